@@ -6,6 +6,7 @@ from data_loaders import find_class_imbalance_mnist
 from networks.custom_dt_gini_with_entropy_metrics import \
     CustomDecisionTree
 from model.loss import SelectiveNetLoss, CELoss
+from utils.util import dataset_column
 
 class MNISTBlackBoxArchitecture:
     def __init__(self, config, device, hard_concepts=None, data_loader=None):
@@ -31,7 +32,7 @@ class MNISTCBMwithSLRaslabelPredictorArchitecture:
         else:
             self.hard_concepts = hard_concepts
 
-        C_train = data_loader.dataset[:][1]
+        C_train = dataset_column(data_loader.dataset, 1)
         if "use_attribute_imbalance" in config["dataset"]:
             if config["dataset"]["use_attribute_imbalance"]:
                 self.imbalance = torch.FloatTensor(find_class_imbalance_mnist(C_train)).to(device)
@@ -82,7 +83,7 @@ class MNISTCBMwithDTaslabelPredictorArchitecture:
         else:
             self.hard_concepts = hard_concepts
 
-        C_train = data_loader.dataset[:][1]
+        C_train = dataset_column(data_loader.dataset, 1)
         if "use_attribute_imbalance" in config["dataset"]:
             if config["dataset"]["use_attribute_imbalance"]:
                 self.imbalance = torch.FloatTensor(find_class_imbalance_mnist(C_train)).to(device)
@@ -150,7 +151,7 @@ class MNISTCBMTreeArchitecture:
         else:
             self.hard_concepts = hard_concepts
 
-        C_train = data_loader.dataset[:][1]
+        C_train = dataset_column(data_loader.dataset, 1)
         dataset_size = len(C_train)
         if "use_attribute_imbalance" in config["dataset"]:
             if config["dataset"]["use_attribute_imbalance"]:
@@ -191,7 +192,7 @@ class MNISTCBMArchitecture:
         else:
             self.hard_concepts = hard_concepts
 
-        C_train = data_loader.dataset[:][1]
+        C_train = dataset_column(data_loader.dataset, 1)
         if "use_attribute_imbalance" in config["dataset"]:
             if config["dataset"]["use_attribute_imbalance"]:
                 self.imbalance = torch.FloatTensor(find_class_imbalance_mnist(C_train)).to(device)
@@ -258,7 +259,7 @@ class MNISTCBMSelectiveNetArchitecture:
         else:
             self.hard_concepts = hard_concepts
 
-        C_train = data_loader.dataset[:][1]
+        C_train = dataset_column(data_loader.dataset, 1)
         if "use_attribute_imbalance" in config["dataset"]:
             if config["dataset"]["use_attribute_imbalance"]:
                 self.imbalance = torch.FloatTensor(find_class_imbalance_mnist(C_train)).to(device)
@@ -9,8 +9,9 @@ from sklearn.tree import DecisionTreeClassifier, export_graphviz
 from base import TrainerBase
 from networks.custom_decision_with_fixed_top_nodes import CustomDecisionTree, tree_to_dict, \
     export_tree
+from utils.apl_estimator import APLEstimator, AsyncAPLPipeline
 from utils.tree_utils import get_light_colors, replace_splits, \
-    modify_dot_with_colors, weighted_node_count, prune_tree
+    modify_dot_with_colors, prune_tree
 
 
 class EpochTrainerBase(TrainerBase):
@@ -23,6 +24,15 @@ class EpochTrainerBase(TrainerBase):
         self.config = config
         self.expert = expert
         self.or_colors = get_light_colors(len(self.or_class_names))
+        # surrogate tree estimators per mode, see _get_apl_estimator
+        self.apl_estimators = {}
+
+        # fit the surrogate trees of the tree-regularised trainers in background
+        # processes (regularisation.async_apl), see _submit_APL
+        self.apl_pipeline = None
+        if 'regularisation' in config.config and config['regularisation'].get('async_apl', False):
+            self.apl_pipeline = AsyncAPLPipeline(
+                max_workers=config['regularisation'].get('async_apl_workers', 1))
 
     def _train_epoch(self, epoch):
         raise NotImplementedError
@@ -30,11 +40,57 @@ class EpochTrainerBase(TrainerBase):
     def _valid_epoch(self, epoch):
         raise NotImplementedError
 
-    def _calculate_APL(self, min_samples_leaf, inputs, outputs):
-
-        tree = DecisionTreeClassifier(min_samples_leaf=min_samples_leaf, random_state=42)
+    def _calculate_APL(self, min_samples_leaf, inputs, outputs, mode=None):
+        """
+        Fit the surrogate tree of the network's predictions and return APL, fidelity,
+        feature importances and the tree. With a `mode` ('train', 'val') the estimator
+        of that mode is used, which keeps its tree across epochs (see _get_apl_estimator).
+        """
         inputs = inputs.detach().cpu().numpy()
+        preds = self._hard_predictions(outputs)
+        self._set_reduced_classes(preds)
+
+        if mode is None:
+            estimator = APLEstimator(min_samples_leaf,
+                                     apl_type=self.config['regularisation'].get('tree_apl_type'))
+        else:
+            estimator = self._get_apl_estimator(mode, min_samples_leaf)
+
+        return estimator.estimate(inputs, preds)
+
+    def _submit_APL(self, min_samples_leaf, inputs, outputs, mode, **context):
+        """
+        Asynchronous _calculate_APL: the tree is fitted by self.apl_pipeline and the
+        result is handed to _on_APL_result(context, ...) by a later _collect_APL.
+        """
+        # copies: on CPU the arrays would be views of the reused EpochBuffer storage, and
+        # the pool pickles its arguments lazily, possibly after the next epoch overwrote them
+        inputs = np.array(inputs.detach().cpu().numpy(), copy=True)
+        preds = np.array(self._hard_predictions(outputs), copy=True)
+        self.apl_pipeline.submit(self._get_apl_estimator(mode, min_samples_leaf),
+                                 inputs, preds, mode=mode, **context)
+
+    def _collect_APL(self, wait=False):
+        if self.apl_pipeline is None:
+            return
+        for context, (APL, fid, fi, tree) in self.apl_pipeline.collect(wait=wait):
+            self._set_reduced_classes(tree.classes_)
+            self._on_APL_result(context, APL, fid, fi, tree)
+
+    def _on_APL_result(self, context, APL, fid, fi, tree):
+        raise NotImplementedError
 
+    def _training_loop(self, epochs):
+        try:
+            super(EpochTrainerBase, self)._training_loop(epochs)
+        finally:
+            if self.apl_pipeline is not None:
+                self._collect_APL(wait=True)
+                self.apl_pipeline.shutdown()
+                self.apl_pipeline = None
+
+    @staticmethod
+    def _hard_predictions(outputs):
         if outputs.shape[1] == 1:
             outputs = torch.sigmoid(outputs)
             outputs = outputs.detach().cpu().numpy()
@@ -44,24 +100,29 @@ class EpochTrainerBase(TrainerBase):
             preds = np.argmax(outputs, axis=1)
         else:
             raise ValueError('Invalid number of output classes')
+        return preds
 
+    def _set_reduced_classes(self, preds):
         self.reduced_class_names = [self.or_class_names[i] for i in self.class_mapping if i in preds]
         self.reduced_colors = [self.or_colors[i] for i in self.class_mapping if i in preds]
         self.reduced_colors_dict = {i: self.reduced_colors[i] for i in range(len(self.reduced_class_names))}
 
-        tree.fit(inputs, preds)
-        y_pred = tree.predict(inputs)
-        fid = accuracy_score(preds, y_pred)
-
-        if "tree_apl_type" in self.config['regularisation']:
-            if self.config['regularisation']['tree_apl_type'] == 'weighted_node_count':
-                APL = weighted_node_count(tree, inputs)
-            else:
-                APL = tree.tree_.node_count
-        else:
-            APL = tree.tree_.node_count
-
-        return APL, fid, list(tree.feature_importances_), tree
+    def _get_apl_estimator(self, mode, min_samples_leaf):
+        """
+        The APL estimator of `mode`, configured from the 'regularisation' section:
+        apl_subsample_size (fit on a stratified subsample), apl_reuse_tolerance and
+        apl_max_reuse (keep the previous epoch's tree while its fidelity holds).
+        Without these keys every epoch fits a new tree on all samples.
+        """
+        if mode not in self.apl_estimators:
+            reg_config = self.config['regularisation']
+            self.apl_estimators[mode] = APLEstimator(
+                min_samples_leaf,
+                apl_type=reg_config.get('tree_apl_type'),
+                subsample_size=reg_config.get('apl_subsample_size'),
+                reuse_tolerance=reg_config.get('apl_reuse_tolerance'),
+                max_reuse=reg_config.get('apl_max_reuse', 5))
+        return self.apl_estimators[mode]
 
     def _visualize_tree(self, tree, config, epoch, APL, train_acc, val_acc,
                         mode, expert=None):
@@ -53,6 +53,14 @@ class TrainerBase:
         if config.resume is not None:
             self._resume_checkpoint(config.resume)
 
+    def _set_sampler_epoch(self, epoch):
+        """Reseed epoch-aware samplers (e.g. DistributedImbalancedDatasetSampler) of the train loader."""
+        data_loader = getattr(self, 'train_loader', None)
+        for sampler in (getattr(data_loader, 'sampler', None),
+                        getattr(getattr(data_loader, 'batch_sampler', None), 'sampler', None)):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
     @abstractmethod
     def _train_epoch(self, epoch):
         """
@@ -69,6 +77,7 @@ class TrainerBase:
         """
         not_improved_count = 0
         for epoch in range(self.start_epoch, epochs):
+            self._set_sampler_epoch(epoch)
             result = self._train_epoch(epoch)
 
             # save logged informations into log dict
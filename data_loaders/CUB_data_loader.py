@@ -1,3 +1,4 @@
+import math
 import os
 import pickle
 from pathlib import Path
@@ -9,6 +10,10 @@ from torchvision import datasets, transforms
 from PIL import Image
 from torch.utils.data import BatchSampler
 
+from data_loaders.batched_augmentation import BatchedCUBAugmentation, BatchTransformLoader
+from data_loaders.cub_image_store import CUBImageStore, resolve_cub_img_path
+from utils.util import dataset_column, prepare_device
+
 CUB_PROCESSED_DIR = Path("datasets/CUB/class_attr_data_10")
 CUB_DATA_DIR = Path("datasets/CUB/CUB_200_2011")
 N_ATTRIBUTES = 312
@@ -456,7 +461,12 @@ CONCEPT_SEMANTICS = [
 
 def get_cub_dataLoader(data_dir='./datasets/parabola',
                        type='Full-GD', config=None,
-                       batch_size=None):
+                       batch_size=None, image_store_dir=None,
+                       image_store_size=None, num_workers=0,
+                       pin_memory=False, persistent_workers=False,
+                       prefetch_factor=None, augmentation='pil',
+                       resampling=False, resampling_attributes=None,
+                       distributed=False):
 
     num_classes = config['dataset']['num_classes']
     if "indices_to_keep_from_or_concept_list" in config['dataset']:
@@ -468,26 +478,40 @@ def get_cub_dataLoader(data_dir='./datasets/parabola',
     VAL_PKL = str(CUB_PROCESSED_DIR) + "/val.pkl"
     TEST_PKL = str(CUB_PROCESSED_DIR) + "/test.pkl"
     normalizer = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[2, 2, 2])
+    loader_kwargs = dict(image_store_dir=image_store_dir,
+                         image_store_size=image_store_size,
+                         num_workers=num_workers, pin_memory=pin_memory,
+                         persistent_workers=persistent_workers,
+                         prefetch_factor=prefetch_factor,
+                         augmentation=augmentation)
+    if augmentation == 'batched':
+        # augment on the device the model will use
+        loader_kwargs['augmentation_device'] = prepare_device(config['n_gpu'])[0]
     train_loader = load_cub_data([TRAIN_PKL], use_attr=True, no_img=False,
                                  batch_size=batch_size,
                                  uncertain_label=False, image_dir=str(CUB_DATA_DIR),
                                  resol=224, normalizer=normalizer,
-                                 n_classes=num_classes, resampling=False,
-                                 reduced_concepts=reduced_concepts)
+                                 n_classes=num_classes, resampling=resampling,
+                                 reduced_concepts=reduced_concepts,
+                                 resampling_attributes=resampling_attributes,
+                                 distributed=distributed,
+                                 **loader_kwargs)
 
     val_loader = load_cub_data([VAL_PKL], use_attr=True, no_img=False,
                                  batch_size=batch_size,
                                  uncertain_label=False, image_dir=str(CUB_DATA_DIR),
                                  resol=224, normalizer=normalizer,
                                  n_classes=num_classes, resampling=False,
-                                 reduced_concepts=reduced_concepts)
+                                 reduced_concepts=reduced_concepts,
+                                 **loader_kwargs)
 
     test_loader = load_cub_data([TEST_PKL], use_attr=True, no_img=False,
                                 batch_size=batch_size,
                                 uncertain_label=False, image_dir=str(CUB_DATA_DIR),
                                 resol=224, normalizer=normalizer,
                                 n_classes=num_classes, resampling=False,
-                                reduced_concepts=reduced_concepts)
+                                reduced_concepts=reduced_concepts,
+                                **loader_kwargs)
 
     classes = open(os.path.join(CUB_DATA_DIR, "classes.txt")).readlines()
     classes = [a.split(".")[1].strip() for a in classes]
@@ -506,32 +530,74 @@ def load_cub_data(pkl_paths, use_attr, no_img, batch_size,
                   resampling=False, resol=299,
                   normalizer=transforms.Normalize(mean=[0.5, 0.5, 0.5],
                                                   std=[2, 2, 2]),
-                  n_classes=200, reduced_concepts=None):
+                  n_classes=200, reduced_concepts=None,
+                  image_store_dir=None, image_store_size=None, num_workers=0,
+                  pin_memory=False, persistent_workers=False,
+                  prefetch_factor=None, augmentation='pil',
+                  augmentation_device='cpu', resampling_attributes=None,
+                  distributed=False):
     """
     Note: Inception needs (299,299,3) images with inputs scaled between -1 and 1
     Loads data with transformations applied, and upsample the minority class if there is class imbalance and weighted loss is not used
-    NOTE: resampling is customized for first attribute only, so change sampler.py if necessary
+    NOTE: resampling balances the class labels, or the concepts resampling_attributes if given;
+    with distributed, every data-parallel process draws its own share of the resampled indices
+    (they change every epoch, the trainers call set_epoch on loader.batch_sampler.sampler)
+    image_store_dir: if given, the images are decoded once into a memory-mapped store of
+    uint8 images (see CUBImageStore) and the transforms run on tensors instead of PIL
+    images. They keep their original resolution unless image_store_size is set, which
+    resizes their shorter side to it and changes the pixel-sized crops (see CUBImageStore)
+    augmentation: 'pil' applies the transforms per sample in the loader workers,
+    'batched' (requires image_store_dir and image_store_size, the stored images are
+    center-cropped to image_store_size squares) loads uint8 batches and applies
+    BatchedCUBAugmentation to whole batches on augmentation_device
     """
+    if augmentation not in ('pil', 'batched'):
+        raise ValueError(f'Unknown augmentation: {augmentation}')
+    if augmentation == 'batched' and image_store_dir is None:
+        raise ValueError('Batched augmentation needs fixed size images, set image_store_dir')
+    if augmentation == 'batched' and image_store_size is None:
+        raise ValueError('Batched augmentation needs fixed size images, set image_store_size')
     is_training = any(['train.pkl' in f for f in pkl_paths])
+    # the store yields uint8 tensors, ToTensor only accepts PIL images / arrays
+    to_tensor = transforms.ToTensor() if image_store_dir is None \
+        else transforms.ConvertImageDtype(torch.float)
     if is_training:
         transform = transforms.Compose([
             transforms.ColorJitter(brightness=32 / 255,
                                    saturation=(0.5, 1.5)),
             transforms.RandomResizedCrop(resol),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
+            to_tensor,
             normalizer
         ])
     else:
         transform = transforms.Compose([
             transforms.CenterCrop(resol),
-            transforms.ToTensor(),
+            to_tensor,
             normalizer
         ])
 
+    if augmentation == 'batched':
+        batch_transform = BatchedCUBAugmentation(resol, train=is_training,
+                                                 mean=normalizer.mean,
+                                                 std=normalizer.std)
+        transform = None
+
     dataset = CUBDataset(pkl_paths, use_attr, no_img, uncertain_label,
                          image_dir, n_class_attr, n_classes, transform,
                          reduced_concepts=reduced_concepts)
+    if image_store_dir is not None and not no_img:
+        split = os.path.splitext(os.path.basename(pkl_paths[0]))[0]
+        dataset.image_store = CUBImageStore(dataset.img_paths, image_dir,
+                                            image_store_dir, split,
+                                            size=image_store_size,
+                                            crop=augmentation == 'batched')
+
+    worker_kwargs = dict(num_workers=num_workers, pin_memory=pin_memory)
+    if num_workers > 0:
+        worker_kwargs['persistent_workers'] = persistent_workers
+        if prefetch_factor is not None:
+            worker_kwargs['prefetch_factor'] = prefetch_factor
 
     if is_training:
         drop_last = True
@@ -540,12 +606,16 @@ def load_cub_data(pkl_paths, use_attr, no_img, batch_size,
         drop_last = False
         shuffle = False
     if resampling:
-        sampler = BatchSampler(ImbalancedDatasetSampler(dataset),
+        sampler_class = DistributedImbalancedDatasetSampler if distributed \
+            else ImbalancedDatasetSampler
+        sampler = BatchSampler(sampler_class(dataset, attributes=resampling_attributes),
                                batch_size=batch_size, drop_last=drop_last)
-        loader = DataLoader(dataset, batch_sampler=sampler)
+        loader = DataLoader(dataset, batch_sampler=sampler, **worker_kwargs)
     else:
         loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
-                            drop_last=drop_last)
+                            drop_last=drop_last, **worker_kwargs)
+    if augmentation == 'batched' and not no_img:
+        loader = BatchTransformLoader(loader, batch_transform, augmentation_device)
     return loader
 
 def find_class_imbalance(pkl_file, multiple_attr=False, attr_idx=-1):
@@ -641,99 +711,170 @@ class CUBDataset(Dataset):
         self.image_dir = image_dir
         self.n_class_attr = n_class_attr
         self.num_classes = num_classes
+        # optional pre-decoded images, see load_cub_data
+        self.image_store = None
+
+        # columns of the records, so that concept / label access needs no per-record loop
+        self.img_paths = np.array([record['img_path'] for record in self.data])
+        self.class_labels = np.array([record['class_label'] for record in self.data],
+                                     dtype=np.int64)
+        self.attribute_labels = np.array([record['attribute_label'] for record in self.data],
+                                         dtype=np.float32)
+        self.uncertain_attribute_labels = None
+        if uncertain_label:
+            self.uncertain_attribute_labels = np.array(
+                [record['uncertain_attribute_label'] for record in self.data],
+                dtype=np.float32)
 
         if reduced_concepts is not None:
-            for i in self.data:
-                i["attribute_label"] = list(np.array(i["attribute_label"])[reduced_concepts])
-            print("Reduced length of data attributes to", len(self.data[0]["attribute_label"]))
+            self.attribute_labels = np.ascontiguousarray(
+                self.attribute_labels[:, reduced_concepts])
+            print("Reduced length of data attributes to", self.attribute_labels.shape[1])
+        self.C = torch.from_numpy(self.attribute_labels)
+        self.y = torch.from_numpy(self.class_labels)
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
-        img_data = self.data[idx]
-        img_path = img_data['img_path']
-        # Trim unnecessary paths
-
-        idx = img_path.split('/').index('CUB_200_2011')
-        img_path = '/'.join([self.image_dir] + img_path.split('/')[idx + 1:])
-        img = Image.open(img_path).convert('RGB')
-
-        class_label = img_data['class_label']
-        if self.transform:
-            img = self.transform(img)
-
+        class_label = int(self.class_labels[idx])
         if self.use_attr:
             if self.uncertain_label:
-                attr_label = img_data['uncertain_attribute_label']
+                attr_label = self.uncertain_attribute_labels[idx]
             else:
-                attr_label = img_data['attribute_label']
+                attr_label = self.attribute_labels[idx]
             if self.no_img:
                 if self.n_class_attr == 3:
                     one_hot_attr_label = np.zeros(
                         (N_ATTRIBUTES, self.n_class_attr))
-                    one_hot_attr_label[np.arange(N_ATTRIBUTES), attr_label] = 1
+                    one_hot_attr_label[np.arange(N_ATTRIBUTES), attr_label.astype(int)] = 1
                     return one_hot_attr_label, class_label
                 else:
-                    return attr_label, class_label
-            else:
-                return img, torch.tensor(attr_label).float(), class_label
+                    return attr_label.tolist(), class_label
+
+        img = self._load_image(idx)
+        if self.transform:
+            img = self.transform(img)
+
+        if self.use_attr:
+            return img, torch.from_numpy(attr_label.copy()), class_label
         else:
             return img, class_label
 
+    def _load_image(self, idx):
+        if self.image_store is not None:
+            return self.image_store[idx]
+        # Trim unnecessary paths
+        img_path = resolve_cub_img_path(self.img_paths[idx], self.image_dir)
+        return Image.open(img_path).convert('RGB')
+
+    def columns(self, *indices):
+        """Concepts (1) and labels (2) of the (image, concepts, label) samples."""
+        columns = {1: self.C, 2: self.y}
+        if any(index not in columns for index in indices):
+            raise ValueError('Only the concept (1) and label (2) columns of CUB can be read at once')
+        return tuple(columns[index] for index in indices)
+
     def get_all_data_in_tensors(self, batch_size, shuffle, return_loader=True):
-        all_C = []
-        all_y = []
-        for i in self.data:
-            all_C.append(i["attribute_label"])
-            all_y.append(i["class_label"])
-        all_C = torch.tensor(all_C).float()
-        all_y = torch.tensor(all_y).long()
-        all_data = TensorDataset(all_C, all_y)
-        dataloader = DataLoader(all_data, batch_size=batch_size, shuffle=shuffle)
+        """
+        All concepts and labels, as (views of) the tensors built at construction,
+        or a loader over them.
+        """
         if return_loader:
-            return dataloader
+            all_data = TensorDataset(self.C, self.y)
+            return DataLoader(all_data, batch_size=batch_size, shuffle=shuffle)
         else:
-            return all_C, all_y
+            return self.C, self.y
 
 class ImbalancedDatasetSampler(torch.utils.data.sampler.Sampler):
     """Samples elements randomly from a given list of indices for imbalanced dataset
     Arguments:
         indices (list, optional): a list of indices
         num_samples (int, optional): number of samples to draw
+        attributes (list, optional): balance these binary concepts instead of the
+            class labels; a sample is weighted by the mean over the attributes of
+            1 / (number of samples with its value of the attribute)
+    The weights are computed once, from the label / concept columns of the dataset.
     """
 
-    def __init__(self, dataset, indices=None):
+    def __init__(self, dataset, indices=None, num_samples=None, attributes=None):
         # if indices is not provided,
         # all elements in the dataset will be considered
-        self.indices = list(range(len(dataset))) \
-            if indices is None else indices
+        self.indices = torch.arange(len(dataset)) if indices is None \
+            else torch.as_tensor(indices, dtype=torch.long)
 
         # if num_samples is not provided,
         # draw `len(indices)` samples in each iteration
-        self.num_samples = len(self.indices)
-
-        # distribution of classes in the dataset
-        label_to_count = {}
-        for idx in self.indices:
-            label = self._get_label(dataset, idx)
-            if label in label_to_count:
-                label_to_count[label] += 1
-            else:
-                label_to_count[label] = 1
+        self.num_samples = len(self.indices) if num_samples is None else num_samples
+        self.weights = self._compute_weights(dataset, self.indices.numpy(), attributes)
+
+    @staticmethod
+    def _compute_weights(dataset, indices, attributes):
+        if attributes is None:
+            labels = ImbalancedDatasetSampler._get_labels(dataset)[indices]
+            _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+            return torch.from_numpy(1.0 / counts[inverse])
+
+        C = np.asarray(dataset.attribute_labels)[indices][:, attributes] > 0.5
+        n_positive = C.sum(axis=0)
+        counts = np.where(C, n_positive, len(C) - n_positive)
+        return torch.from_numpy((1.0 / counts).mean(axis=1))
+
+    @staticmethod
+    def _get_labels(dataset):
+        if hasattr(dataset, 'class_labels'):
+            return np.asarray(dataset.class_labels)
+        return np.asarray(dataset_column(dataset, 2))
+
+    def _draw(self, generator=None):
+        draws = torch.multinomial(self.weights, self.num_samples, replacement=True,
+                                  generator=generator)
+        return self.indices[draws]
 
-        # weight for each sample
-        weights = [1.0 / label_to_count[self._get_label(dataset, idx)]
-                   for idx in self.indices]
-        self.weights = torch.DoubleTensor(weights)
+    def __iter__(self):
+        return iter(self._draw().tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class DistributedImbalancedDatasetSampler(ImbalancedDatasetSampler):
+    """
+    ImbalancedDatasetSampler for data-parallel training: every process draws the same
+    num_samples indices (from `seed` and the epoch) and keeps every num_replicas-th one
+    starting at its rank. The epoch advances after every iteration, and set_epoch
+    (called by the trainers before every epoch) sets it explicitly, e.g. on resume.
+    """
 
-    def _get_label(self, dataset, idx):  # Note: for single attribute dataset
-        return dataset.data[idx]['class_label']  # [0]
+    def __init__(self, dataset, indices=None, num_samples=None, attributes=None,
+                 num_replicas=None, rank=None, seed=0):
+        super().__init__(dataset, indices=indices, num_samples=num_samples,
+                         attributes=attributes)
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f'Invalid rank {rank} for {num_replicas} replicas')
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        # every replica draws the same number of samples
+        self.total_size = int(math.ceil(self.num_samples / num_replicas)) * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
     def __iter__(self):
-        idx = (self.indices[i] for i in torch.multinomial(
-            self.weights, self.num_samples, replacement=True))
-        return idx
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        # all replicas iterate once per epoch, so they stay in step
+        self.epoch += 1
+        draws = torch.multinomial(self.weights, self.total_size, replacement=True,
+                                  generator=generator)
+        return iter(self.indices[draws[self.rank::self.num_replicas]].tolist())
 
     def __len__(self):
-        return self.num_samples
\ No newline at end of file
+        return self.total_size // self.num_replicas
@@ -1,3 +1,4 @@
 from .parabola_data_loader import *
 from .mnist_data_loader import *
 from .CUB_data_loader import *
+from .sharded_dataset import *
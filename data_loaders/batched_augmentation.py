@@ -0,0 +1,135 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class BatchedCUBAugmentation:
+    """
+    Batched tensor version of the CUB transforms of load_cub_data, for uint8 (B, 3, H, W)
+    batches on any device.
+
+    train: RandomResizedCrop(resol) + RandomHorizontalFlip as one bilinear grid_sample per
+    batch, then ColorJitter(brightness=32 / 255, saturation=(0.5, 1.5)) with per-sample
+    factors and order. The crop / flip / jitter parameters follow the torchvision
+    distributions; the jitter runs after the crop (on fewer pixels), which only differs
+    from the PIL pipeline by interpolation rounding.
+    eval: CenterCrop(resol).
+    Both then scale to [0, 1] and normalise with `mean` / `std`.
+    """
+
+    def __init__(self, resol, train, mean=(0.5, 0.5, 0.5), std=(2, 2, 2),
+                 scale=(0.08, 1.0), ratio=(3 / 4, 4 / 3), brightness=32 / 255,
+                 saturation=(0.5, 1.5), n_attempts=10):
+        self.resol = resol
+        self.train = train
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.scale = scale
+        self.ratio = ratio
+        self.brightness = (1 - brightness, 1 + brightness)
+        self.saturation = saturation
+        self.n_attempts = n_attempts
+
+    def __call__(self, images):
+        images = images.float().div_(255)
+        if self.train:
+            images = self._resized_crop_flip(images)
+            images = self._color_jitter(images)
+        else:
+            images = self._center_crop(images)
+        mean, std = self.mean.to(images.device), self.std.to(images.device)
+        return (images - mean) / std
+
+    def _center_crop(self, images):
+        height, width = images.shape[-2:]
+        if height < self.resol or width < self.resol:
+            raise ValueError(f'Cannot center crop {self.resol} from images of size {height}x{width}')
+        top, left = int(round((height - self.resol) / 2.0)), int(round((width - self.resol) / 2.0))
+        return images[..., top:top + self.resol, left:left + self.resol]
+
+    def _crop_boxes(self, batch_size, height, width, device):
+        """(top, left, h, w) per sample, drawn like transforms.RandomResizedCrop.get_params."""
+        area = height * width
+        shape = (batch_size, self.n_attempts)
+        target_area = area * torch.empty(shape, device=device).uniform_(*self.scale)
+        log_ratio = (math.log(self.ratio[0]), math.log(self.ratio[1]))
+        aspect = torch.exp(torch.empty(shape, device=device).uniform_(*log_ratio))
+        w = torch.round(torch.sqrt(target_area * aspect))
+        h = torch.round(torch.sqrt(target_area / aspect))
+        valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+
+        # fallback of get_params when no attempt fits: whole image, clamped to the ratio range
+        in_ratio = width / height
+        if in_ratio < min(self.ratio):
+            fallback_w, fallback_h = width, int(round(width / min(self.ratio)))
+        elif in_ratio > max(self.ratio):
+            fallback_w, fallback_h = int(round(height * max(self.ratio))), height
+        else:
+            fallback_w, fallback_h = width, height
+
+        any_valid = valid.any(dim=1)
+        first = valid.float().argmax(dim=1, keepdim=True)
+        w = torch.where(any_valid, w.gather(1, first).squeeze(1), torch.full_like(w[:, 0], fallback_w))
+        h = torch.where(any_valid, h.gather(1, first).squeeze(1), torch.full_like(h[:, 0], fallback_h))
+        top = torch.floor(torch.rand(batch_size, device=device) * (height - h + 1))
+        left = torch.floor(torch.rand(batch_size, device=device) * (width - w + 1))
+        top = torch.where(any_valid, top, (height - h).div(2, rounding_mode='floor'))
+        left = torch.where(any_valid, left, (width - w).div(2, rounding_mode='floor'))
+        return top, left, h, w
+
+    def _resized_crop_flip(self, images):
+        batch_size, _, height, width = images.shape
+        top, left, h, w = self._crop_boxes(batch_size, height, width, images.device)
+        flip = torch.where(torch.rand(batch_size, device=images.device) < 0.5, -1.0, 1.0)
+
+        # affine map from output to input coordinates in [-1, 1]
+        theta = torch.zeros(batch_size, 2, 3, device=images.device)
+        theta[:, 0, 0] = w / width * flip
+        theta[:, 0, 2] = (2 * left + w) / width - 1
+        theta[:, 1, 1] = h / height
+        theta[:, 1, 2] = (2 * top + h) / height - 1
+        grid = F.affine_grid(theta, (batch_size, 3, self.resol, self.resol), align_corners=False)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+    def _color_jitter(self, images):
+        batch_size = images.shape[0]
+        device = images.device
+        brightness = torch.empty(batch_size, 1, 1, 1, device=device).uniform_(*self.brightness)
+        saturation = torch.empty(batch_size, 1, 1, 1, device=device).uniform_(*self.saturation)
+
+        def adjust_brightness(x):
+            return (x * brightness).clamp_(0, 1)
+
+        def adjust_saturation(x):
+            gray = (0.2989 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3])
+            return (x * saturation + gray * (1 - saturation)).clamp_(0, 1)
+
+        # ColorJitter applies its adjustments in a random order per call (here per sample)
+        brightness_first = torch.rand(batch_size, 1, 1, 1, device=device) < 0.5
+        return torch.where(brightness_first,
+                           adjust_saturation(adjust_brightness(images)),
+                           adjust_brightness(adjust_saturation(images)))
+
+
+class BatchTransformLoader:
+    """
+    DataLoader wrapper that moves the images of every (X, C, y) batch to `device` and
+    applies `batch_transform` there. Everything else is forwarded to the wrapped loader.
+    """
+
+    def __init__(self, data_loader, batch_transform, device):
+        self.data_loader = data_loader
+        self.batch_transform = batch_transform
+        self.device = device
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        for X_batch, *rest in self.data_loader:
+            X_batch = X_batch.to(self.device, non_blocking=True)
+            yield (self.batch_transform(X_batch), *rest)
+
+    def __getattr__(self, name):
+        return getattr(self.data_loader, name)
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class ConceptBinEncoder:
+    """
+    One-hot bins of continuous concepts, with bin edges fitted once and reused verbatim,
+    e.g. fitted on the train split and applied to val and test.
+
+    binning='quantile': bins with about the same number of fitted samples per concept
+    (edges at every len // num_bins sorted value, the first one open at -inf).
+    binning='uniform': bins of equal width between the fitted min and max.
+    As in the original loaders, values equal to the first 'uniform' edge (i.e. the fitted
+    minimum) fall in the last bin; values above the last edge fall in the last bin.
+    """
+
+    def __init__(self, num_bins=4, binning='quantile'):
+        if binning not in ('quantile', 'uniform'):
+            raise ValueError(f'Unknown binning: {binning}')
+        self.num_bins = num_bins
+        self.binning = binning
+        self.bin_edges_ = None
+
+    def fit(self, concepts_raw):
+        """Fit the (num_bins + 1, n_concepts) bin edges of the (n_samples, n_concepts) values."""
+        concepts_raw = np.asarray(concepts_raw, dtype=np.float64)
+        if self.binning == 'quantile':
+            values_sorted = np.sort(concepts_raw, axis=0)
+            bin_size = len(values_sorted) // self.num_bins
+            rows = [i * bin_size for i in range(1, self.num_bins)] + [len(values_sorted) - 1]
+            self.bin_edges_ = np.vstack([np.full((1, concepts_raw.shape[1]), -np.inf),
+                                         values_sorted[rows]])
+        else:
+            self.bin_edges_ = np.linspace(concepts_raw.min(axis=0), concepts_raw.max(axis=0),
+                                          self.num_bins + 1)
+        return self
+
+    def bin_indices(self, concepts_raw):
+        """(n_samples, n_concepts) bin of every value, in [0, num_bins)."""
+        if self.bin_edges_ is None:
+            raise ValueError('ConceptBinEncoder must be fitted before transform')
+        concepts_raw = np.asarray(concepts_raw, dtype=np.float64)
+        # np.digitize(right=True) of every concept with its own edges
+        bins = np.stack([np.searchsorted(self.bin_edges_[:, i], concepts_raw[:, i], side='left')
+                         for i in range(concepts_raw.shape[1])], axis=1)
+        return (np.minimum(bins, self.num_bins) - 1) % self.num_bins
+
+    def transform(self, concepts_raw):
+        """(n_samples, n_concepts * num_bins) float32 one-hot bins."""
+        bins = self.bin_indices(concepts_raw)
+        n_samples, n_concepts = bins.shape
+        C = np.zeros((n_samples, n_concepts * self.num_bins), dtype=np.float32)
+        C[np.arange(n_samples)[:, None], np.arange(n_concepts) * self.num_bins + bins] = 1
+        return C
+
+    def fit_transform(self, concepts_raw):
+        return self.fit(concepts_raw).transform(concepts_raw)
+
+
+def encode_concept_splits(encoder, train_raw, *other_raw):
+    """Fit `encoder` on the raw concepts of the train split and encode every split with it."""
+    encoder.fit(train_raw)
+    return [encoder.transform(raw) for raw in (train_raw,) + other_raw]
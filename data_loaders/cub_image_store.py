@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+# bump when the decoding / resizing of the stored images changes
+CUB_STORE_VERSION = 2
+
+
+def resolve_cub_img_path(img_path, image_dir):
+    """Path of a CUB image under `image_dir`, from the (absolute) path stored in the pkl files."""
+    parts = img_path.split('/')
+    idx = parts.index('CUB_200_2011')
+    return '/'.join([image_dir] + parts[idx + 1:])
+
+
+def stored_image_size(width, height, size, crop=False):
+    """(width, height) of a width x height image in a store of `size` (see decode_cub_image)."""
+    if crop:
+        return size, size
+    if size is None:
+        return width, height
+    scale = size / min(width, height)
+    return max(size, round(width * scale)), max(size, round(height * scale))
+
+
+def decode_cub_image(path, size, crop=False):
+    """
+    RGB (height, width, 3) uint8 image, resized so that its shorter side is `size`
+    (kept at its original resolution if size is None), and center-cropped to
+    (size, size, 3) if `crop`.
+    """
+    img = Image.open(path).convert('RGB')
+    width, height = img.size
+    new_width, new_height = stored_image_size(width, height, size)
+    if (new_width, new_height) != (width, height):
+        img = img.resize((new_width, new_height), Image.BILINEAR)
+    if crop:
+        left, top = (new_width - size) // 2, (new_height - size) // 2
+        img = img.crop((left, top, left + size, top + size))
+    return np.asarray(img, dtype=np.uint8)
+
+
+def build_cub_image_store(img_paths, image_dir, store_path, size, crop=False, n_threads=8):
+    """
+    Decode the images `img_paths` (as stored in the pkl files) once and write them to
+    `store_path`: images.npy, a (n, H, W, 3) uint8 array in that order where every image
+    is in the top-left corner, shapes.npy, the (n, 2) height and width of every image,
+    and meta.json.
+    """
+    img_paths = [str(img_path) for img_path in img_paths]
+    paths = [resolve_cub_img_path(img_path, image_dir) for img_path in img_paths]
+    tmp_path = store_path + f'.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    # only the headers are read here
+    shapes = np.zeros((len(paths), 2), dtype=np.int64)
+    for i, path in enumerate(paths):
+        with Image.open(path) as img:
+            width, height = stored_image_size(*img.size, size, crop=crop)
+        shapes[i] = height, width
+    np.save(os.path.join(tmp_path, 'shapes.npy'), shapes)
+    max_height, max_width = shapes.max(axis=0) if len(paths) else (0, 0)
+    images = np.lib.format.open_memmap(os.path.join(tmp_path, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), int(max_height), int(max_width), 3))
+
+    def decode(i):
+        height, width = shapes[i]
+        images[i, :height, :width] = decode_cub_image(paths[i], size, crop=crop)
+
+    # PIL releases the GIL while decoding, so threads are enough
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for i, _ in enumerate(executor.map(decode, range(len(paths)))):
+            if (i + 1) % 1000 == 0:
+                print(f'Decoded {i + 1}/{len(paths)} CUB images')
+    images.flush()
+    del images
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'version': CUB_STORE_VERSION, 'size': size, 'crop': crop, 'img_paths': img_paths}, f)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+    print(f'Stored {len(paths)} CUB images of size {size} in {store_path}')
+
+
+class CUBImageStore:
+    """
+    Pre-decoded CUB images of one split, memory-mapped from a store built on first use.
+
+    With size=None the images are stored at their original resolution, so the transforms
+    see exactly the images of the PIL path. Otherwise their shorter side is resized to
+    `size`, which changes what the pixel-sized transforms see: CenterCrop(resol) covers
+    resol / size of the shorter side instead of a resol pixel patch of the ~500 pixel
+    original (the Resize(256) + CenterCrop(224) protocol for size 256), so a model must
+    be evaluated with the same image store settings it was trained with.
+    With `crop`, images are also center-cropped to size x size, as needed for batched
+    augmentation: train crops then cannot reach the borders outside that square.
+
+    The store lives in `store_dir/<split>_<size>[_crop]` and is rebuilt if its version,
+    size, crop or image list does not match `img_paths`. The memory map is opened lazily,
+    so that every DataLoader worker opens its own.
+    """
+
+    def __init__(self, img_paths, image_dir, store_dir, split, size=None, crop=False):
+        if crop and size is None:
+            raise ValueError('Cropped CUB image stores need a size')
+        self.size = size
+        self.crop = crop
+        self.path = os.path.join(store_dir, f'{split}_{size or "original"}' + ('_crop' if crop else ''))
+        self._images = None
+        self._shapes = None
+        img_paths = [str(img_path) for img_path in img_paths]
+        if not self._is_valid(img_paths):
+            build_cub_image_store(img_paths, image_dir, self.path, size, crop=crop)
+
+    def _is_valid(self, img_paths):
+        meta_file = os.path.join(self.path, 'meta.json')
+        if any(not os.path.exists(os.path.join(self.path, name))
+               for name in ('meta.json', 'images.npy', 'shapes.npy')):
+            return False
+        with open(meta_file) as f:
+            meta = json.load(f)
+        return (meta['version'] == CUB_STORE_VERSION and meta['size'] == self.size
+                and meta.get('crop') == self.crop and meta['img_paths'] == img_paths)
+
+    def __len__(self):
+        return len(self.images)
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(os.path.join(self.path, 'images.npy'), mmap_mode='r')
+        return self._images
+
+    @property
+    def shapes(self):
+        if self._shapes is None:
+            self._shapes = np.load(os.path.join(self.path, 'shapes.npy'))
+        return self._shapes
+
+    def __getitem__(self, idx):
+        """(3, height, width) uint8 tensor of image `idx`."""
+        height, width = self.shapes[idx]
+        return torch.from_numpy(np.array(self.images[idx, :height, :width])).permute(2, 0, 1)
+
+    def __getstate__(self):
+        # do not pickle the memory map into worker processes
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+from data_loaders.concept_encoding import ConceptBinEncoder
+
+# bump when the content or layout of the cached arrays changes
+MNIST_CACHE_VERSION = 2
+
+MNIST_ROOT = './datasets/MNIST/data'
+MORPHO_DIR = './datasets/MNIST/mine_preprocessed'
+MNIST_CACHE_DIR = './datasets/MNIST/cache'
+
+MORPHO_CONCEPTS = ['area', 'length', 'thickness', 'slant', 'width', 'height']
+
+
+def _cache_key(spec):
+    return hashlib.md5(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def _build_mnist_concepts(spec, with_images):
+    """Images, raw and binned concepts and labels of the digits in `spec`, grouped by digit."""
+    morpho = {}
+    for concept in spec['concepts']:
+        with open(os.path.join(MORPHO_DIR, f'{concept}_dict.pkl'), 'rb') as f:
+            morpho[concept] = pickle.load(f)
+
+    concepts_raw = np.concatenate([
+        np.stack([np.asarray(morpho[concept][digit], dtype=np.float64) for concept in spec['concepts']],
+                 axis=1)
+        for digit in spec['digits']])
+    y = np.concatenate([np.full(len(morpho[spec['concepts'][0]][digit]), k, dtype=np.int64)
+                        for k, digit in enumerate(spec['digits'])])
+    encoder = ConceptBinEncoder(spec['num_bins'], spec['binning'])
+    arrays = {
+        'concepts_raw': concepts_raw,
+        'C': encoder.fit_transform(concepts_raw),
+        'bin_edges': encoder.bin_edges_,
+        'y': y,
+    }
+
+    if with_images:
+        from torchvision import datasets
+        mnist = datasets.MNIST(root=MNIST_ROOT, train=True, download=True)
+        images = mnist.data.numpy()
+        targets = mnist.targets.numpy()
+        # train images of each digit in dataset order, as the morpho dicts are
+        arrays['X'] = np.concatenate([images[targets == digit] for digit in spec['digits']]
+                                     ).reshape(-1, 1, 28, 28)
+        if len(arrays['X']) != len(y):
+            raise ValueError(f'{len(arrays["X"])} MNIST images but {len(y)} morpho samples '
+                             f'for digits {spec["digits"]}')
+    return arrays
+
+
+def load_mnist_concepts(digits, concepts, num_bins=4, binning='quantile', with_images=True,
+                        cache_dir=MNIST_CACHE_DIR, rebuild=False):
+    """
+    Morpho-MNIST train split of `digits`, memory-mapped from a cache built on the first call.
+
+    Returns a dict of read-only arrays in digit order:
+        X: (n, 1, 28, 28) uint8 images (only if `with_images`)
+        concepts_raw: (n, len(concepts)) morphometric values
+        C: (n, len(concepts) * num_bins) float32 one-hot bins, edges fitted on all n samples
+        bin_edges: (num_bins + 1, len(concepts)) the edges of C
+        y: (n,) int64 labels, the position of the digit in `digits`
+    The cache is keyed by the digits, concepts and binning config (and MNIST_CACHE_VERSION),
+    so loaders that only differ in their splits or batch sizes share it.
+    """
+    spec = {'version': MNIST_CACHE_VERSION, 'digits': [int(d) for d in digits],
+            'concepts': list(concepts), 'num_bins': int(num_bins), 'binning': binning}
+    unknown = [c for c in spec['concepts'] if c not in MORPHO_CONCEPTS]
+    if unknown:
+        raise ValueError(f'Unknown Morpho-MNIST concepts: {unknown}')
+    names = (['X'] if with_images else []) + ['concepts_raw', 'C', 'bin_edges', 'y']
+
+    path = os.path.join(cache_dir, _cache_key(spec))
+    if rebuild or not all(os.path.exists(os.path.join(path, f'{name}.npy')) for name in names):
+        arrays = _build_mnist_concepts(spec, with_images=with_images)
+        # write to a temporary directory first, so that an interrupted run leaves no partial cache
+        tmp_path = path + f'.tmp{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'), np.ascontiguousarray(array))
+        with open(os.path.join(tmp_path, 'spec.json'), 'w') as f:
+            json.dump(spec, f, indent=2)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        print(f'Cached Morpho-MNIST digits {spec["digits"]} in {path}')
+
+    return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names}
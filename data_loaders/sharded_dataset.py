@@ -0,0 +1,156 @@
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, IterableDataset, TensorDataset
+
+SHARD_FORMAT_VERSION = 1
+
+
+def write_shards(out_dir, columns, names, shard_size=10000):
+    """
+    Write equally long `columns` (tensors or arrays, e.g. X, C, y) to `out_dir` as
+    shard_<k>_<name>.npy files of `shard_size` samples each, plus an index.json.
+    """
+    n_samples = len(columns[0])
+    if any(len(column) != n_samples for column in columns):
+        raise ValueError('All columns must have the same number of samples')
+    if len(names) != len(columns):
+        raise ValueError(f'{len(columns)} columns but {len(names)} names')
+
+    tmp_dir = out_dir.rstrip('/') + f'.tmp{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    n_shards = max(1, math.ceil(n_samples / shard_size))
+    for k in range(n_shards):
+        for name, column in zip(names, columns):
+            shard = column[k * shard_size:(k + 1) * shard_size]
+            if isinstance(shard, torch.Tensor):
+                shard = shard.detach().cpu().numpy()
+            np.save(os.path.join(tmp_dir, f'shard_{k}_{name}.npy'), np.ascontiguousarray(shard))
+    index = {'version': SHARD_FORMAT_VERSION, 'n_samples': n_samples, 'shard_size': shard_size,
+             'n_shards': n_shards, 'columns': list(names)}
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+
+
+def export_loaders_to_shards(out_dir, loaders, names=('X', 'C', 'y'), shard_size=10000):
+    """Write the TensorDatasets of e.g. {'train': ..., 'val': ..., 'test': ...} loaders to `out_dir/<split>`."""
+    for split, data_loader in loaders.items():
+        if not isinstance(data_loader.dataset, TensorDataset):
+            raise ValueError(f'Only TensorDatasets can be exported, got {type(data_loader.dataset)}')
+        write_shards(os.path.join(out_dir, split), data_loader.dataset.tensors, names,
+                     shard_size=shard_size)
+
+
+class ShardedConceptDataset(IterableDataset):
+    """
+    Iterable (X, C, y)-style dataset over the memory-mapped shards written by write_shards,
+    for datasets that do not fit in memory.
+
+    Only the shards being iterated are paged in. The shards are split between the
+    DataLoader workers, and with `shuffle` both the shard order and the samples within
+    a shard are permuted (with a new permutation every epoch).
+    Samples can also be read by index (`dataset[i]`), so that Subset views of the
+    dataset (e.g. the leaf / expert subsets of the leakage trainers) are map-style
+    datasets over the same shards.
+    `columns(...)` reads whole columns without touching the others, e.g. C and y
+    without the images.
+    """
+
+    def __init__(self, root, columns=None, shuffle=False, seed=42):
+        self.root = root
+        with open(os.path.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        if self.index['version'] != SHARD_FORMAT_VERSION:
+            raise ValueError(f'Shards in {root} have version {self.index["version"]}, '
+                             f'expected {SHARD_FORMAT_VERSION}')
+        self.column_names = self.index['columns'] if columns is None else list(columns)
+        unknown = [name for name in self.column_names if name not in self.index['columns']]
+        if unknown:
+            raise ValueError(f'Unknown columns {unknown}, the shards hold {self.index["columns"]}')
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._open_shards = {}
+
+    def __len__(self):
+        return self.index['n_samples']
+
+    def _shard(self, k, name):
+        return np.load(os.path.join(self.root, f'shard_{k}_{name}.npy'), mmap_mode='r')
+
+    def __getitem__(self, idx):
+        """Sample `idx`, read from the memory map of its shard."""
+        n_samples = self.index['n_samples']
+        if idx < 0:
+            idx += n_samples
+        if not 0 <= idx < n_samples:
+            raise IndexError(f'Index {idx} out of range for {n_samples} samples')
+        k, i = divmod(int(idx), self.index['shard_size'])
+        if k not in self._open_shards:
+            self._open_shards[k] = [self._shard(k, name) for name in self.column_names]
+        return tuple(torch.from_numpy(np.array(column[i])) for column in self._open_shards[k])
+
+    def __getstate__(self):
+        # do not pickle the memory maps into worker processes
+        state = self.__dict__.copy()
+        state['_open_shards'] = {}
+        return state
+
+    def columns(self, *indices):
+        """
+        Whole columns, by name or by position in the stored columns (index['columns'],
+        e.g. X, C, y, as for dataset_column), whatever columns the samples are projected on.
+        The shards of every column are concatenated in memory, so this is meant for
+        C and y only: reading X this way loads the whole image column into RAM.
+        """
+        stored = self.index['columns']
+        names = [i if isinstance(i, str) else (stored[int(i)] if 0 <= int(i) < len(stored) else None)
+                 for i in indices]
+        if None in names or any(name not in stored for name in names):
+            raise ValueError(f'Unknown columns {list(indices)}, the shards hold {stored}')
+        return tuple(torch.from_numpy(np.concatenate([self._shard(k, name)
+                                                      for k in range(self.index['n_shards'])]))
+                     for name in names)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            self.epoch += 1
+        else:
+            # workers are re-created (with a new base seed) every epoch, and they must
+            # agree on the shard order to split it
+            rng = np.random.default_rng(worker_info.seed - worker_info.id)
+        shards = np.arange(self.index['n_shards'])
+        if self.shuffle:
+            shards = rng.permutation(shards)
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+
+        for k in shards:
+            data = [self._shard(k, name) for name in self.column_names]
+            order = rng.permutation(len(data[0])) if self.shuffle else range(len(data[0]))
+            for i in order:
+                yield tuple(torch.from_numpy(np.array(column[i])) for column in data)
+
+
+def get_sharded_dataLoader(data_dir, type='SGD', config=None, batch_size=None,
+                           columns=None, num_workers=0, shuffle_train=True):
+    """
+    Train / val / test loaders over the shards in `data_dir`/{train,val,test}
+    (see export_loaders_to_shards), in the (X, C, y) layout of the in-memory loaders.
+    """
+    loaders = []
+    for split in ['train', 'val', 'test']:
+        dataset = ShardedConceptDataset(os.path.join(data_dir, split), columns=columns,
+                                        shuffle=shuffle_train and split == 'train')
+        loaders.append(DataLoader(dataset, batch_size=batch_size or len(dataset),
+                                  num_workers=num_workers))
+    return tuple(loaders)
@@ -12,6 +12,9 @@ from tqdm import tqdm
 
 from loggers.cy_logger import CYLogger
 from utils.util import compute_AUC, get_correct
+from utils.epoch_buffer import EpochBuffer
+from utils.risk_coverage import risk_coverage_curve, save_risk_coverage, \
+    threshold_for_coverage, operating_point, load_risk_coverage
 from base.epoch_trainer_base import EpochTrainerBase
 
 
@@ -57,6 +60,11 @@ class CY_Epoch_Trainer(EpochTrainerBase):
         self.metrics_tracker.begin_run()
         print("Device: ", self.device)
 
+        # per-sample outputs of an epoch, preallocated once and reused
+        self.train_buffer = EpochBuffer.from_loader(self.train_loader, dtypes={'C': torch.float})
+        if self.val_loader is not None:
+            self.val_buffer = EpochBuffer.from_loader(self.val_loader, dtypes={'C': torch.float})
+
         self.optimizer = arch.cy_optimizer
         for state in self.optimizer.state.values():
             for k, v in state.items():
@@ -72,19 +80,18 @@ class CY_Epoch_Trainer(EpochTrainerBase):
             self.arch.selector.train()
             self.arch.aux_model.train()
 
-        tensor_C = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
+        buffer = self.train_buffer
+        buffer.reset()
 
         with tqdm(total=len(self.train_loader), file=sys.stdout) as t:
             for batch_idx, (C_batch, y_batch) in enumerate(self.train_loader):
                 batch_size = C_batch.size(0)
                 C_batch = C_batch.to(self.device)
-                tensor_C = torch.cat((tensor_C, C_batch), dim=0)
                 y_batch = y_batch.to(self.device)
 
                 # Forward pass
                 y_pred = self.model.label_predictor(C_batch)
-                tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
+                buffer.append(C=C_batch, y_pred=y_pred)
                 outputs = {"prediction_out": y_pred}
 
                 if self.selective_net:
@@ -114,7 +121,7 @@ class CY_Epoch_Trainer(EpochTrainerBase):
 
                     # Calculate the APL
                     APL, fid, fi, tree = self._calculate_APL(self.min_samples_leaf,
-                                                             tensor_C, tensor_y_pred)
+                                                             buffer.get('C'), buffer.get('y_pred'), mode='train')
                     self.metrics_tracker.update_batch(update_dict_or_key='APL',
                                                       value=APL,
                                                       batch_size=len(self.train_loader.dataset),
@@ -134,7 +141,7 @@ class CY_Epoch_Trainer(EpochTrainerBase):
                 loss.backward()
                 self.optimizer.step()
                 self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                                  value=loss.detach().cpu().item(),
+                                                  value=loss.detach(),
                                                   batch_size=batch_size,
                                                   mode='train')
 
@@ -174,20 +181,19 @@ class CY_Epoch_Trainer(EpochTrainerBase):
             self.arch.selector.eval()
             self.arch.aux_model.eval()
 
-        tensor_C = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
+        buffer = self.val_buffer
+        buffer.reset()
 
         with torch.no_grad():
             with tqdm(total=len(self.val_loader), file=sys.stdout) as t:
                 for batch_idx, (C_batch, y_batch) in enumerate(self.val_loader):
                     batch_size = C_batch.size(0)
                     C_batch = C_batch.to(self.device)
-                    tensor_C = torch.cat((tensor_C, C_batch), dim=0)
                     y_batch = y_batch.to(self.device)
 
                     # Forward pass
                     y_pred = self.model.label_predictor(C_batch)
-                    tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
+                    buffer.append(C=C_batch, y_pred=y_pred)
                     outputs = {"prediction_out": y_pred}
 
                     if self.selective_net:
@@ -237,7 +243,7 @@ class CY_Epoch_Trainer(EpochTrainerBase):
 
                         # Calculate the APL
                         APL, fid, fi, tree = self._calculate_APL(
-                            self.min_samples_leaf, tensor_C, tensor_y_pred)
+                            self.min_samples_leaf, buffer.get('C'), buffer.get('y_pred'), mode='val')
                         self.metrics_tracker.update_batch(update_dict_or_key='APL',
                                                           value=APL,
                                                           batch_size=len(self.val_loader.dataset),
@@ -263,7 +269,7 @@ class CY_Epoch_Trainer(EpochTrainerBase):
 
                     loss = loss_label["target_loss"]
                     self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                                      value=loss.detach().cpu().item(),
+                                                      value=loss.detach(),
                                                       batch_size=batch_size,
                                                       mode='val')
                     t.set_postfix(
@@ -272,14 +278,11 @@ class CY_Epoch_Trainer(EpochTrainerBase):
 
         # Update the epoch metrics
         if self.selective_net:
-            # evaluate g for correctly selected samples (pi >= 0.5)
-            # should be higher
-            self.metrics_tracker.evaluate_correctly(selection_threshold=self.config['selectivenet']['selection_threshold'])
-
-            # evaluate g for correctly rejected samples (pi < 0.5)
-            # should be lower
-            self.metrics_tracker.evaluate_incorrectly(selection_threshold=self.config['selectivenet']['selection_threshold'])
-            self.metrics_tracker.evaluate_coverage_stats(selection_threshold=self.config['selectivenet']['selection_threshold'])
+            # accuracy of the selected (pi >= threshold, should be higher) and of the
+            # rejected (pi < threshold, should be lower) samples, and the coverage
+            self.metrics_tracker.evaluate_selective(
+                selection_threshold=self.config['selectivenet']['selection_threshold'],
+                sweep_thresholds=self.config['selectivenet'].get('sweep_thresholds'))
 
     def _test(self, test_data_loader):
 
@@ -288,8 +291,7 @@ class CY_Epoch_Trainer(EpochTrainerBase):
             self.arch.selector.eval()
             self.arch.aux_model.eval()
 
-        tensor_C_pred = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
+        buffer = EpochBuffer.from_loader(test_data_loader, dtypes={'C_pred': torch.float})
 
         test_metrics = {"loss": 0, "target_loss": 0, "accuracy": 0, "APL": 0, "fidelity": 0,
                         "feature_importance": [], "APL_predictions": [], "total_correct": 0}
@@ -300,12 +302,11 @@ class CY_Epoch_Trainer(EpochTrainerBase):
 
                     batch_size = C_pred.size(0)
                     C_pred = C_pred.to(self.device)
-                    tensor_C_pred = torch.cat((tensor_C_pred, C_pred), dim=0)
                     y_batch = y_batch.to(self.device)
 
                     # Forward pass
                     y_pred = self.model.label_predictor(C_pred)
-                    tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
+                    buffer.append(C_pred=C_pred, y_pred=y_pred)
                     outputs = {"prediction_out": y_pred}
 
                     # Calculate Label losses
@@ -319,7 +320,7 @@ class CY_Epoch_Trainer(EpochTrainerBase):
                     if (batch_idx == len(test_data_loader) - 1):
                         # Calculate the APL
                         APL, fid, fi, tree = self._calculate_APL(
-                            self.min_samples_leaf, tensor_C_pred, tensor_y_pred)
+                            self.min_samples_leaf, buffer.get('C_pred'), buffer.get('y_pred'))
                         test_metrics["APL"] = APL
                         test_metrics["fidelity"] = fid
                         test_metrics["feature_importance"] = fi
@@ -372,251 +373,94 @@ class CY_Epoch_Trainer(EpochTrainerBase):
         self.logger.info(f"Feature Importance: {test_metrics['feature_importance']}")
 
 
-    def _save_selected_results(self, loader, expert, mode, arch, min_samples_leaf_for_gt=None):
-        print(f"\n------------------- Metrics ({mode}) ---------------------")
-        print('Loading the best model and applying selectivenet ...')
-        tensor_X_rej = torch.FloatTensor().to(self.device)
-        tensor_X_acc = torch.FloatTensor().to(self.device)
-        tensor_C_rej = torch.FloatTensor().to(self.device)
-        tensor_C_acc = torch.FloatTensor().to(self.device)
-        tensor_y_acc = torch.LongTensor().to(self.device)
-        tensor_y_pred_acc = torch.FloatTensor().to(self.device)
-        tensor_y_rej = torch.LongTensor().to(self.device)
-        tensor_y_pred_rej = torch.FloatTensor().to(self.device)
-        tensor_out_selector = torch.FloatTensor().to(self.device)
+    def _save_risk_coverage(self, out_selector, y_pred, y, mode, selection_threshold):
+        """
+        Save the risk-coverage curve of the selector on a split next to the checkpoint, with
+        the threshold calibrated for the target coverage, so that the threshold can be
+        retuned later (see utils.risk_coverage.threshold_for_coverage) without retraining.
+        """
+        if len(out_selector) == 0:
+            return None
+        curve = risk_coverage_curve(out_selector, y_pred, y,
+                                    num_classes=self.config['dataset']['num_classes'])
+        target_coverages = np.atleast_1d(self.config['selectivenet'].get('coverage', [])).tolist()
+        path = os.path.join(self.checkpoint_dir, f'risk_coverage_{mode}.json')
+        save_risk_coverage(path, curve, target_coverages, selection_threshold=selection_threshold)
+        # the outputs themselves, to route the split again at a retuned threshold
+        torch.save({'out_selector': out_selector.detach().reshape(-1).cpu(),
+                    'y_pred': y_pred.detach().cpu(), 'y': y.detach().cpu()},
+                   os.path.join(self.checkpoint_dir, f'selector_outputs_{mode}.pt'))
+
+        point = operating_point(curve, selection_threshold)
+        print(f"{mode} coverage {point['coverage']:.4f} and risk {point['risk']:.4f} "
+              f"at selection threshold {selection_threshold} (AURC {curve['aurc']:.4f})")
+        for coverage in target_coverages:
+            calibrated = threshold_for_coverage(curve, coverage)
+            print(f"{mode} threshold for coverage {coverage}: {calibrated['threshold']:.4f} "
+                  f"(coverage {calibrated['coverage']:.4f}, risk {calibrated['risk']:.4f})")
+        return curve
+
+    def retune_selection_threshold(self, target_coverage, mode='valid'):
+        """
+        Set the selection threshold to the one calibrated for `target_coverage` on the
+        risk-coverage curve and selector outputs saved for `mode`, without retraining.
+        Returns the calibrated threshold, with its coverage and risk.
+        """
+        curve = load_risk_coverage(os.path.join(self.checkpoint_dir, f'risk_coverage_{mode}.json'))
+        outputs = torch.load(os.path.join(self.checkpoint_dir, f'selector_outputs_{mode}.pt'))
+        calibrated = threshold_for_coverage(curve, target_coverage)
+        self.config['selectivenet']['selection_threshold'] = calibrated['threshold']
+
+        acc = torch.nonzero(outputs['out_selector'] >= calibrated['threshold']).reshape(-1)
+        print(f"{mode} threshold retuned for coverage {target_coverage}: {calibrated['threshold']:.4f} "
+              f"({len(acc)} of {len(outputs['out_selector'])} samples accepted, "
+              f"risk {calibrated['risk']:.4f})")
+        self.logger.info(f"{mode} threshold retuned for coverage {target_coverage}: "
+                         f"{calibrated['threshold']:.4f} (coverage {calibrated['coverage']:.4f}, "
+                         f"risk {calibrated['risk']:.4f})")
+        return calibrated
+
+    def _select_indices(self, loader, expert, mode, arch, selection_threshold=None):
+        """
+        Positions (in `loader` order) of the samples accepted / rejected by the selector of
+        `arch` on their ground truth concepts. No images are kept: the caller routes the
+        samples through index arrays.
+        """
+        return self._route(loader, expert, mode, selection_threshold,
+                           lambda X_batch, C_batch: (arch.selector(C_batch),
+                                                     arch.model.label_predictor(C_batch)))
+
+    def _select_indices_from_predictions(self, loader, expert_idx, mode, expert,
+                                         selection_threshold=None):
+        """
+        Positions (in `loader` order) of the samples accepted / rejected by the selector of
+        `expert` on the predicted concepts.
+        """
+        def forward(X_batch, C_batch):
+            C_pred = torch.sigmoid(expert.model.concept_predictor(X_batch))
+            return expert.arch.selector(C_pred[:, expert.arch.selected_concepts]), None
+        return self._route(loader, expert_idx, mode, selection_threshold, forward)
+
+    def _route(self, loader, expert, mode, selection_threshold, forward):
+        if selection_threshold is None:
+            selection_threshold = self.config['selectivenet']['selection_threshold']
+        buffer = EpochBuffer.from_loader(loader, dtypes={'y': torch.long})
 
         with torch.no_grad():
-            with tqdm(total=len(loader), file=sys.stdout) as t:
-                for batch_id, (X_batch, C_batch, y_batch) in enumerate(loader):
-                    X_batch = X_batch.to(self.device)
-                    C_batch = C_batch.to(self.device)
-                    y_batch = y_batch.to(self.device)
-
-                    out_selector = arch.selector(C_batch)
-                    tensor_out_selector = torch.cat((tensor_out_selector, out_selector), dim=0)
-
-                    y_pred = arch.model.label_predictor(C_batch)
-                    selection_threshold = self.config['selectivenet']['selection_threshold']
-                    arr_rej_indices = torch.nonzero(out_selector < selection_threshold, as_tuple=True)[0]
-                    arr_sel_indices = torch.nonzero(out_selector >= selection_threshold, as_tuple=True)[0]
-
-                    if arr_rej_indices.size(0) > 0:
-                        g_X = X_batch[arr_rej_indices, :, :, :]
-                        g_concepts = C_batch[arr_rej_indices, :]
-                        g_y = y_batch[arr_rej_indices]
-                        g_ypred = y_pred[arr_rej_indices, :]
-
-                        tensor_X_rej = torch.cat((tensor_X_rej, g_X), dim=0)
-                        tensor_C_rej = torch.cat((tensor_C_rej, g_concepts), dim=0)
-                        tensor_y_rej = torch.cat((tensor_y_rej, g_y), dim=0)
-                        tensor_y_pred_rej = torch.cat((tensor_y_pred_rej, g_ypred), dim=0)
-
-                    if arr_sel_indices.size(0) > 0:
-                        g_X = X_batch[arr_sel_indices, :, :, :]
-                        g_y = y_batch[arr_sel_indices]
-                        g_ypred = y_pred[arr_sel_indices, :]
-                        g_concepts = C_batch[arr_sel_indices, :]
-
-                        tensor_X_acc = torch.cat((tensor_X_acc, g_X), dim=0)
-                        tensor_y_acc = torch.cat((tensor_y_acc, g_y), dim=0)
-                        tensor_C_acc = torch.cat((tensor_C_acc, g_concepts), dim=0)
-                        tensor_y_pred_acc = torch.cat((tensor_y_pred_acc, g_ypred), dim=0)
-
-                    # plot a bar plot with the number of concepts equal to 1 per class
-                    # for i in range(3):
-                    #     print(f'Class {i}')
-                    #     class_digit = tensor_C_acc[tensor_y_acc == i]
-                    #     for j in range(12):
-                    #         print(
-                    #             f'Concept {j}: {torch.sum((class_digit[:, j] == 1).int())}')
-
-
-                    t.set_postfix(
-                        batch_id='{0}'.format(batch_id + 1))
-                    t.update()
-
-        tensor_X_rej = tensor_X_rej.cpu()
-        tensor_X_acc = tensor_X_acc.cpu()
-        tensor_C_rej = tensor_C_rej.cpu()
-        tensor_C_acc = tensor_C_acc.cpu()
-        tensor_y_rej = tensor_y_rej.cpu()
-        tensor_y_pred_rej = tensor_y_pred_rej.cpu()
-        tensor_y_acc = tensor_y_acc.cpu()
-        tensor_y_pred_acc = tensor_y_pred_acc.cpu()
-        tensor_out_selector = tensor_out_selector.cpu()
-
-        # plot a bar plot with the number of concepts equal to 1 per class
-        # for i in range(3):
-        #     print(f'Class {i}')
-        #     class_digit = tensor_C_acc[tensor_y_acc == i]
-        #     for j in range(12):
-        #         print(
-        #             f'Concept {j}: {torch.sum((class_digit[:, j] == 1).int())}')
-
-        # Fit a tree
-        # APL, fid, fi, tree = self._calculate_APL(self.min_samples_leaf,
-        #                                          tensor_C_acc,
-        #                                          tensor_y_pred_acc)
-        #
-        # self._visualize_tree(tree, self.config, None, APL, 'None', 'None',
-        #                      mode=f'selected_{mode}_fid_{fid:.2f}_samples', expert=expert)
-        #
-        # tensor_C_all = torch.cat((tensor_C_acc, tensor_C_rej), dim=0)
-        # tensor_y_pred_all = torch.cat((tensor_y_pred_acc, tensor_y_pred_rej), dim=0)
-        # tensor_y_all = torch.cat((tensor_y_acc, tensor_y_rej), dim=0)
-        # # isolate the indices of all ys = 1
-        # tensor_C_all_8s = tensor_C_all[tensor_y_all == 1].numpy()
-        # tensor_C_all_9s = tensor_C_all[tensor_y_all == 2].numpy()
-        # tensor_C_all_6s = tensor_C_all[tensor_y_all == 0].numpy()
-        #
-        # APL_all, fid_all, fi_all, tree_all = self._calculate_APL(self.min_samples_leaf,
-        #                                          tensor_C_all,
-        #                                          tensor_y_pred_all)
-        #
-        # self._visualize_tree(tree_all, self.config, None, APL_all, 'None', 'None',
-        #                      mode=f'all_{mode}_fid_{fid_all:.2f}_samples', expert=expert)
-        #
-        # APL_all_true, fid_all_true, fi_all_true, tree_all_true = self._calculate_APL_gt(300,
-        #                                                                              tensor_C_all,
-        #                                                                              tensor_y_all)
-        #
-        # self._visualize_tree(tree_all_true, self.config, None, APL_all_true, 'None', 'None',
-        #                      mode=f'all_true_{mode}_fid_{fid_all_true:.2f}_samples', expert=expert)
-        #
-        # # Fit a tree
-        # APL_truth, fid_truth, fi_truth, tree_truth = self._calculate_APL_gt(min_samples_leaf_for_gt,
-        #                                                                     tensor_C_acc,
-        #                                                                     tensor_y_acc)
-        #
-        # self._visualize_tree(tree_truth, self.config, None, APL_truth, 'None', 'None',
-        #                      mode=f'selected_{mode}_fid_{fid_truth:.2f}_truth', expert=expert)
-        #
-        # APL_selector, fid_selector, fi_selector, tree_selector = self._calculate_APL(1,
-        #                                                          tensor_C_all,
-        #                                                          tensor_out_selector)
-        #
-        # # export tree
-        # plt.figure(figsize=(20, 20))
-        # dot_data = export_graphviz(
-        #     decision_tree=tree_selector,
-        #     out_file=None,
-        #     filled=True,
-        #     rounded=True,
-        #     special_characters=True,
-        #     feature_names=self.config['dataset']['concept_names'],
-        #     class_names=["rejected", "accepted"],
-        # )
-        # name = f'selected_{mode}_fid_{fid_selector:.2f}_selector_expert_{expert}_nodes_{APL_selector}'
-        #
-        # # Render the graph
-        # fig_path = str(self.config.log_dir) + '/trees'
-        # graph = graphviz.Source(dot_data, directory=fig_path)
-        # graph.render(name, format="png", cleanup=True)
-
-
-        # print(f"APL: {APL}")
-        # print(f"Fidelity: {fid}")
-        # print(f"Feature Importance: {fi}")
-
-        # print("Output sizes: ")
-        # print(f"tensor_X_acc size: {tensor_X_acc.size()}")
-        # print(f"tensor_X_rej size: {tensor_X_rej.size()}")
-        # print(f"tensor_C_rej size: {tensor_C_rej.size()}")
-        # print(f"tensor_y_rej size: {tensor_y_rej.size()}")
-        # print(f"tensor_y_pred_rej size: {tensor_y_pred_rej.size()}")
-        # print(f"tensor_y_acc size: {tensor_y_acc.size()}")
-        # print(f"tensor_y_pred_acc size: {tensor_y_pred_acc.size()}")
-
+            for X_batch, C_batch, y_batch in loader:
+                out_selector, y_pred = forward(X_batch.to(self.device), C_batch.to(self.device))
+                fields = {'y': y_batch.to(self.device), 'out_selector': out_selector}
+                if y_pred is not None:
+                    fields['y_pred'] = y_pred
+                buffer.append(partitions={'rej': out_selector < selection_threshold,
+                                          'acc': out_selector >= selection_threshold}, **fields)
+
+        if buffer.size > 0 and y_pred is not None:
+            self._save_risk_coverage(buffer.get('out_selector'), buffer.get('y_pred'), buffer.get('y'),
+                                     mode, selection_threshold)
+        acc = buffer.indices('acc').cpu().numpy()
+        rej = buffer.indices('rej').cpu().numpy()
         print(f"Expert: {expert}")
-        print(f"Number of accepted {mode} samples: {tensor_X_acc.size(0)}")
-        print(f"Number of rejected {mode} samples: {tensor_X_rej.size(0)}")
-        # #proba = torch.nn.Softmax(dim=1)(tensor_y_pred_rej)[:, 1]
-        # acc_rej = accuracy_score(tensor_y_rej.cpu().numpy(),
-        #                         tensor_y_pred_rej.cpu().argmax(dim=1).numpy())
-        # print(f"{mode} accuracy of the rejected samples: {acc_rej * 100} (%)")
-        #
-        # #proba = torch.nn.Softmax(dim=1)(tensor_y_pred_acc)[:, 1]
-        # acc_acc = accuracy_score(tensor_y_acc.cpu().numpy(),
-        #                         tensor_y_pred_acc.cpu().argmax(dim=1).numpy())
-        # print(f"{mode} Accuracy of the accepted samples: {acc_acc * 100} (%)")
-
-        # output_path = os.path.join(self.config.save_dir, "intermediate_tensors")
-        # if not os.path.exists(output_path):
-        #     os.makedirs(output_path)
-
-        # torch.save(tensor_X_rej, os.path.join(output_path, f"expert_{expert}_{mode}_tensor_X_rej.pt"))
-        # torch.save(tensor_C_rej, os.path.join(output_path, f"expert_{expert}_{mode}_tensor_C_rej.pt"))
-        # torch.save(tensor_y_rej, os.path.join(output_path, f"expert_{expert}_{mode}_tensor_y.pt"))
-
-        # return (tensor_X_rej, tensor_C_rej, tensor_y_rej, fi)
-
-
-        # return (tensor_X_acc, tensor_C_acc, tensor_y_acc, fi_truth, tree_truth,
-        #         tensor_X_rej, tensor_C_rej, tensor_y_rej)
-        return (tensor_X_acc, tensor_C_acc, tensor_y_acc, None, None,
-                tensor_X_rej, tensor_C_rej, tensor_y_rej)
-
-    def _get_predictions_from_selector(self, loader, expert_idx, mode, expert):
-        print(f'\nGet test samples selected by expert {expert_idx} ...')
-        tensor_X_rej = torch.FloatTensor().to(self.device)
-        tensor_X_acc = torch.FloatTensor().to(self.device)
-        tensor_C_rej = torch.FloatTensor().to(self.device)
-        tensor_C_acc = torch.FloatTensor().to(self.device)
-        tensor_y_acc = torch.LongTensor().to(self.device)
-        tensor_y_rej = torch.LongTensor().to(self.device)
-        tensor_out_selector = torch.FloatTensor().to(self.device)
-
-        with torch.no_grad():
-            with tqdm(total=len(loader), file=sys.stdout) as t:
-                for batch_id, (X_batch, C_batch, y_batch) in enumerate(loader):
-                    X_batch = X_batch.to(self.device)
-                    C_batch = C_batch.to(self.device)
-                    y_batch = y_batch.to(self.device)
-
-                    # Forward pass
-                    C_pred = expert.model.concept_predictor(X_batch)
-                    C_pred = torch.sigmoid(C_pred)
-                    C_pred = C_pred[:, expert.arch.selected_concepts]
-
-                    out_selector = expert.arch.selector(C_pred)
-                    tensor_out_selector = torch.cat((tensor_out_selector, out_selector), dim=0)
-
-                    selection_threshold = self.config['selectivenet']['selection_threshold']
-                    arr_rej_indices = torch.nonzero(out_selector < selection_threshold, as_tuple=True)[0]
-                    arr_sel_indices = torch.nonzero(out_selector >= selection_threshold, as_tuple=True)[0]
-
-                    if arr_rej_indices.size(0) > 0:
-                        g_X = X_batch[arr_rej_indices, :, :, :]
-                        g_concepts = C_batch[arr_rej_indices, :]
-                        g_y = y_batch[arr_rej_indices]
-
-                        tensor_X_rej = torch.cat((tensor_X_rej, g_X), dim=0)
-                        tensor_C_rej = torch.cat((tensor_C_rej, g_concepts), dim=0)
-                        tensor_y_rej = torch.cat((tensor_y_rej, g_y), dim=0)
-
-                    if arr_sel_indices.size(0) > 0:
-                        g_X = X_batch[arr_sel_indices, :, :, :]
-                        g_y = y_batch[arr_sel_indices]
-                        g_concepts = C_batch[arr_sel_indices, :]
-
-                        tensor_X_acc = torch.cat((tensor_X_acc, g_X), dim=0)
-                        tensor_y_acc = torch.cat((tensor_y_acc, g_y), dim=0)
-                        tensor_C_acc = torch.cat((tensor_C_acc, g_concepts), dim=0)
-
-                    t.set_postfix(
-                        batch_id='{0}'.format(batch_id + 1))
-                    t.update()
-
-        tensor_X_rej = tensor_X_rej.cpu()
-        tensor_X_acc = tensor_X_acc.cpu()
-        tensor_C_rej = tensor_C_rej.cpu()
-        tensor_C_acc = tensor_C_acc.cpu()
-        tensor_y_rej = tensor_y_rej.cpu()
-        tensor_y_acc = tensor_y_acc.cpu()
-
-        print(f"Expert: {expert_idx}")
-        print(f"Number of accepted {mode} samples: {tensor_X_acc.size(0)}")
-        print(f"Number of rejected {mode} samples: {tensor_X_rej.size(0)}")
-
-        return (tensor_X_acc, tensor_C_acc, tensor_y_acc, None, None,
-                tensor_X_rej, tensor_C_rej, tensor_y_rej)
+        print(f"Number of accepted {mode} samples: {len(acc)}")
+        print(f"Number of rejected {mode} samples: {len(rej)}")
+        return acc, rej
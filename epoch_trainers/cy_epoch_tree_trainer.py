@@ -118,7 +118,7 @@ class CY_Epoch_Tree_Trainer(EpochTrainerBase):
             loss.backward()
             self.optimizer.step()
             self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                              value=loss.detach().item(),
+                                              value=loss.detach(),
                                               batch_size=batch_size,
                                               mode='train')
 
@@ -168,17 +168,17 @@ class CY_Epoch_Tree_Trainer(EpochTrainerBase):
                 if self.selective_net:
                     self.metrics_tracker.update_batch(
                         update_dict_or_key='out_put_sel_proba',
-                        value=out_selector.detach().cpu(),
+                        value=out_selector.detach(),
                         batch_size=batch_size,
                         mode='val')
                     self.metrics_tracker.update_batch(
                         update_dict_or_key='out_put_class',
-                        value=y_pred.detach().cpu(),
+                        value=y_pred.detach(),
                         batch_size=batch_size,
                         mode='val')
                     self.metrics_tracker.update_batch(
                         update_dict_or_key='out_put_target',
-                        value=y_batch.detach().cpu(),
+                        value=y_batch.detach(),
                         batch_size=batch_size,
                         mode='val')
 
@@ -227,23 +227,14 @@ class CY_Epoch_Tree_Trainer(EpochTrainerBase):
 
                 loss = loss_label["target_loss"]
                 self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                                  value=loss.detach().item(),
+                                                  value=loss.detach(),
                                                   batch_size=batch_size,
                                                   mode='val')
 
         # Update the epoch metrics
         if self.selective_net:
-            # evaluate g for correctly selected samples (pi >= 0.5)
-            # should be higher
-            self.metrics_tracker.evaluate_correctly(
-                selection_threshold=self.config['selectivenet'][
-                    'selection_threshold'])
-
-            # evaluate g for correctly rejected samples (pi < 0.5)
-            # should be lower
-            self.metrics_tracker.evaluate_incorrectly(
-                selection_threshold=self.config['selectivenet'][
-                    'selection_threshold'])
-            self.metrics_tracker.evaluate_coverage_stats(
-                selection_threshold=self.config['selectivenet'][
-                    'selection_threshold'])
+            # accuracy of the selected (pi >= threshold, should be higher) and of the
+            # rejected (pi < threshold, should be lower) samples, and the coverage
+            self.metrics_tracker.evaluate_selective(
+                selection_threshold=self.config['selectivenet']['selection_threshold'],
+                sweep_thresholds=self.config['selectivenet'].get('sweep_thresholds'))
@@ -12,6 +12,7 @@ from loggers.xc_logger import XCLogger
 
 from base.epoch_trainer_base import EpochTrainerBase
 from utils import column_get_correct
+from utils.epoch_buffer import EpochBuffer
 
 
 class XC_Epoch_Trainer(EpochTrainerBase):
@@ -171,10 +172,7 @@ class XC_Epoch_Trainer(EpochTrainerBase):
     def _test(self, test_data_loader, hard_cbm=False):
 
         self.model.concept_predictor.eval()
-        #tensor_X = torch.FloatTensor().to(self.device)
-        tensor_C_pred = torch.FloatTensor().to(self.device)
-        tensor_C = torch.FloatTensor().to(self.device)
-        tensor_y = torch.LongTensor().to(self.device)
+        buffer = EpochBuffer.from_loader(test_data_loader, dtypes={'C': torch.float, 'y': torch.long})
 
         test_metrics = {"concept_loss": 0, "loss_per_concept": np.zeros(self.num_concepts), "total_correct": 0,
                         "accuracy_per_concept": np.zeros(self.num_concepts)}
@@ -202,10 +200,7 @@ class XC_Epoch_Trainer(EpochTrainerBase):
                     test_metrics["accuracy_per_concept"] += np.array([x for x in correct_per_column])
 
                     C_pred = torch.sigmoid(C_pred)
-                    #tensor_X = torch.cat((tensor_X, X_batch), dim=0)
-                    tensor_C_pred = torch.cat((tensor_C_pred, C_pred), dim=0)
-                    tensor_y = torch.cat((tensor_y, y_batch), dim=0)
-                    tensor_C = torch.cat((tensor_C, C_batch), dim=0)
+                    buffer.append(C_pred=C_pred, y=y_batch, C=C_batch)
 
                     # Calculate Concept losses
                     loss_concept_total = self.criterion(C_pred, C_batch)
@@ -278,6 +273,7 @@ class XC_Epoch_Trainer(EpochTrainerBase):
 
         # if we use a hard-cbm, convert the predictions to binary
         #tensor_C_pred = torch.sigmoid(tensor_C_pred)
+        tensor_C_pred, tensor_C, tensor_y = buffer.get('C_pred'), buffer.get('C'), buffer.get('y')
 
         tensor_C_pred_binarised = tensor_C_pred.clone()
         tensor_C_pred_binarised[tensor_C_pred_binarised >= 0.5] = 1
@@ -340,8 +336,7 @@ class XC_Epoch_Trainer(EpochTrainerBase):
         self.model.concept_predictor.eval()
 
         if use_data_loader:
-            tensor_C_pred = torch.FloatTensor().to(self.device)
-            tensor_y = torch.LongTensor().to(self.device)
+            buffer = EpochBuffer.from_loader(data_loader, dtypes={'y': torch.long})
 
             with torch.no_grad():
                 with tqdm(total=len(data_loader), file=sys.stdout) as t:
@@ -353,16 +348,15 @@ class XC_Epoch_Trainer(EpochTrainerBase):
                         # Forward pass
                         C_pred = self.model.concept_predictor(X_batch)
                         C_pred = C_pred[:, self.arch.selected_concepts]
-                        tensor_C_pred = torch.cat((tensor_C_pred, C_pred), dim=0)
-                        tensor_y = torch.cat((tensor_y, y_batch), dim=0)
+                        buffer.append(C_pred=C_pred, y=y_batch)
 
                         t.set_postfix(
                             batch_id='{0}'.format(batch_idx + 1))
                         t.update()
 
             # if we use a hard-cbm, convert the predictions to binary
-            tensor_C_pred = torch.sigmoid(tensor_C_pred)
-            return tensor_C_pred, tensor_y
+            tensor_C_pred = torch.sigmoid(buffer.get('C_pred'))
+            return tensor_C_pred, buffer.get('y')
         else:
             X = X.to(self.device)
             with torch.no_grad():
@@ -11,6 +11,7 @@ from loggers.joint_cbm_logger import JointCBMLogger
 
 from base.epoch_trainer_base import EpochTrainerBase
 from utils import compute_AUC, column_get_correct, get_correct
+from utils.epoch_buffer import EpochBuffer
 from utils.tree_utils import prune_tree
 
 
@@ -65,6 +66,11 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                                               device=self.device)
         self.metrics_tracker.begin_run()
 
+        # per-sample outputs of an epoch, preallocated once and reused
+        self.train_buffer = EpochBuffer.from_loader(self.train_loader)
+        if self.val_loader is not None:
+            self.val_buffer = EpochBuffer.from_loader(self.val_loader)
+
         self.optimizer = arch.optimizer
         for state in self.optimizer.state.values():
             for k, v in state.items():
@@ -83,8 +89,8 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
             self.arch.selector.train()
             self.arch.aux_model.train()
 
-        tensor_C_pred= torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
+        buffer = self.train_buffer
+        buffer.reset()
 
         with tqdm(total=len(self.train_loader), file=sys.stdout) as t:
             for batch_idx, (X_batch, C_batch, y_batch) in enumerate(self.train_loader):
@@ -110,9 +116,8 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                 C_pred_soft = torch.sigmoid(C_pred_soft)
                 C_pred_concat = torch.cat((C_hard, C_pred_soft), dim=1)
                 C_pred = C_pred_concat[:, self.sorted_concept_indices]
-                tensor_C_pred = torch.cat((tensor_C_pred, C_pred), dim=0)
                 y_pred = self.model.label_predictor(C_pred)
-                tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
+                buffer.append(C_pred=C_pred, y_pred=y_pred)
                 outputs = {"prediction_out": y_pred}
 
                 if self.selective_net:
@@ -125,11 +130,11 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                 bce_loss_per_concept = self.criterion_per_concept(C_pred, C_batch)
                 bce_loss_per_concept = torch.mean(bce_loss_per_concept, dim=0)
                 self.metrics_tracker.update_batch(update_dict_or_key='concept_loss',
-                                                  value=loss_concept_total.detach().cpu().item(),
+                                                  value=loss_concept_total.detach(),
                                                   batch_size=batch_size,
                                                   mode='train')
                 self.metrics_tracker.update_batch(update_dict_or_key='loss_per_concept',
-                                                  value=list(bce_loss_per_concept.detach().cpu().numpy()),
+                                                  value=bce_loss_per_concept.detach(),
                                                   batch_size=batch_size,
                                                   mode='train')
 
@@ -152,7 +157,7 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                 if (batch_idx == len(self.train_loader) - 1):
                     # Calculate the APL
                     APL, fid, fi, tree = self._calculate_APL(self.min_samples_leaf,
-                                                             tensor_C_pred, tensor_y_pred)
+                                                             buffer.get('C_pred'), buffer.get('y_pred'), mode='train')
                     self.metrics_tracker.update_batch(update_dict_or_key='APL',
                                                       value=APL,
                                                       batch_size=len(self.train_loader.dataset),
@@ -173,7 +178,7 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                 loss.backward()
                 self.optimizer.step()
                 self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                                  value=loss.detach().cpu().item(),
+                                                  value=loss.detach(),
                                                   batch_size=batch_size,
                                                   mode='train')
 
@@ -215,8 +220,8 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
             self.arch.selector.eval()
             self.arch.aux_model.eval()
 
-        tensor_C_pred = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
+        buffer = self.val_buffer
+        buffer.reset()
 
         with torch.no_grad():
             with tqdm(total=len(self.val_loader), file=sys.stdout) as t:
@@ -243,9 +248,8 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                     C_pred_soft = torch.sigmoid(C_pred_soft)
                     C_pred_concat = torch.cat((C_hard, C_pred_soft), dim=1)
                     C_pred = C_pred_concat[:, self.sorted_concept_indices]
-                    tensor_C_pred = torch.cat((tensor_C_pred, C_pred), dim=0)
                     y_pred = self.model.label_predictor(C_pred)
-                    tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
+                    buffer.append(C_pred=C_pred, y_pred=y_pred)
                     outputs = {"prediction_out": y_pred}
 
                     if self.selective_net:
@@ -259,17 +263,17 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                     if self.selective_net:
                         self.metrics_tracker.update_batch(
                             update_dict_or_key='out_put_sel_proba',
-                            value=out_selector.detach().cpu(),
+                            value=out_selector.detach(),
                             batch_size=batch_size,
                             mode='val')
                         self.metrics_tracker.update_batch(
                             update_dict_or_key='out_put_class',
-                            value=y_pred.detach().cpu(),
+                            value=y_pred.detach(),
                             batch_size=batch_size,
                             mode='val')
                         self.metrics_tracker.update_batch(
                             update_dict_or_key='out_put_target',
-                            value=y_batch.detach().cpu(),
+                            value=y_batch.detach(),
                             batch_size=batch_size,
                             mode='val')
 
@@ -279,12 +283,12 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                     bce_loss_per_concept = torch.mean(bce_loss_per_concept, dim=0)
                     self.metrics_tracker.update_batch(
                         update_dict_or_key='concept_loss',
-                        value=loss_concept_total.detach().cpu().item(),
+                        value=loss_concept_total.detach(),
                         batch_size=batch_size,
                         mode='val')
                     self.metrics_tracker.update_batch(
                         update_dict_or_key='loss_per_concept',
-                        value=list(bce_loss_per_concept.detach().cpu().numpy()),
+                        value=bce_loss_per_concept.detach(),
                         batch_size=batch_size,
                         mode='val')
 
@@ -307,7 +311,7 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                     if (batch_idx == len(self.val_loader) - 1):
                         # Calculate the APL
                         APL, fid, fi, tree = self._calculate_APL(
-                            self.min_samples_leaf, tensor_C_pred, tensor_y_pred)
+                            self.min_samples_leaf, buffer.get('C_pred'), buffer.get('y_pred'), mode='val')
                         self.metrics_tracker.update_batch(update_dict_or_key='APL',
                                                           value=APL,
                                                           batch_size=len(self.val_loader.dataset),
@@ -338,7 +342,7 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
 
                     loss = self.alpha * loss_concept_total + loss_label["target_loss"]
                     self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                                      value=loss.detach().cpu().item(),
+                                                      value=loss.detach(),
                                                       batch_size=batch_size,
                                                       mode='val')
 
@@ -348,14 +352,11 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
 
         # Update the epoch metrics
         if self.selective_net:
-            # evaluate g for correctly selected samples (pi >= 0.5)
-            # should be higher
-            self.metrics_tracker.evaluate_correctly(selection_threshold=self.config['selectivenet']['selection_threshold'])
-
-            # evaluate g for correctly rejected samples (pi < 0.5)
-            # should be lower
-            self.metrics_tracker.evaluate_incorrectly(selection_threshold=self.config['selectivenet']['selection_threshold'])
-            self.metrics_tracker.evaluate_coverage_stats(selection_threshold=self.config['selectivenet']['selection_threshold'])
+            # accuracy of the selected (pi >= threshold, should be higher) and of the
+            # rejected (pi < threshold, should be lower) samples, and the coverage
+            self.metrics_tracker.evaluate_selective(
+                selection_threshold=self.config['selectivenet']['selection_threshold'],
+                sweep_thresholds=self.config['selectivenet'].get('sweep_thresholds'))
 
     def _test(self, test_data_loader):
 
@@ -365,8 +366,7 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
             self.arch.selector.eval()
             self.arch.aux_model.eval()
 
-        tensor_C_pred = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
+        buffer = EpochBuffer.from_loader(test_data_loader)
 
         test_metrics = {"concept_loss": 0, "loss_per_concept": np.zeros(self.num_concepts), "total_correct": 0,
                         "accuracy_per_concept": np.zeros(self.num_concepts),
@@ -394,9 +394,8 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                     test_metrics["accuracy_per_concept"] += np.array([x for x in correct_per_column])
 
                     C_pred = torch.sigmoid(C_pred)
-                    tensor_C_pred = torch.cat((tensor_C_pred, C_pred), dim=0)
                     y_pred = self.model.label_predictor(C_pred)
-                    tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
+                    buffer.append(C_pred=C_pred, y_pred=y_pred)
                     outputs = {"prediction_out": y_pred}
 
                     # Calculate Concept losses
@@ -416,7 +415,7 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                     if (batch_idx == len(test_data_loader) - 1):
                         # Calculate the APL
                         APL, fid, fi, tree = self._calculate_APL(
-                            self.min_samples_leaf, tensor_C_pred, tensor_y_pred)
+                            self.min_samples_leaf, buffer.get('C_pred'), buffer.get('y_pred'))
                         test_metrics["APL"] = APL
                         test_metrics["fidelity"] = fid
                         test_metrics["feature_importance"] = fi
@@ -482,16 +481,7 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
 
 
     def _save_selected_results(self, loader, expert, mode):
-        tensor_X_rej = torch.FloatTensor().to(self.device)
-        tensor_X_acc = torch.FloatTensor().to(self.device)
-        tensor_C_rej = torch.FloatTensor().to(self.device)
-        tensor_C_pred_rej = torch.FloatTensor().to(self.device)
-        tensor_C_acc = torch.FloatTensor().to(self.device)
-        tensor_C_pred_acc = torch.FloatTensor().to(self.device)
-        tensor_y_acc = torch.LongTensor().to(self.device)
-        tensor_y_pred_acc = torch.FloatTensor().to(self.device)
-        tensor_y_rej = torch.LongTensor().to(self.device)
-        tensor_y_pred_rej = torch.FloatTensor().to(self.device)
+        buffer = EpochBuffer.from_loader(loader, dtypes={'C': torch.float, 'y': torch.long})
 
         with torch.no_grad():
             with tqdm(total=len(loader), file=sys.stdout) as t:
@@ -504,34 +494,10 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                     out_selector = self.arch.selector(C_pred)
                     y_pred = self.model.label_predictor(C_pred)
                     selection_threshold = self.config['selectivenet']['selection_threshold']
-                    arr_rej_indices = torch.nonzero(out_selector < selection_threshold, as_tuple=True)[0]
-                    arr_sel_indices = torch.nonzero(out_selector >= selection_threshold, as_tuple=True)[0]
-
-                    if arr_rej_indices.size(0) > 0:
-                        g_X = X_batch[arr_rej_indices, :, :, :]
-                        g_concepts = C_batch[arr_rej_indices, :]
-                        g_y = y_batch[arr_rej_indices]
-                        g_ypred = y_pred[arr_rej_indices, :]
-                        g_pred_concepts = C_pred[arr_rej_indices, :]
-
-                        tensor_X_rej = torch.cat((tensor_X_rej, g_X.cpu()), dim=0)
-                        tensor_C_rej = torch.cat((tensor_C_rej, g_concepts), dim=0)
-                        tensor_y_rej = torch.cat((tensor_y_rej, g_y), dim=0)
-                        tensor_y_pred_rej = torch.cat((tensor_y_pred_rej, g_ypred), dim=0)
-                        tensor_C_pred_rej = torch.cat((tensor_C_pred_rej, g_pred_concepts), dim=0)
-
-                    if arr_sel_indices.size(0) > 0:
-                        g_X = X_batch[arr_sel_indices, :, :, :]
-                        g_y = y_batch[arr_sel_indices]
-                        g_ypred = y_pred[arr_sel_indices, :]
-                        g_concepts = C_batch[arr_sel_indices, :]
-                        g_pred_concepts = C_pred[arr_sel_indices, :]
-
-                        tensor_X_acc = torch.cat((tensor_X_acc, g_X.cpu()), dim=0)
-                        tensor_y_acc = torch.cat((tensor_y_acc, g_y), dim=0)
-                        tensor_C_acc = torch.cat((tensor_C_acc, g_concepts), dim=0)
-                        tensor_y_pred_acc = torch.cat((tensor_y_pred_acc, g_ypred), dim=0)
-                        tensor_C_pred_acc = torch.cat((tensor_C_pred_acc, g_pred_concepts), dim=0)
+                    # the images are kept on the cpu
+                    buffer.append(partitions={'rej': out_selector < selection_threshold,
+                                              'acc': out_selector >= selection_threshold},
+                                  X=X_batch.cpu(), C=C_batch, y=y_batch, y_pred=y_pred, C_pred=C_pred)
 
                     # plot a bar plot with the number of concepts equal to 1 per class
                     # for i in range(3):
@@ -546,16 +512,16 @@ class XCY_Epoch_Trainer(EpochTrainerBase):
                         batch_id='{0}'.format(batch_id + 1))
                     t.update()
 
-        tensor_X_rej = tensor_X_rej.cpu()
-        tensor_X_acc = tensor_X_acc.cpu()
-        tensor_C_rej = tensor_C_rej.cpu()
-        tensor_C_acc = tensor_C_acc.cpu()
-        tensor_y_rej = tensor_y_rej.cpu()
-        tensor_y_pred_rej = tensor_y_pred_rej.cpu()
-        tensor_y_acc = tensor_y_acc.cpu()
-        tensor_y_pred_acc = tensor_y_pred_acc.cpu()
-        tensor_C_pred_acc = tensor_C_pred_acc.cpu()
-        tensor_C_pred_rej = tensor_C_pred_rej.cpu()
+        tensor_X_rej = buffer.get('X', 'rej')
+        tensor_X_acc = buffer.get('X', 'acc')
+        tensor_C_rej = buffer.get('C', 'rej').cpu()
+        tensor_C_acc = buffer.get('C', 'acc').cpu()
+        tensor_y_rej = buffer.get('y', 'rej').cpu()
+        tensor_y_pred_rej = buffer.get('y_pred', 'rej').cpu()
+        tensor_y_acc = buffer.get('y', 'acc').cpu()
+        tensor_y_pred_acc = buffer.get('y_pred', 'acc').cpu()
+        tensor_C_pred_acc = buffer.get('C_pred', 'acc').cpu()
+        tensor_C_pred_rej = buffer.get('C_pred', 'rej').cpu()
 
         # plot a bar plot with the number of concepts equal to 1 per class
         # for i in range(3):
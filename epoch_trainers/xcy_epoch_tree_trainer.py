@@ -4,12 +4,13 @@ import sys
 
 import numpy as np
 import torch
-from torch.utils.data import TensorDataset, DataLoader
 from tqdm import tqdm
 
 from base.epoch_trainer_base import EpochTrainerBase
 from loggers.joint_cbm_logger import JointCBMLogger
 from utils import compute_AUC, column_get_correct, get_correct
+from utils.epoch_buffer import EpochBuffer
+from utils.replay_buffer import SurrogateReplayBuffer
 
 class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
     """
@@ -56,8 +57,10 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
         # all intermediate APL values and the corresponding predictions
         if self.tree_reg_mode == 'Sequential':
             self.sr_training_freq = config['regularisation']['sequential']['sr_training_freq']
-            self.APLs_truth = []
-            self.all_preds = []
+            # bounded (prediction vector, APL) training set of the surrogate
+            self.sr_replay = SurrogateReplayBuffer(
+                capacity=config['regularisation']['sequential'].get('sr_buffer_size', 500),
+                eviction=config['regularisation']['sequential'].get('sr_buffer_eviction', 'reservoir'))
 
         # Initialize the metrics tracker
         self.metrics_tracker = JointCBMLogger(config, iteration=1,
@@ -70,6 +73,15 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
         self.metrics_tracker.begin_run()
         print("Device: ", self.device)
 
+        # with regularisation.async_apl the surrogate trees are fitted in the background
+        # (see _on_APL_result): the surrogate loss uses the latest collected APL
+        self.latest_APL = None
+
+        # per-sample outputs of an epoch, preallocated once and reused
+        self.train_buffer = EpochBuffer.from_loader(self.train_loader)
+        if self.do_validation:
+            self.val_buffer = EpochBuffer.from_loader(self.val_loader)
+
         # if we load a pre-trained model, we need to load the
         # optimizer state to device
         self.optimizer = arch.optimizer
@@ -84,13 +96,14 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
         self.metrics_tracker.begin_epoch()
         self.model.train()
 
-        tensor_C_pred = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
-        tensor_y = torch.FloatTensor().to(self.device)
-        tensor_y_pred_sr = torch.FloatTensor().to(self.device)
+        buffer = self.train_buffer
+        buffer.reset()
 
+        # surrogate inputs of every batch, paired with the epoch's APL once it is collected
+        sr_preds = []
         with tqdm(total=len(self.train_loader), file=sys.stdout) as t:
             for batch_idx, (X_batch, C_batch, y_batch) in enumerate(self.train_loader):
+                self._collect_APL()
 
                 C_hard = C_batch[:, self.hard_concepts]
 
@@ -99,7 +112,6 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                 C_batch = C_batch.to(self.device)
                 C_hard = C_hard.to(self.device)
                 y_batch = y_batch.to(self.device)
-                tensor_y = torch.cat((tensor_y, y_batch), dim=0)
 
                 # Forward pass
                 C_pred_soft = self.model.mn_model.concept_predictor(X_batch)
@@ -110,9 +122,7 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                 C_pred_soft = torch.sigmoid(C_pred_soft)
                 C_pred_concat = torch.cat((C_hard, C_pred_soft), dim=1)
                 C_pred = C_pred_concat[:, self.sorted_concept_indices]
-                tensor_C_pred = torch.cat((tensor_C_pred, C_pred), dim=0)
                 y_pred = self.model.mn_model.label_predictor(C_pred)
-                tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
                 outputs = {"prediction_out": y_pred}
 
                 # Calculate Concept losses
@@ -120,11 +130,11 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                 bce_loss_per_concept = self.criterion_per_concept(C_pred, C_batch)
                 bce_loss_per_concept = torch.mean(bce_loss_per_concept, dim=0)
                 self.metrics_tracker.update_batch(update_dict_or_key='concept_loss',
-                                                  value=loss_concept_total.detach().item(),
+                                                  value=loss_concept_total.detach(),
                                                   batch_size=batch_size,
                                                   mode='train')
                 self.metrics_tracker.update_batch(update_dict_or_key='loss_per_concept',
-                                                  value=list(bce_loss_per_concept.detach().numpy()),
+                                                  value=bce_loss_per_concept.detach(),
                                                   batch_size=batch_size,
                                                   mode='train')
 
@@ -133,7 +143,9 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                     y_hat_sr = y_pred.flatten().detach()
                 else:
                     y_hat_sr = y_pred.flatten()
-                tensor_y_pred_sr = torch.cat((tensor_y_pred_sr, y_hat_sr), dim=0)
+                buffer.append(C_pred=C_pred, y_pred=y_pred, y=y_batch, y_pred_sr=y_hat_sr)
+                if self.apl_pipeline is not None:
+                    sr_preds.append(y_hat_sr.detach())
 
                 # Calculate Label losses
                 loss_label = self.criterion_label(outputs, y_batch)
@@ -151,9 +163,13 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                 )
 
                 # In the final batch, calculate the APL
-                if (batch_idx == len(self.train_loader) - 1):
+                if (batch_idx == len(self.train_loader) - 1) and self.apl_pipeline is not None:
+                    self._submit_APL(self.min_samples_leaf, buffer.get('C_pred'), buffer.get('y_pred'), 'train',
+                                     epoch=epoch, epoch_id=self.metrics_tracker.epoch_id,
+                                     y_hat_sr=sr_preds)
+                elif (batch_idx == len(self.train_loader) - 1):
                     APL, fid, fi, tree = self._calculate_APL(self.min_samples_leaf,
-                                                             tensor_C_pred, tensor_y_pred)
+                                                             buffer.get('C_pred'), buffer.get('y_pred'), mode='train')
                     self.metrics_tracker.update_batch(update_dict_or_key='APL',
                                                       value=APL,
                                                       batch_size=len(self.train_loader.dataset),
@@ -172,15 +188,19 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                 # only for usefull APL predictions
                 omega = self.model.sr_model(y_hat_sr)
                 self.metrics_tracker.update_batch(update_dict_or_key='APL_predictions',
-                                                  value=omega.item(),
+                                                  value=omega.detach(),
                                                   batch_size=batch_size,
                                                   mode='train')
-                if (APL > 1 or epoch == 0) and self.tree_reg_mode == 'Sequential':
-                    self.APLs_truth.append(APL)
-                    self.all_preds.append(y_hat_sr)
+                if self.apl_pipeline is not None:
+                    # the surrogate training set is extended in _on_APL_result
+                    APL = self.latest_APL
+                elif (APL > 1 or epoch == 0) and self.tree_reg_mode == 'Sequential':
+                    self.sr_replay.add(y_hat_sr, APL)
 
-                # Calculate the surrogate loss
-                sr_loss = self.criterion_sr(input=omega, target=torch.tensor([APL], dtype=torch.float))
+                # Calculate the surrogate loss (none until the first asynchronous APL is collected)
+                sr_loss = None
+                if APL is not None:
+                    sr_loss = self.criterion_sr(input=omega, target=torch.tensor([APL], dtype=torch.float))
 
                 # Optimise either the two losses separately in warm-up mode or the total loss
                 if epoch <= self.epochs_warm_up:
@@ -189,11 +209,12 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                     loss.backward()
                     self.optimizer_mn.step()
 
-                    self.optimizer_sr.zero_grad()
-                    sr_loss.backward()
-                    self.optimizer_sr.step()
+                    if sr_loss is not None:
+                        self.optimizer_sr.zero_grad()
+                        sr_loss.backward()
+                        self.optimizer_sr.step()
                 else:
-                    if self.tree_reg_mode == 'Sequential':
+                    if self.tree_reg_mode == 'Sequential' or sr_loss is None:
                         loss = self.alpha * loss_concept_total + loss_label["target_loss"] + self.reg_strength * omega
                     else:
                         loss = self.alpha * loss_concept_total + loss_label["target_loss"] + self.reg_strength * omega + self.mse_loss_strength * sr_loss
@@ -204,7 +225,7 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                     self.optimizer.step()
 
                 self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                                  value=loss.detach().item(),
+                                                  value=loss.detach(),
                                                   batch_size=batch_size,
                                                   mode='train')
 
@@ -215,23 +236,28 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
         # in sequential mode, train the surrogate model
         if self.tree_reg_mode == 'Sequential':
             if epoch % self.sr_training_freq == 0:
+                # the surrogate is trained on this epoch's pairs, as without async_apl
+                self._collect_APL(wait=True)
                 self._train_surrogate_sequential_mode(epoch)
 
-        # visualize last tree
-        if epoch != 0 and (epoch % self.config['regularisation']['snapshot_epochs'] == 0
-                           or epoch == self.epochs_warm_up):
-            self._visualize_tree(tree=tree,
-                                 config=self.config,
-                                 epoch=epoch,
-                                 APL=APL,
-                                 train_acc='None',
-                                 val_acc='None',
-                                 mode='train',
-                                 expert=None)
+        # visualize last tree (asynchronous trees are visualized in _on_APL_result)
+        if self._is_snapshot_epoch(epoch):
+            if self.apl_pipeline is None:
+                self._visualize_tree(tree=tree,
+                                     config=self.config,
+                                     epoch=epoch,
+                                     APL=APL,
+                                     train_acc='None',
+                                     val_acc='None',
+                                     mode='train',
+                                     expert=None)
 
         if self.do_validation:
             self._valid_epoch(epoch)
 
+        # the asynchronous APL of this epoch must reach its log, and the checkpoint monitor
+        self._collect_APL(wait=True)
+
         # Update the epoch metrics
         self.metrics_tracker.end_epoch()
         log = self.metrics_tracker.result_epoch()
@@ -248,8 +274,8 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
         print(f"Validation Epoch {epoch}:")
         self.model.eval()
 
-        tensor_C_pred = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
+        buffer = self.val_buffer
+        buffer.reset()
 
         with torch.no_grad():
             with tqdm(total=len(self.val_loader), file=sys.stdout) as t:
@@ -271,9 +297,8 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                     C_pred_soft = torch.sigmoid(C_pred_soft)
                     C_pred_concat = torch.cat((C_hard, C_pred_soft), dim=1)
                     C_pred = C_pred_concat[:, self.sorted_concept_indices]
-                    tensor_C_pred = torch.cat((tensor_C_pred, C_pred), dim=0)
                     y_pred = self.model.mn_model.label_predictor(C_pred)
-                    tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
+                    buffer.append(C_pred=C_pred, y_pred=y_pred)
                     outputs = {"prediction_out": y_pred}
 
                     # Calculate Concept losses
@@ -282,12 +307,12 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                     bce_loss_per_concept = torch.mean(bce_loss_per_concept, dim=0)
                     self.metrics_tracker.update_batch(
                         update_dict_or_key='concept_loss',
-                        value=loss_concept_total.detach().item(),
+                        value=loss_concept_total.detach(),
                         batch_size=batch_size,
                         mode='val')
                     self.metrics_tracker.update_batch(
                         update_dict_or_key='loss_per_concept',
-                        value=list(bce_loss_per_concept.detach().numpy()),
+                        value=bce_loss_per_concept.detach(),
                         batch_size=batch_size,
                         mode='val')
 
@@ -307,10 +332,13 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                     )
 
                     # In the final batch, calculate the APL
-                    if (batch_idx == len(self.val_loader) - 1):
+                    if (batch_idx == len(self.val_loader) - 1) and self.apl_pipeline is not None:
+                        self._submit_APL(self.min_samples_leaf, buffer.get('C_pred'), buffer.get('y_pred'), 'val',
+                                         epoch=epoch, epoch_id=self.metrics_tracker.epoch_id)
+                    elif (batch_idx == len(self.val_loader) - 1):
                         APL, fid, fi, tree = self._calculate_APL(
                             self.min_samples_leaf,
-                            tensor_C_pred, tensor_y_pred)
+                            buffer.get('C_pred'), buffer.get('y_pred'), mode='val')
                         self.metrics_tracker.update_batch(
                             update_dict_or_key='APL',
                             value=APL,
@@ -329,7 +357,7 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
 
                     loss = self.alpha * loss_concept_total + loss_label["target_loss"]
                     self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                                      value=loss.detach().item(),
+                                                      value=loss.detach(),
                                                       batch_size=batch_size,
                                                       mode='val')
 
@@ -337,12 +365,41 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                         batch_id='{0}'.format(batch_idx + 1))
                     t.update()
 
+    def _is_snapshot_epoch(self, epoch):
+        return epoch != 0 and (epoch % self.config['regularisation']['snapshot_epochs'] == 0
+                               or epoch == self.epochs_warm_up)
+
+    def _on_APL_result(self, context, APL, fid, fi, tree):
+        """Log the asynchronously fitted tree of `context['epoch']` and feed the surrogate."""
+        epoch, mode = context['epoch'], context['mode']
+        self.metrics_tracker.update_epoch(context['epoch_id'],
+                                          {'APL': APL, 'fidelity': fid, 'feature_importance': fi},
+                                          mode=mode)
+        print(f"APL of {mode} epoch {epoch}: {APL}, fidelity: {fid}")
+        self.logger.info(f"APL of {mode} epoch {epoch}: {APL}, fidelity: {fid}")
+        if mode != 'train':
+            return
+
+        self.latest_APL = APL
+        if (APL > 1 or epoch == 0) and self.tree_reg_mode == 'Sequential':
+            for y_hat_sr in context['y_hat_sr']:
+                self.sr_replay.add(y_hat_sr, APL)
+
+        if self._is_snapshot_epoch(epoch):
+            self._visualize_tree(tree=tree,
+                                 config=self.config,
+                                 epoch=epoch,
+                                 APL=APL,
+                                 train_acc='None',
+                                 val_acc='None',
+                                 mode='train',
+                                 expert=None)
+
     def _test(self, test_data_loader):
 
         self.model.eval()
 
-        tensor_C_pred = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
+        buffer = EpochBuffer.from_loader(test_data_loader)
 
         test_metrics = {"concept_loss": 0, "loss_per_concept": np.zeros(self.num_concepts), "total_correct": 0,
                         "accuracy_per_concept": np.zeros(self.num_concepts),
@@ -366,9 +423,8 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                     test_metrics["accuracy_per_concept"] += np.array([x for x in correct_per_column])
 
                     C_pred = torch.sigmoid(C_pred)
-                    tensor_C_pred = torch.cat((tensor_C_pred, C_pred), dim=0)
                     y_pred = self.model.mn_model.label_predictor(C_pred)
-                    tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
+                    buffer.append(C_pred=C_pred, y_pred=y_pred)
                     outputs = {"prediction_out": y_pred}
 
                     # Calculate Concept losses
@@ -388,7 +444,7 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
                     if (batch_idx == len(test_data_loader) - 1):
                         # Calculate the APL
                         APL, fid, fi, tree = self._calculate_APL(
-                            self.min_samples_leaf, tensor_C_pred, tensor_y_pred)
+                            self.min_samples_leaf, buffer.get('C_pred'), buffer.get('y_pred'))
                         test_metrics["APL"] = APL
                         test_metrics["fidelity"] = fid
                         test_metrics["feature_importance"] = fi
@@ -460,9 +516,10 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
         self.model.sr_model.train()
         self.model.freeze_model()
         self.model.reset_surrogate_weights()
-        if epoch > 0:
-            surrogate_training_loss = self.train_surrogate_model(self.all_preds,
-                                                            self.APLs_truth,
+        if epoch > 0 and len(self.sr_replay) > 0:
+            preds, APLs = self.sr_replay.tensors()
+            surrogate_training_loss = self.train_surrogate_model(preds,
+                                                            APLs,
                                                             self.criterion_sr,
                                                             # optimizer,
                                                             self.optimizer_sr,
@@ -474,19 +531,21 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
 
 
     def train_surrogate_model(self, X, y, criterion, optimizer, model):
-
-        # X_train = torch.vstack(X)
-        X_train = torch.vstack(X).detach()
-        y_train = torch.tensor([y], dtype=torch.float).T.to(self.device)
+        """
+        Fit the surrogate on the (prediction vector, APL) pairs X, y of the replay buffer.
+        Mini-batches of sr_batch_size are sliced from a permutation of the tensors, a
+        single full batch is used if sr_batch_size is missing or larger than the buffer.
+        """
+        X_train = X.to(self.device)
+        y_train = y.to(self.device)
+        y_var = torch.var(y_train).item() if len(y_train) > 1 else 0
 
         model.surrogate_network.to(self.device)
 
         num_epochs = self.config['regularisation']['sequential']['sr_epochs']
-        batch_size = self.config['regularisation']['sequential']['sr_batch_size']
-
-        data_train = TensorDataset(X_train, y_train)
-        data_train_loader = DataLoader(dataset=data_train,
-                                       batch_size=batch_size, shuffle=True)
+        batch_size = self.config['regularisation']['sequential'].get('sr_batch_size')
+        if batch_size is None or batch_size >= len(X_train):
+            batch_size = len(X_train)
 
         training_loss = []
 
@@ -495,26 +554,26 @@ class XCY_Tree_Epoch_Trainer(EpochTrainerBase):
         for epoch in range(num_epochs):
             batch_loss = []
 
-            for (x, y) in data_train_loader:
-                y_hat = model.surrogate_network(x)
-                loss = criterion(input=y_hat, target=y)
+            if batch_size == len(X_train):
+                batches = [slice(None)]
+            else:
+                permutation = torch.randperm(len(X_train), device=X_train.device)
+                batches = [permutation[i:i + batch_size] for i in range(0, len(X_train), batch_size)]
+
+            for batch in batches:
+                y_hat = model.surrogate_network(X_train[batch])
+                loss = criterion(input=y_hat, target=y_train[batch])
                 optimizer.zero_grad()
-                # loss.backward()
                 loss.backward()
                 optimizer.step()
 
-                batch_loss.append(
-                    loss.item() / (torch.var(y_train).item() + 0.01))
+                batch_loss.append(loss.item() / (y_var + 0.01))
 
             training_loss.append(np.array(batch_loss).mean())
 
             if epoch == 0 or (epoch + 1) % 10 == 0:
-                # if epoch:
                 print(
                     f'Surrogate Model: Epoch [{epoch + 1}/{num_epochs},'
                     f' Loss: {np.array(batch_loss).mean():.4f}]')
 
-        del X
-        del y
-
         return training_loss
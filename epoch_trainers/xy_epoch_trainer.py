@@ -6,6 +6,7 @@ from tqdm import tqdm
 
 from loggers import XYLogger
 from utils.util import get_correct
+from utils.epoch_buffer import EpochBuffer
 from base.epoch_trainer_base import EpochTrainerBase
 
 
@@ -64,19 +65,14 @@ class XY_Epoch_Trainer(EpochTrainerBase):
             self.arch.selector.train()
             self.arch.aux_model.train()
 
-        tensor_X = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
-
         with tqdm(total=len(self.train_loader), file=sys.stdout) as t:
             for batch_idx, (X_batch, y_batch) in enumerate(self.train_loader):
                 batch_size = X_batch.size(0)
                 X_batch = X_batch.to(self.device)
-                tensor_X = torch.cat((tensor_X, X_batch), dim=0)
                 y_batch = y_batch.to(self.device)
 
                 # Forward pass
                 y_pred = self.model(X_batch)
-                tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
                 outputs = {"prediction_out": y_pred}
 
                 if self.selective_net:
@@ -104,7 +100,7 @@ class XY_Epoch_Trainer(EpochTrainerBase):
                 loss.backward()
                 self.optimizer.step()
                 self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                                  value=loss.detach().cpu().item(),
+                                                  value=loss.detach(),
                                                   batch_size=batch_size,
                                                   mode='train')
 
@@ -133,20 +129,15 @@ class XY_Epoch_Trainer(EpochTrainerBase):
             self.arch.selector.eval()
             self.arch.aux_model.eval()
 
-        tensor_X = torch.FloatTensor().to(self.device)
-        tensor_y_pred = torch.FloatTensor().to(self.device)
-
         with torch.no_grad():
             with tqdm(total=len(self.val_loader), file=sys.stdout) as t:
                 for batch_idx, (X_batch, y_batch) in enumerate(self.val_loader):
                     batch_size = X_batch.size(0)
                     X_batch = X_batch.to(self.device)
-                    tensor_X = torch.cat((tensor_X, X_batch), dim=0)
                     y_batch = y_batch.to(self.device)
 
                     # Forward pass
                     y_pred = self.model(X_batch)
-                    tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
                     outputs = {"prediction_out": y_pred}
 
                     if self.selective_net:
@@ -160,17 +151,17 @@ class XY_Epoch_Trainer(EpochTrainerBase):
                     if self.selective_net:
                         self.metrics_tracker.update_batch(
                             update_dict_or_key='out_put_sel_proba',
-                            value=out_selector.detach().cpu(),
+                            value=out_selector.detach(),
                             batch_size=batch_size,
                             mode='val')
                         self.metrics_tracker.update_batch(
                             update_dict_or_key='out_put_class',
-                            value=y_pred.detach().cpu(),
+                            value=y_pred.detach(),
                             batch_size=batch_size,
                             mode='val')
                         self.metrics_tracker.update_batch(
                             update_dict_or_key='out_put_target',
-                            value=y_batch.detach().cpu(),
+                            value=y_batch.detach(),
                             batch_size=batch_size,
                             mode='val')
 
@@ -191,7 +182,7 @@ class XY_Epoch_Trainer(EpochTrainerBase):
 
                     loss = loss_label["target_loss"]
                     self.metrics_tracker.update_batch(update_dict_or_key='loss',
-                                                      value=loss.detach().cpu().item(),
+                                                      value=loss.detach(),
                                                       batch_size=batch_size,
                                                       mode='val')
                     t.set_postfix(
@@ -200,14 +191,11 @@ class XY_Epoch_Trainer(EpochTrainerBase):
 
         # Update the epoch metrics
         if self.selective_net:
-            # evaluate g for correctly selected samples (pi >= 0.5)
-            # should be higher
-            self.metrics_tracker.evaluate_correctly(selection_threshold=self.config['selectivenet']['selection_threshold'])
-
-            # evaluate g for correctly rejected samples (pi < 0.5)
-            # should be lower
-            self.metrics_tracker.evaluate_incorrectly(selection_threshold=self.config['selectivenet']['selection_threshold'])
-            self.metrics_tracker.evaluate_coverage_stats(selection_threshold=self.config['selectivenet']['selection_threshold'])
+            # accuracy of the selected (pi >= threshold, should be higher) and of the
+            # rejected (pi < threshold, should be lower) samples, and the coverage
+            self.metrics_tracker.evaluate_selective(
+                selection_threshold=self.config['selectivenet']['selection_threshold'],
+                sweep_thresholds=self.config['selectivenet'].get('sweep_thresholds'))
 
     def _test(self, test_data_loader):
 
@@ -216,8 +204,7 @@ class XY_Epoch_Trainer(EpochTrainerBase):
             self.arch.selector.eval()
             self.arch.aux_model.eval()
 
-        tensor_y_pred = torch.FloatTensor().to(self.device)
-        tensor_y = torch.FloatTensor().to(self.device)
+        buffer = EpochBuffer.from_loader(test_data_loader, dtypes={'y': torch.float})
         test_metrics = {"loss": 0, "target_loss": 0, "accuracy": 0, "total_correct": 0}
 
         with torch.no_grad():
@@ -227,11 +214,10 @@ class XY_Epoch_Trainer(EpochTrainerBase):
                     batch_size = X_batch.size(0)
                     X_batch = X_batch.to(self.device)
                     y_batch = y_batch.to(self.device)
-                    tensor_y = torch.cat((tensor_y, y_batch), dim=0)
 
                     # Forward pass
                     y_pred = self.model(X_batch)
-                    tensor_y_pred = torch.cat((tensor_y_pred, y_pred), dim=0)
+                    buffer.append(y=y_batch, y_pred=y_pred)
                     outputs = {"prediction_out": y_pred}
 
                     # Calculate Label losses
@@ -268,8 +254,8 @@ class XY_Epoch_Trainer(EpochTrainerBase):
         self.logger.info(f"Target Loss: {test_metrics['target_loss']}")
 
         # save the predictions
-        tensor_y_pred = tensor_y_pred.cpu()
-        tensor_y = tensor_y.cpu()
+        tensor_y_pred = buffer.get('y_pred').cpu()
+        tensor_y = buffer.get('y').cpu()
         if self.config["dataset"]["num_classes"] == 1:
             y_hat = torch.sigmoid(tensor_y_pred)
             y_hat = [1 if y_hat[i] >= 0.5 else 0 for i in range(len(y_hat))]
@@ -0,0 +1,128 @@
+import argparse
+import time
+
+import numpy as np
+
+from networks.custom_dt_gini_with_entropy_metrics import CustomDecisionTree
+
+
+def make_concept_data(n_samples, n_concepts, n_classes, seed=42):
+    """Random concept probabilities with a few duplicated values per feature."""
+    rng = np.random.default_rng(seed)
+    X = rng.random((n_samples, n_concepts)).astype(np.float32)
+    # mimic hard / thresholded concepts for half of the features
+    X[:, ::2] = (X[:, ::2] > 0.5).astype(np.float32)
+    y = rng.integers(0, n_classes, size=n_samples)
+    return X, y
+
+
+def time_split(split_fn, X, y, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = split_fn(X, y)
+    return result, (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    X, y = make_concept_data(args.n_samples, args.n_concepts, args.n_classes)
+    tree = CustomDecisionTree(n_classes=args.n_classes)
+
+    (idx_vec, thr_vec), t_vec = time_split(tree._best_split, X, y, args.repeats)
+    (idx_loop, thr_loop), t_loop = time_split(tree._best_split_loop, X, y, args.repeats)
+
+    print(f"samples={args.n_samples}, concepts={args.n_concepts}, classes={args.n_classes}")
+    print(f"loop split:       feature={idx_loop}, threshold={thr_loop}, {t_loop:.4f}s")
+    print(f"vectorized split: feature={idx_vec}, threshold={thr_vec}, {t_vec:.4f}s")
+    print(f"speedup: {t_loop / t_vec:.1f}x")
+    if idx_vec != idx_loop or thr_vec != thr_loop:
+        raise ValueError("Vectorized split differs from the reference loop")
+
+    if args.fit:
+        # grow a full tree with both engines and compare the chosen splits
+        start = time.perf_counter()
+        tree.fit(X, y)
+        t_fit_vec = time.perf_counter() - start
+        splits_vec = [(node.id, node.feature_index, node.threshold) for node in _nodes(tree.tree)]
+
+        tree_loop = CustomDecisionTree(n_classes=args.n_classes)
+        tree_loop._best_split = tree_loop._best_split_loop
+        start = time.perf_counter()
+        tree_loop.fit(X, y)
+        t_fit_loop = time.perf_counter() - start
+        splits_loop = [(node.id, node.feature_index, node.threshold) for node in _nodes(tree_loop.tree)]
+
+        print(f"fit with loop split:       {t_fit_loop:.2f}s")
+        print(f"fit with vectorized split: {t_fit_vec:.2f}s")
+        if splits_vec != splits_loop:
+            raise ValueError("Trees grown with the two split engines differ")
+        print("Both trees are identical")
+
+    if args.traversal:
+        benchmark_traversal(args)
+
+
+def benchmark_traversal(args):
+    """Compare batched predict / apply / decision_path to a per-sample walk of the Node graph."""
+    X, y = make_concept_data(args.n_samples, args.n_concepts, args.n_classes)
+    tree = CustomDecisionTree(n_classes=args.n_classes, min_samples_leaf=args.min_samples_leaf)
+    tree.fit(X, y)
+    X_eval, _ = make_concept_data(args.n_eval_samples, args.n_concepts, args.n_classes, seed=0)
+
+    start = time.perf_counter()
+    leaves_loop = [_walk(tree.tree, inputs) for inputs in X_eval]
+    predict_loop = np.array([leaf.predicted_class for leaf in leaves_loop])
+    apply_loop = np.array([leaf.id for leaf in leaves_loop])
+    paths_loop = [[node.id for node in _walk_path(tree.tree, inputs)] for inputs in X_eval]
+    t_loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predict_vec = tree.predict(X_eval)
+    apply_vec = tree.apply(X_eval)
+    decision_paths = tree.decision_path(X_eval)
+    t_vec = time.perf_counter() - start
+
+    print(f"traversal of {args.n_eval_samples} samples through {tree.node_count} nodes")
+    print(f"per-sample walk: {t_loop:.4f}s")
+    print(f"batched:         {t_vec:.4f}s")
+    print(f"speedup: {t_loop / t_vec:.1f}x")
+
+    paths_vec = [list(decision_paths.node_indices[decision_paths.node_indptr[i]:decision_paths.node_indptr[i + 1]])
+                 for i in range(len(X_eval))]
+    if not (np.array_equal(predict_loop, predict_vec) and np.array_equal(apply_loop, apply_vec)
+            and paths_loop == paths_vec):
+        raise ValueError("Batched traversal differs from the per-sample walk")
+    print("Both traversals are identical")
+
+
+def _walk(node, inputs):
+    return _walk_path(node, inputs)[-1]
+
+
+def _walk_path(node, inputs):
+    path = [node]
+    while node.left:
+        if inputs[node.feature_index] < node.threshold:
+            node = node.left
+        else:
+            node = node.right
+        path.append(node)
+    return path
+
+
+def _nodes(node):
+    if node is None:
+        return []
+    return [node] + _nodes(node.left) + _nodes(node.right)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark CustomDecisionTree split search and traversal')
+    parser.add_argument('--n_samples', default=5000, type=int)
+    parser.add_argument('--n_concepts', default=112, type=int)
+    parser.add_argument('--n_classes', default=200, type=int)
+    parser.add_argument('--repeats', default=1, type=int)
+    parser.add_argument('--fit', action='store_true', help='also grow full trees with both engines')
+    parser.add_argument('--traversal', action='store_true', help='also benchmark predict / apply / decision_path')
+    parser.add_argument('--n_eval_samples', default=60000, type=int)
+    parser.add_argument('--min_samples_leaf', default=20, type=int)
+    main(parser.parse_args())
@@ -7,6 +7,9 @@ from sklearn.inspection import PartialDependenceDisplay
 from sklearn.metrics import accuracy_score
 from sklearn.tree import export_graphviz, DecisionTreeClassifier,  _tree
 
+from utils.tree_utils import compute_semantic_similarity, find_best_trees, \
+    find_highest_similarity_pair
+
 
 def compute_structural_similarity(tree1, tree2):
     depth1 = tree1.get_depth()
@@ -71,35 +74,6 @@ def plot_partial_dependence_trees(tree1, tree2, X, feature_names, target=0):
     plt.show()
 
 
-def compute_semantic_similarity(tree1, tree2, X):
-    leaf_ids1 = tree1.apply(X)
-    leaf_ids2 = tree2.apply(X)
-
-    # Leaf node distribution
-    unique_leaf_ids1, counts1 = np.unique(leaf_ids1, return_counts=True)
-    unique_leaf_ids2, counts2 = np.unique(leaf_ids2, return_counts=True)
-
-    leaf_dist1 = dict(zip(unique_leaf_ids1, counts1))
-    leaf_dist2 = dict(zip(unique_leaf_ids2, counts2))
-
-    common_leaves = set(leaf_dist1.keys()).intersection(set(leaf_dist2.keys()))
-    leaf_similarity = sum(min(leaf_dist1[leaf], leaf_dist2[leaf]) for leaf in
-                          common_leaves) / min(sum(counts1), sum(counts2))
-
-    # Path similarity
-    paths1 = [tree1.decision_path([x]).toarray() for x in X]
-    paths2 = [tree2.decision_path([x]).toarray() for x in X]
-    path_similarity = np.mean(
-        [np.array_equal(p1, p2) for p1, p2 in zip(paths1, paths2)])
-
-    semantic_similarity = {
-        'leaf_similarity': leaf_similarity,
-        'path_similarity': path_similarity
-    }
-
-    return semantic_similarity
-
-
 def serialize_tree(tree):
     # Serialize the tree structure and node values
     return hashlib.md5(tree.tree_.__getstate__()['nodes'].tobytes()).hexdigest()
@@ -326,54 +300,6 @@ def find_closest_paths_to_0_and_1(classifications_prob, counts_prob,
     return closest_paths_prob_0, closest_paths_prob_1, target_feature
 
 
-def find_best_trees(X, y, num_trees = 1500, threshold = 0.02, min_performance = 0.9,
-                    min_samples_leaf=1):
-
-    # Number of different random states to visualize
-    num_trees = num_trees
-    performance_threshold = threshold  # Performance range (e.g., within 2% of the best performance)
-    min_performance = min_performance  # Minimum performance to consider (e.g., accuracy of 90%)
-    # First pass to collect all scores
-
-    scores = []
-    classifiers = []
-    for i in range(num_trees):
-        random_state = i
-        clf = DecisionTreeClassifier(random_state=random_state,
-                                     min_samples_leaf=min_samples_leaf)
-        clf.fit(X, y)  # Train on the full dataset
-        y_pred = clf.predict(X)
-        mean_score = accuracy_score(y, y_pred)
-        classifiers.append((clf, random_state, mean_score))
-        scores.append(mean_score)
-
-    # Determine the best score
-    best_score = max(scores)
-
-    # Filter classifiers with similar performance
-    similar_trees = [
-        (clf, random_state, mean_score)
-        for clf, random_state, mean_score in classifiers
-        if
-        best_score - performance_threshold <= mean_score <= best_score + performance_threshold and mean_score >= min_performance
-    ]
-    # Remove identical trees
-    unique_trees = []
-    seen_hashes = set()
-    for clf, random_state, mean_score in similar_trees:
-        tree_hash = serialize_tree(clf)
-        if tree_hash not in seen_hashes:
-            seen_hashes.add(tree_hash)
-            unique_trees.append((clf, random_state, mean_score))
-
-    # Visualize the unique trees with similar performance
-    # for clf, random_state, mean_score in unique_trees:
-    #     title = f"tree_random_state_{random_state}_score_{mean_score:.4f}"
-    #     graph = export_tree_graphviz(clf, feature_names, class_names, title)
-        # graph.view()
-
-    return unique_trees
-
 def calculate_feature_similarity(tree1, tree2):
     # Extract feature importances
     features1 = tree1.feature_importances_
@@ -385,37 +311,6 @@ def calculate_feature_similarity(tree1, tree2):
     return similarity
 
 
-def find_highest_similarity_pair(trees_list1, trees_list2, feature_names):
-    max_similarity = -1
-    best_pair = (None, None)
-
-    for tree1 in trees_list1:
-        for tree2 in trees_list2:
-            similarity = calculate_feature_similarity(tree1, tree2)
-            if similarity > max_similarity:
-                max_similarity = similarity
-                best_pair = (tree1, tree2)
-
-    # find the feature with the highest importance in the best pair
-    best_pair_features = []
-    for tree in best_pair:
-        best_pair_features.append(tree.feature_importances_.argmax())
-
-    # raise an error if the best feature is not the same in both trees
-    if best_pair_features[0] != best_pair_features[1]:
-        raise ValueError('The best feature is not the same in both trees')
-
-    # print the feature importances in the two trees
-    print(f"Feature importances for the best pair of trees:")
-    print(f"Tree 1: {best_pair[0].feature_importances_}")
-    print(f"Tree 2: {best_pair[1].feature_importances_}")
-
-    print(f"Best feature: {feature_names[best_pair_features[0]]}")
-    best_feature_name = feature_names[best_pair_features[0]]
-
-    return best_pair, max_similarity, best_feature_name
-
-
 def prune(tree):
     def is_leaf(node):
         return (tree.children_left[node] == _tree.TREE_LEAF and
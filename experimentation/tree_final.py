@@ -234,7 +234,7 @@ def compare_two_trees(tree_binary, tree_prob, X, X_binary, X_prob, y_binary, y_p
 def leakage_visualizer(X, X_binary, y_binary, y, X_prob, y_prob,
                        feature_names, class_names, output_path,
                         num_trees = 1500, threshold = 0.02,
-                        min_performance = 0.5, min_samples_leaf=5):
+                        min_performance = 0.5, min_samples_leaf=5, n_jobs=1):
 
     # load the ground truth concepts as X_binary
     # load the predictions of the NN as y_binary
@@ -246,14 +246,16 @@ def leakage_visualizer(X, X_binary, y_binary, y, X_prob, y_prob,
                                           num_trees=num_trees,
                                           threshold=threshold,
                                           min_performance=min_performance,
-                                          min_samples_leaf=min_samples_leaf)
+                                          min_samples_leaf=min_samples_leaf,
+                                          n_jobs=n_jobs)
 
     # collect best trees for the probabilistic tree
     unique_trees_prob = find_best_trees(X_prob, y_prob,
                                         num_trees=num_trees,
                                         threshold=threshold,
                                         min_performance=min_performance,
-                                        min_samples_leaf=min_samples_leaf)
+                                        min_samples_leaf=min_samples_leaf,
+                                        n_jobs=n_jobs)
 
     # stack the first elements of each tuple into a new list
     trees_list1 = [tree for tree, _, _ in unique_trees_binary]
@@ -1,3 +1,5 @@
+from .metrics_engine import *
+from .metrics_logger import *
 from .joint_cbm_logger import *
 from .cy_logger import *
 from .xc_logger import *
@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+
+
+class MetricsEngine:
+    """
+    Running sums of named metrics, kept as tensors on `device`.
+
+    Metrics are registered once, either as sums (scalar or of a fixed `size`) or as
+    concatenations of per-batch tensors. `add` only queues device ops, so a training
+    loop never waits for the device; `sync` copies every sum to the host in a single
+    transfer, and should be called once per epoch.
+    """
+
+    def __init__(self, device=None, dtype=torch.float64):
+        self.device = torch.device('cpu') if device is None else torch.device(device)
+        self.dtype = dtype
+        self.sizes = {}
+        self.sums = {}
+        self.chunks = {}
+
+    def __contains__(self, name):
+        return name in self.sizes or name in self.chunks
+
+    def is_concat(self, name):
+        return name in self.chunks
+
+    def register_sum(self, name, size=None):
+        """A running sum, of shape () or (size,)."""
+        if name in self:
+            raise ValueError(f'Metric {name} is already registered')
+        self.sizes[name] = size
+        self.sums[name] = self._zeros(size)
+
+    def register_concat(self, name):
+        """Per-batch tensors concatenated along the first dimension."""
+        if name in self:
+            raise ValueError(f'Metric {name} is already registered')
+        self.chunks[name] = []
+
+    def _zeros(self, size):
+        return torch.zeros(() if size is None else (size,), dtype=self.dtype, device=self.device)
+
+    def reset(self):
+        for name, size in self.sizes.items():
+            self.sums[name] = self._zeros(size)
+        for name in self.chunks:
+            self.chunks[name] = []
+
+    def add(self, name, value, weight=1):
+        """Add `value * weight` to the sum `name`, or append the tensor `value` to the concatenation `name`."""
+        if name in self.chunks:
+            self.chunks[name].append(value.detach().to(self.device, non_blocking=True))
+            return
+        if isinstance(value, torch.Tensor):
+            value = value.detach().to(self.device, self.dtype, non_blocking=True)
+        elif self.sizes[name] is not None:
+            value = torch.as_tensor(np.asarray(value, dtype=np.float64), dtype=self.dtype).to(self.device)
+        if self.sizes[name] is None and isinstance(value, torch.Tensor):
+            value = value.reshape(())
+        self.sums[name] += value * weight
+
+    def concatenated(self, name):
+        chunks = self.chunks[name]
+        if len(chunks) > 1:
+            self.chunks[name] = chunks = [torch.cat(chunks, dim=0)]
+        return chunks[0] if chunks else torch.empty(0, device=self.device)
+
+    def sync(self):
+        """Host copy of all sums: floats for scalar sums, numpy arrays otherwise."""
+        names = list(self.sizes)
+        if not names:
+            return {}
+        flat = torch.cat([self.sums[name].reshape(-1) for name in names]).cpu().numpy()
+        values, offset = {}, 0
+        for name in names:
+            size = self.sizes[name]
+            if size is None:
+                values[name] = float(flat[offset])
+                offset += 1
+            else:
+                values[name] = flat[offset:offset + size].copy()
+                offset += size
+        return values
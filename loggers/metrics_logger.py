@@ -0,0 +1,436 @@
+import os.path
+import time
+
+from torch.utils.tensorboard import SummaryWriter
+
+from loggers.metrics_engine import MetricsEngine
+from utils.selective_metrics import selective_stats
+from utils import *
+
+
+class MetricsLogger:
+    """
+    Shared epoch logger of the XY, CY and joint CBM trainers.
+
+    All running sums live in a MetricsEngine on the training device, so update_batch and
+    the track_* methods never wait for the device; everything is copied to the host once,
+    in end_epoch. Metrics are declared with register_metric: '<mode>_<name>' is averaged
+    over the samples of each epoch, kept in attributes_per_epoch (or
+    list_attributes_per_epoch for vectors) and in the history, and written to tensorboard
+    if it has a tensorboard name. Subclasses declare their metrics in register_metrics
+    and add their own tensorboard scalars in log_epoch.
+    """
+
+    # the directory names and tensorboard tag of the logger
+    name = None
+    tb_tag = None
+    # metric name -> tensorboard name, written as '<tb_tag>/<Mode>_<tb name>'
+    tb_scalars = {}
+    # the column of the labels in the datasets, None for X, y TensorDatasets or X, C, y otherwise
+    label_column = None
+
+    def __init__(self, config, expert, tb_path, output_path, train_loader,
+                 val_loader, selectivenet=False, device=None):
+        """
+        Initialized each parameters of each run.
+        """
+        self.selectivenet = selectivenet
+        self.expert = expert
+        if expert is not None:
+            self.tb_path = tb_path + f'/{self.name}_logger_expert_' + str(expert)
+            self.output_path = output_path + f'/{self.name}_model_expert_' + str(expert)
+        else:
+            self.tb_path = tb_path + f'/{self.name}_logger'
+            self.output_path = output_path + f'/{self.name}_model'
+        self.train_loader = train_loader
+        self.val_loader = val_loader
+        self.device = device
+        self.epoch_id = 0
+        self.best_epoch_id = 0
+
+        self.n_classes = config['dataset']['num_classes']
+        self.class_names = config['dataset']['class_names']
+
+        label_column = self.label_column
+        if label_column is None:
+            # (X, y) TensorDatasets or (X, C, y) datasets, e.g. CUB or sharded
+            label_column = 1 if isinstance(train_loader.dataset, torch.utils.data.TensorDataset) else 2
+        self.class_counts_train = count_labels_per_class(dataset_column(self.train_loader.dataset, label_column))
+        self.class_counts_val = count_labels_per_class(dataset_column(self.val_loader.dataset, label_column))
+        print("Class counts in val data: ",  self.class_counts_val)
+
+        self.run_id = 0
+        self.run_data = []
+        self.run_start_time = None
+        self.epoch_duration = None
+
+        self.tb = None
+        self.val_best_accuracy = 0
+        self.best_val_loss = 1000000
+        self.val_auroc = None
+
+        self.metrics = MetricsEngine(device)
+        self.tb_names = dict(self.tb_scalars)
+        self.attributes_per_epoch = {}
+        self.list_attributes_per_epoch = {}
+        self.all_epoch_attributes = {"train_accuracy": [], "val_accuracy": []}
+        self.all_epoch_list_attributes = {"train_accuracy_per_class": [], "val_accuracy_per_class": []}
+
+        for mode in ('train', 'val'):
+            self.metrics.register_sum(f'{mode}_correct_per_class', self.n_classes)
+        if self.selectivenet:
+            for key in ("val_out_put_sel_proba", "val_out_put_class", "val_out_put_target"):
+                self.metrics.register_concat(key)
+        self.register_metrics()
+
+        self.train_accuracy = None
+        self.val_accuracy = None
+        self.train_accuracy_per_class = np.zeros(self.n_classes)
+        self.val_accuracy_per_class = np.zeros(self.n_classes)
+        self._reset_selectivenet_stats()
+
+    def register_metrics(self):
+        """Declare the metrics of the logger."""
+        self.register_metric('loss')
+        self.register_metric('target_loss')
+        self.register_metric('total_correct')
+        if self.selectivenet:
+            for name in ('selective_loss', 'emp_coverage', 'CE_risk', 'emp_risk', 'cov_penalty', 'aux_loss'):
+                self.register_metric(name)
+        self.register_metric('APL')
+        self.register_metric('fidelity')
+        self.register_metric('APL_predictions', modes=('train',))
+
+    def register_metric(self, name, size=None, modes=('train', 'val'), tb_name=None):
+        """
+        Declare the per-sample metric `name` (a scalar, or a vector of `size`) for each of
+        `modes`. Metrics can also be registered by a trainer, before its first epoch.
+        """
+        if tb_name is not None:
+            self.tb_names[name] = tb_name
+        for mode in modes:
+            key = f'{mode}_{name}'
+            self.metrics.register_sum(key, size)
+            if size is None:
+                self.attributes_per_epoch[key] = 0
+                self.all_epoch_attributes[key] = []
+            else:
+                self.list_attributes_per_epoch[key] = np.zeros(size)
+                self.all_epoch_list_attributes[key] = []
+
+    @property
+    def tensor_attributes_per_epoch(self):
+        return {key: self.metrics.concatenated(key) for key in self.metrics.chunks}
+
+    def _reset_selectivenet_stats(self):
+        if self.selectivenet:
+            self.val_correct_accuracy = 0
+            self.val_incorrect_accuracy = 0
+            self.val_correct = 0
+            self.val_n_selected = 0
+            self.val_n_rejected = 0
+            self.val_coverage = 0
+            self.val_selective_sweep = None
+
+    def begin_run(self):
+        """
+        Records all the parameters at the start of each run.
+
+        :param run:
+
+        :return: none
+        """
+        self.run_start_time = time.time()
+
+        self.run_id += 1
+        self.tb = SummaryWriter(f"{self.tb_path}")
+
+    def end_run(self):
+        """
+        Records all the parameters at the end of each run.
+
+        :return: none
+        """
+        self.tb.close()
+        self.epoch_id = 0
+
+    def begin_epoch(self):
+        self.metrics.reset()
+        for key in self.attributes_per_epoch:
+            self.attributes_per_epoch[key] = 0
+        for key in self.list_attributes_per_epoch:
+            self.list_attributes_per_epoch[key].fill(0)
+
+        self.train_accuracy = None
+        self.val_accuracy = None
+        self._reset_selectivenet_stats()
+
+        self.train_accuracy_per_class = np.zeros(self.n_classes)
+        self.val_accuracy_per_class = np.zeros(self.n_classes)
+
+        self.epoch_id += 1
+
+    def update_batch(self, update_dict_or_key, batch_size, value=None,
+                     mode='train'):
+        """
+        Add the batch means in `update_dict_or_key` (or the single `value` of the metric
+        `update_dict_or_key`), weighted by `batch_size`. Values may be device tensors;
+        unknown metrics are ignored.
+        """
+        prefix = "train_" if mode == 'train' else "val_"
+        if isinstance(update_dict_or_key, dict):
+            updates = update_dict_or_key.items()
+        elif isinstance(update_dict_or_key, str) and value is not None:
+            updates = [(update_dict_or_key, value)]
+        else:
+            raise ValueError(
+                "Invalid input: expected a dictionary or a key-value pair")
+
+        for key, val in updates:
+            full_key = prefix + key
+            if full_key not in self.metrics:
+                continue
+            if self.metrics.is_concat(full_key):
+                self.metrics.add(full_key, val)
+            else:
+                self.metrics.add(full_key, val, weight=batch_size)
+
+    def update_epoch(self, epoch_id, update_dict, mode='train'):
+        """
+        Record values of epoch `epoch_id` that are only available later, e.g. an APL
+        computed asynchronously, as if update_batch had been called during that epoch.
+        """
+        prefix = "train_" if mode == 'train' else "val_"
+        if len(self.all_epoch_attributes["train_accuracy"]) < epoch_id:
+            # the epoch has not ended yet
+            dataset_length = len(self.train_loader.dataset) if mode == 'train' else len(self.val_loader.dataset)
+            for key, value in update_dict.items():
+                self.update_batch(update_dict_or_key=key, value=value,
+                                  batch_size=dataset_length, mode=mode)
+            return
+
+        for key, value in update_dict.items():
+            full_key = prefix + key
+            if full_key in self.all_epoch_attributes:
+                self.all_epoch_attributes[full_key][epoch_id - 1] = value
+            elif full_key in self.all_epoch_list_attributes:
+                self.all_epoch_list_attributes[full_key][epoch_id - 1] = list(value)
+            if key in self.tb_names:
+                self.tb.add_scalar(f"{self.tb_tag}/{mode.capitalize()}_{self.tb_names[key]}", value, epoch_id)
+
+    def _dataset_length(self, key):
+        if key.startswith("train_"):
+            return len(self.train_loader.dataset)
+        elif key.startswith("val_"):
+            return len(self.val_loader.dataset)
+        raise ValueError("Invalid key: ", key)
+
+    def _accuracy_per_class(self, correct_per_class, class_counts):
+        counts = np.array([class_counts.get(i, 0) for i in range(self.n_classes)], dtype=np.float64)
+        return np.divide(correct_per_class, counts, out=np.zeros(self.n_classes), where=counts > 0)
+
+    def end_epoch(self, selectivenet=False):
+        # the only device sync of the epoch
+        totals = self.metrics.sync()
+
+        # for multiclass classification
+        self.train_accuracy = (totals['train_total_correct'] / len(self.train_loader.dataset)) * 100
+        self.val_accuracy = (totals['val_total_correct'] / len(self.val_loader.dataset)) * 100
+        self.all_epoch_attributes["train_accuracy"].append(self.train_accuracy)
+        self.all_epoch_attributes["val_accuracy"].append(self.val_accuracy)
+
+        self.train_accuracy_per_class = self._accuracy_per_class(totals['train_correct_per_class'],
+                                                                 self.class_counts_train)
+        self.val_accuracy_per_class = self._accuracy_per_class(totals['val_correct_per_class'],
+                                                               self.class_counts_val)
+        self.all_epoch_list_attributes["train_accuracy_per_class"].append(
+            (self.train_accuracy_per_class).tolist())
+        self.all_epoch_list_attributes["val_accuracy_per_class"].append(
+            (self.val_accuracy_per_class).tolist())
+
+        for key in self.list_attributes_per_epoch:
+            self.list_attributes_per_epoch[key] = totals[key] / self._dataset_length(key)
+            self.all_epoch_list_attributes[key].append((self.list_attributes_per_epoch[key]).tolist())
+
+        for key in self.attributes_per_epoch:
+            self.attributes_per_epoch[key] = totals[key] / self._dataset_length(key)
+            self.all_epoch_attributes[key].append(self.attributes_per_epoch[key])
+
+        self.tb.add_scalar(f"{self.tb_tag}/Train_accuracy", self.train_accuracy, self.epoch_id)
+        self.tb.add_scalar(f"{self.tb_tag}/Val_accuracy", self.val_accuracy, self.epoch_id)
+        for key in self.attributes_per_epoch:
+            mode, name = key.split('_', 1)
+            if name in self.tb_names:
+                self.tb.add_scalar(f"{self.tb_tag}/{mode.capitalize()}_{self.tb_names[name]}",
+                                   self.attributes_per_epoch[key], self.epoch_id)
+
+        # report class accuracies
+        for i in range(self.n_classes):
+            self.tb.add_scalar(f"{self.tb_tag} Train Accuracy Per Class/Train Accuracy Class {self.class_names[i]}",
+                               self.train_accuracy_per_class[i],
+                               self.epoch_id)
+            self.tb.add_scalar(f"{self.tb_tag} Val Accuracy Per Class/Val Accuracy Class {self.class_names[i]}",
+                               self.val_accuracy_per_class[i],
+                               self.epoch_id)
+
+        self.log_epoch()
+        if selectivenet:
+            self.track_selectivenet_stats()
+
+    def log_epoch(self):
+        """Logger specific statistics of the epoch, after the metrics have been averaged."""
+        pass
+
+    def track_selectivenet_stats(self):
+
+        for mode in ('train', 'val'):
+            tag = f"SelectiveNet {mode.capitalize()}"
+            self.tb.add_scalar(f"{tag}/Empirical_Coverage ",
+                               self.attributes_per_epoch[f"{mode}_emp_coverage"],
+                               self.epoch_id)
+            self.tb.add_scalar(f"{tag}/CE_Risk",
+                               self.attributes_per_epoch[f"{mode}_CE_risk"],
+                               self.epoch_id)
+            self.tb.add_scalar(f"{tag}/Emp_Risk (KD + Entropy)",
+                               self.attributes_per_epoch[f"{mode}_emp_risk"],
+                               self.epoch_id)
+            self.tb.add_scalar(f"{tag}/Cov_Penalty",
+                               self.attributes_per_epoch[f"{mode}_cov_penalty"],
+                               self.epoch_id)
+            self.tb.add_scalar(
+                f"{tag}/Selective_Loss (Emp + Cov)",
+                self.attributes_per_epoch[f"{mode}_selective_loss"], self.epoch_id
+            )
+            self.tb.add_scalar(f"{tag}/Aux_Loss",
+                               self.attributes_per_epoch[f"{mode}_aux_loss"],
+                               self.epoch_id)
+
+        self.tb.add_scalar(
+            "SelectiveNet Val Main/Accuracy_Correctly_Selected (pi >= 0.5)",
+            self.val_correct_accuracy, self.epoch_id
+        )
+        self.tb.add_scalar(
+            "SelectiveNet Val Main/Accuracy_Correctly_Rejected (pi < 0.5)",
+            self.val_incorrect_accuracy, self.epoch_id
+        )
+
+        self.tb.add_scalar("SelectiveNet Val Main/N_Selected", self.val_n_selected,
+                           self.epoch_id)
+        self.tb.add_scalar("SelectiveNet Val Main/N_Rejected", self.val_n_rejected,
+                           self.epoch_id)
+        self.tb.add_scalar("SelectiveNet Val Main/coverage", self.val_coverage,
+                           self.epoch_id)
+
+    def __str__(self):
+        return f"Attributes per epoch: {self.attributes_per_epoch}\nTensor Attributes per epoch: {self.tensor_attributes_per_epoch}\nList Attributes per epoch: {self.list_attributes_per_epoch}"
+
+    def evaluate_selective(self, selection_threshold, sweep_thresholds=None, with_auroc=False):
+        """
+        All the SelectiveNet statistics of the validation outputs of the epoch in one pass:
+        accuracy of the selected (pi >= threshold) and rejected samples, their numbers,
+        the coverage, the AUROC on the selected samples if `with_auroc`, and the same
+        statistics for every threshold of `sweep_thresholds` (in val_selective_sweep).
+        """
+        tensors = self.tensor_attributes_per_epoch
+        stats = selective_stats(tensors["val_out_put_class"], tensors["val_out_put_sel_proba"],
+                                tensors["val_out_put_target"], selection_threshold,
+                                num_classes=self.n_classes, with_auroc=with_auroc,
+                                sweep_thresholds=sweep_thresholds)
+        self.val_correct = stats['ta']
+        self.val_correct_accuracy = stats['selected_accuracy']
+        self.val_incorrect_accuracy = stats['rejected_accuracy']
+        self.val_n_selected = stats['n_selected']
+        self.val_n_rejected = stats['n_rejected']
+        self.val_coverage = stats['coverage']
+        if with_auroc:
+            self.val_auroc = stats['auroc']
+        self.val_selective_sweep = stats.get('sweep')
+        return stats
+
+    def evaluate_correctly(self, selection_threshold):
+        self.evaluate_selective(selection_threshold)
+
+    def evaluate_incorrectly(self, selection_threshold):
+        self.evaluate_selective(selection_threshold)
+
+    def evaluate_correctly_auroc(self, selection_threshold):
+        self.evaluate_selective(selection_threshold, with_auroc=True)
+
+    def evaluate_coverage_stats(self, selection_threshold):
+        self.evaluate_selective(selection_threshold)
+
+    def _track_correct(self, mode, preds, labels):
+        labels = labels.reshape(-1).long()
+        correct = (predicted_classes(preds, self.n_classes) == labels).to(self.metrics.dtype)
+        self.metrics.add(f'{mode}_total_correct', correct.sum())
+
+    def _track_correct_per_class(self, mode, preds, labels):
+        labels = labels.reshape(-1).long()
+        correct = (predicted_classes(preds, self.n_classes) == labels).to(self.metrics.dtype)
+        per_class = torch.zeros(self.n_classes, dtype=self.metrics.dtype, device=correct.device)
+        self.metrics.add(f'{mode}_correct_per_class', per_class.index_add_(0, labels, correct))
+
+    def track_total_train_correct_per_epoch(self, preds, labels):
+        """
+        Calculates the correct prediction at the each iteration of batch.
+
+        :param preds: predicted labels
+        :param labels: true labels
+        """
+        self._track_correct('train', preds, labels)
+
+    def track_total_val_correct_per_epoch(self, preds, labels):
+        """
+        Calculates the correct prediction at the each iteration of batch.
+
+        :param preds: predicted labels
+        :param labels: true labels
+        """
+        self._track_correct('val', preds, labels)
+
+    def track_total_train_correct_per_epoch_per_class(self, preds, labels):
+        """
+        Calculates the correct prediction per class at the each iteration of batch.
+
+        :param preds: predicted labels
+        :param labels: true labels
+        """
+        self._track_correct_per_class('train', preds, labels)
+
+    def track_total_val_correct_per_epoch_per_class(self, preds, labels):
+        """
+        Calculates the correct prediction per class at the each iteration of batch.
+
+        :param preds: predicted labels
+        :param labels: true labels
+        """
+        self._track_correct_per_class('val', preds, labels)
+
+    def result(self):
+        performance_dict = {**self.all_epoch_list_attributes,
+                            **self.all_epoch_attributes}
+        performance_df = pd.DataFrame(
+            dict([(col_name, pd.Series(values)) for col_name, values in
+                  performance_dict.items()])
+        )
+        performance_df.to_csv(
+            os.path.join(self.tb_path, "train_val_stats") + ".csv")
+        return performance_dict
+
+    def result_epoch(self):
+        performance_dict = {**self.attributes_per_epoch,
+                            **self.list_attributes_per_epoch}
+        # Add the values to the dictionary
+        performance_dict['train_accuracy'] = self.train_accuracy
+        performance_dict['val_accuracy'] = self.val_accuracy
+        if self.selectivenet:
+            performance_dict['val_correct_accuracy'] = self.val_correct_accuracy
+            performance_dict['val_incorrect_accuracy'] = self.val_incorrect_accuracy
+            performance_dict['val_correct'] = self.val_correct
+            performance_dict['val_n_selected'] = self.val_n_selected
+            performance_dict['val_n_rejected'] = self.val_n_rejected
+            performance_dict['val_coverage'] = self.val_coverage
+
+        performance_dict['train_accuracy_per_class'] = self.train_accuracy_per_class
+        performance_dict['val_accuracy_per_class'] = self.val_accuracy_per_class
+        return performance_dict
@@ -1,18 +1,51 @@
+import contextlib
+import io
 import numpy as np
 import graphviz
+import torch
 import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
+from scipy.sparse import csr_matrix
 from scipy.stats import entropy
 from data_loaders import get_mnist_dataLoader_original
 from utils.tree_utils import get_light_colors
 
-class DecisionPath:
-    def __init__(self, node_indices, feature_indices, node_indptr, feature_indptr):
-        self.node_indices = node_indices
+TREE_LEAF = -1
+TREE_UNDEFINED = -2
+
+
+def _as_numpy(X):
+    """Host numpy array of `X`, which may be a (device) tensor."""
+    if isinstance(X, torch.Tensor):
+        return X.detach().cpu().numpy()
+    return np.asarray(X)
+
+class DecisionPath(csr_matrix):
+    """CSR node indicator matrix, as returned by sklearn's `decision_path`.
+
+    Row i holds the ids of the nodes visited by sample i, in root-to-leaf
+    order (nodes that share an id with an earlier one get columns after the
+    largest id, see CustomDecisionTree.node_columns). `node_indices`/
+    `node_indptr` are aliases of the CSR `indices`/`indptr`, and `feature_indices`/`feature_indptr` hold the
+    features tested along every path (the leaf is excluded).
+    """
+
+    def __init__(self, arg1, shape=None, dtype=None, copy=False,
+                 feature_indices=None, feature_indptr=None):
+        super().__init__(arg1, shape=shape, dtype=dtype, copy=copy)
         self.feature_indices = feature_indices
-        self.node_indptr = node_indptr
         self.feature_indptr = feature_indptr
 
+    @property
+    def node_indices(self):
+        return self.indices
+
+    @property
+    def node_indptr(self):
+        return self.indptr
+
 class CustomDecisionTree:
     def __init__(self, n_classes, min_samples_split=2, min_samples_leaf=1, max_depth=1000):
         self.min_samples_split = min_samples_split
@@ -44,9 +77,127 @@ class CustomDecisionTree:
         self.n_classes = self.n_classes if self.n_classes else len(set(y))
         self.node_count = 0
         self.tree = self._grow_tree(X, y)
+        self._build_arrays()
+
+    def _build_arrays(self):
+        """Flatten the Node graph into contiguous arrays, similar to sklearn's `tree_`.
+
+        Nodes are stored in pre-order, so the root is at index 0. Leaves have
+        TREE_LEAF children and TREE_UNDEFINED feature/threshold. `node_id` maps
+        every array index back to the id of its Node, since ids are not
+        guaranteed to be contiguous (pruning, combined trees).
+        """
+        nodes = []
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.right is not None:
+                stack.append(node.right)
+            if node.left is not None:
+                stack.append(node.left)
+        position = {id(node): i for i, node in enumerate(nodes)}
+
+        n_nodes = len(nodes)
+        self.children_left = np.full(n_nodes, TREE_LEAF, dtype=np.int64)
+        self.children_right = np.full(n_nodes, TREE_LEAF, dtype=np.int64)
+        self.feature = np.full(n_nodes, TREE_UNDEFINED, dtype=np.int64)
+        self.threshold = np.full(n_nodes, TREE_UNDEFINED, dtype=np.float64)
+        self.value = np.zeros((n_nodes, self.n_classes), dtype=np.int64)
+        self.n_node_samples = np.zeros(n_nodes, dtype=np.int64)
+        self.node_id = np.zeros(n_nodes, dtype=np.int64)
+        self.impurity = np.zeros(n_nodes, dtype=np.float64)
+        self.entropy = np.zeros(n_nodes, dtype=np.float64)
+        self.info_gain = np.zeros(n_nodes, dtype=np.float64)
+        self.gain_ratio = np.zeros(n_nodes, dtype=np.float64)
+
+        self._node_by_id = {}
+        for i, node in enumerate(nodes):
+            if node.left is not None:
+                self.children_left[i] = position[id(node.left)]
+                self.children_right[i] = position[id(node.right)]
+                self.feature[i] = node.feature_index
+                self.threshold[i] = node.threshold
+            self.value[i] = node.num_samples_per_class
+            self.n_node_samples[i] = node.num_samples
+            self.node_id[i] = node.id
+            self.impurity[i] = node.gini
+            self.entropy[i] = node.entropy
+            self.info_gain[i] = node.info_gain
+            self.gain_ratio[i] = node.gain_ratio
+            # keep the first node in pre-order, as the DFS lookup did
+            self._node_by_id.setdefault(node.id, node)
+
+    def _build_nodes(self):
+        """Rebuild the Node graph used by the exporters from the flat arrays."""
+        nodes = [
+            self.Node(
+                gini=self.impurity[i],
+                entropy=self.entropy[i],
+                num_samples=self.n_node_samples[i],
+                num_samples_per_class=list(self.value[i]),
+                predicted_class=np.argmax(self.value[i]),
+                node_id=self.node_id[i],
+                info_gain=self.info_gain[i],
+                gain_ratio=self.gain_ratio[i]
+            )
+            for i in range(len(self.node_id))
+        ]
+        self._node_by_id = {}
+        for i, node in enumerate(nodes):
+            if self.children_left[i] != TREE_LEAF:
+                node.feature_index = self.feature[i]
+                node.threshold = self.threshold[i]
+                node.left = nodes[self.children_left[i]]
+                node.right = nodes[self.children_right[i]]
+            self._node_by_id.setdefault(node.id, node)
+        self.tree = nodes[0]
+
+    def __getstate__(self):
+        # pickle / deepcopy only the flat arrays, the Node graph is rebuilt on load
+        state = self.__dict__.copy()
+        if state.get('tree') is not None:
+            state['tree'] = None
+            state.pop('_node_by_id', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.tree is None and getattr(self, 'node_id', None) is not None:
+            self._build_nodes()
+        elif self.tree is not None and getattr(self, 'node_id', None) is None:
+            # trees pickled before the flat representation existed
+            self._build_arrays()
 
     def predict(self, X):
-        return [self._predict(inputs) for inputs in X]
+        leaves = self._apply_index(X)
+        return np.argmax(self.value, axis=1)[leaves]
+
+    def _apply_index(self, X, return_path=False):
+        """Route all samples through the tree one level at a time.
+
+        Returns the array index of the leaf reached by every sample and, if
+        `return_path` is set, the (sample, node index) pairs visited, in level
+        order.
+        """
+        X = _as_numpy(X)
+        node = np.zeros(X.shape[0], dtype=np.int64)
+        active = np.arange(X.shape[0])
+        # start from empty arrays so that an empty X yields an empty path
+        path_samples, path_nodes = [active[:0]], [node[:0]]
+        while active.size:
+            current = node[active]
+            if return_path:
+                path_samples.append(active)
+                path_nodes.append(current)
+            is_split = self.children_left[current] != TREE_LEAF
+            active, current = active[is_split], current[is_split]
+            go_left = X[active, self.feature[current]] < self.threshold[current]
+            node[active] = np.where(go_left, self.children_left[current],
+                                    self.children_right[current])
+        if return_path:
+            return node, np.concatenate(path_samples), np.concatenate(path_nodes)
+        return node
 
     def _grow_tree(self, X, y, depth=0):
         node_id = self.node_count
@@ -125,6 +276,51 @@ class CustomDecisionTree:
         return True
 
     def _best_split(self, X, y):
+        """Vectorized version of `_best_split_loop`.
+
+        Each feature is sorted once, the class counts left of every candidate
+        threshold are obtained with a cumulative sum and the weighted gini of
+        all candidates is computed in one go. The per-class terms are summed
+        in the same order as the loop, so the selected split is identical.
+        """
+        m, n = X.shape
+        if m <= 1:
+            return None, None
+
+        y = np.asarray(y).astype(np.int64)
+        num_parent = np.bincount(y, minlength=self.n_classes)
+        best_gini = 1.0 - sum((num / m) ** 2 for num in num_parent)
+        best_idx, best_thr = None, None
+
+        n_left = np.arange(1, m)
+        n_right = m - n_left
+        one_hot = np.zeros((m, self.n_classes), dtype=np.int64)
+        for idx in range(n):
+            order = np.argsort(X[:, idx], kind='stable')
+            thresholds = X[order, idx]
+
+            one_hot[:] = 0
+            one_hot[np.arange(m), y[order]] = 1
+            num_left = np.cumsum(one_hot, axis=0)[:-1]
+            num_right = num_parent - num_left
+
+            sum_left = np.zeros(m - 1)
+            sum_right = np.zeros(m - 1)
+            for c in range(self.n_classes):
+                sum_left += (num_left[:, c] / n_left) ** 2
+                sum_right += (num_right[:, c] / n_right) ** 2
+            gini = (n_left * (1.0 - sum_left) + n_right * (1.0 - sum_right)) / m
+            gini[thresholds[1:] == thresholds[:-1]] = np.inf
+
+            i = np.argmin(gini)
+            if gini[i] < best_gini:
+                best_gini = gini[i]
+                best_idx = idx
+                best_thr = (thresholds[i + 1] + thresholds[i]) / 2
+        return best_idx, best_thr
+
+    def _best_split_loop(self, X, y):
+        """Reference pure-Python split search, kept for benchmarking."""
         m, n = X.shape
         if m <= 1:
             return None, None
@@ -180,67 +376,47 @@ class CustomDecisionTree:
             return 0
         return info_gain / split_info
 
-    def _predict(self, inputs):
-        node = self.tree
-        while node.left:
-            if inputs[node.feature_index] < node.threshold:
-                node = node.left
-            else:
-                node = node.right
-        return node.predicted_class
-
     def apply(self, X):
-        return [self._apply(inputs) for inputs in X]
-
-    def _apply(self, inputs):
-        node = self.tree
-        while node.left:
-            if inputs[node.feature_index] < node.threshold:
-                node = node.left
-            else:
-                node = node.right
-        return node.id
+        return self.node_id[self._apply_index(X)]
 
     def decision_path(self, X):
         """Return the decision path in a format similar to scikit-learn"""
-        n_samples = X.shape[0]
-        n_nodes = self.node_count
-
-        # Initialize the attributes
-        node_indices = []
-        feature_indices = []
-        node_indptr = [0]
-        feature_indptr = [0]
-
-        for inputs in X:
-            node_path = []
-            feature_path = []
-            node = self.tree
-            node_path.append(node.id)
-            feature_path.append(node.feature_index)
-            while node.left:
-                if inputs[node.feature_index] < node.threshold:
-                    node = node.left
-                else:
-                    node = node.right
-                node_path.append(node.id)
-                feature_path.append(node.feature_index)
-            node_indices.extend(node_path)
-
-            # remove the feature index of the leaf node
-            feature_path = feature_path[:-1]
-            feature_indices.extend(feature_path)
-
-            node_indptr.append(len(node_indices))
-            feature_indptr.append(len(feature_indices))
-
-        # Convert lists to numpy arrays
-        node_indices = np.array(node_indices, dtype=np.int32)
-        feature_indices = np.array(feature_indices, dtype=np.int32)
-        node_indptr = np.array(node_indptr, dtype=np.int32)
-        feature_indptr = np.array(feature_indptr, dtype=np.int32)
-
-        return DecisionPath(node_indices, feature_indices, node_indptr, feature_indptr)
+        n_samples = len(X)
+        _, samples, nodes = self._apply_index(X, return_path=True)
+
+        # stable sort keeps the root-to-leaf order within every sample
+        order = np.argsort(samples, kind='stable')
+        samples, nodes = samples[order], nodes[order]
+        node_indptr = np.zeros(n_samples + 1, dtype=np.int32)
+        np.cumsum(np.bincount(samples, minlength=n_samples), out=node_indptr[1:])
+
+        # remove the feature index of the leaf nodes
+        is_split = self.children_left[nodes] != TREE_LEAF
+        feature_indptr = np.zeros(n_samples + 1, dtype=np.int32)
+        np.cumsum(np.bincount(samples[is_split], minlength=n_samples), out=feature_indptr[1:])
+        feature_indices = self.feature[nodes[is_split]].astype(np.int32)
+
+        node_columns = self.node_columns()
+        node_indices = node_columns[nodes].astype(np.int32)
+        n_columns = max(self.node_count, int(node_columns.max()) + 1)
+        return DecisionPath((np.ones(len(node_indices), dtype=np.int64), node_indices, node_indptr),
+                            shape=(n_samples, n_columns),
+                            feature_indices=feature_indices, feature_indptr=feature_indptr)
+
+    def node_columns(self):
+        """
+        decision_path column of every array index: its node id, except for the later
+        (in pre-order) nodes sharing an id with another one, e.g. in combined trees,
+        which get columns after the largest id so that every column is a single node.
+        """
+        if getattr(self, '_columns_of', None) is not self.node_id:
+            columns = self.node_id.copy()
+            _, first = np.unique(self.node_id, return_index=True)
+            duplicate = np.ones(len(columns), dtype=bool)
+            duplicate[first] = False
+            columns[duplicate] = self.node_id.max() + 1 + np.arange(duplicate.sum())
+            self._node_column, self._columns_of = columns, self.node_id
+        return self._node_column
 
     def export_tree(self, feature_names, class_colors, class_names):
         import matplotlib.colors as mcolors
@@ -540,6 +716,8 @@ class CustomDecisionTree:
 
     def _get_node_by_id(self, node_id):
         # Helper function to get a node by its id
+        if getattr(self, '_node_by_id', None) is not None:
+            return self._node_by_id.get(node_id)
         stack = [self.tree]
         while stack:
             node = stack.pop()
@@ -989,6 +1167,7 @@ def build_combined_tree(original_tree, leaf_trees, X, y):
                                            min_samples_leaf=original_tree.min_samples_leaf)
     combined_tree_obj.tree = combined_tree_root
     combined_tree_obj.node_count = len(combined_tree)
+    combined_tree_obj._build_arrays()
 
     # Print combined tree attributes for debugging
     print("\nCombined tree attributes:")
@@ -997,6 +1176,85 @@ def build_combined_tree(original_tree, leaf_trees, X, y):
     return combined_tree_obj
 
 
+def fit_leaf_trees(leaf_data, n_classes, min_samples_leaf=1, n_jobs=1):
+    """Fit one CustomDecisionTree per leaf of a tree.
+
+    `leaf_data` maps every leaf id to its (C_leaf, y_leaf) pair. The fitted trees are
+    returned in a dict with the same key order. With n_jobs > 1 the trees are fitted
+    in a process pool: all concept matrices are packed into one shared memory block
+    that the workers attach to, and the output printed during every fit is replayed
+    in leaf order, so that logs are identical to a sequential run.
+    """
+    if n_jobs is None or n_jobs <= 1 or len(leaf_data) <= 1:
+        leaf_trees = {}
+        for leaf, (C_leaf, y_leaf) in leaf_data.items():
+            tree = CustomDecisionTree(min_samples_leaf=min_samples_leaf, n_classes=n_classes)
+            tree.fit(C_leaf, y_leaf)
+            leaf_trees[leaf] = tree
+        return leaf_trees
+
+    leaves = list(leaf_data.keys())
+    all_C = np.concatenate([np.asarray(leaf_data[leaf][0]) for leaf in leaves])
+    all_y = np.concatenate([np.asarray(leaf_data[leaf][1]) for leaf in leaves])
+    bounds = np.cumsum([0] + [len(leaf_data[leaf][1]) for leaf in leaves])
+
+    shm_C = shared_memory.SharedMemory(create=True, size=max(all_C.nbytes, 1))
+    shm_y = shared_memory.SharedMemory(create=True, size=max(all_y.nbytes, 1))
+    try:
+        np.ndarray(all_C.shape, dtype=all_C.dtype, buffer=shm_C.buf)[:] = all_C
+        np.ndarray(all_y.shape, dtype=all_y.dtype, buffer=shm_y.buf)[:] = all_y
+        tasks = [((shm_C.name, all_C.shape, all_C.dtype), (shm_y.name, all_y.shape, all_y.dtype),
+                  bounds[i], bounds[i + 1], n_classes, min_samples_leaf)
+                 for i in range(len(leaves))]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # map keeps the order of the leaves, whatever order the fits finish in
+            results = list(executor.map(_fit_leaf_tree_worker, tasks))
+    finally:
+        shm_C.close()
+        shm_C.unlink()
+        shm_y.close()
+        shm_y.unlink()
+
+    leaf_trees = {}
+    for leaf, (tree, fit_log) in zip(leaves, results):
+        print(fit_log, end='')
+        leaf_trees[leaf] = tree
+    return leaf_trees
+
+
+def _fit_leaf_tree_worker(task):
+    """Fit a leaf tree on a slice of the shared concept matrix, capturing its output."""
+    (C_name, C_shape, C_dtype), (y_name, y_shape, y_dtype), start, stop, n_classes, min_samples_leaf = task
+    shm_C = _attach_shared_memory(C_name)
+    shm_y = _attach_shared_memory(y_name)
+    try:
+        C_leaf = np.ndarray(C_shape, dtype=C_dtype, buffer=shm_C.buf)[start:stop]
+        y_leaf = np.ndarray(y_shape, dtype=y_dtype, buffer=shm_y.buf)[start:stop]
+        tree = CustomDecisionTree(min_samples_leaf=min_samples_leaf, n_classes=n_classes)
+        fit_log = io.StringIO()
+        with contextlib.redirect_stdout(fit_log):
+            tree.fit(C_leaf, y_leaf)
+        # drop the views before closing the shared memory
+        del C_leaf, y_leaf
+    finally:
+        shm_C.close()
+        shm_y.close()
+    return tree, fit_log.getvalue()
+
+
+def _attach_shared_memory(name):
+    """
+    Attach to a block created by the parent. Pool workers (forked or spawned) report to
+    the resource tracker of the parent, where the block is already registered, so they
+    must not unregister it: the parent's unlink would then make the tracker warn.
+    """
+    try:
+        # Python >= 3.13
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
 def traverse_nodes(node):
     """Utility function to traverse nodes in a tree and yield each node."""
     yield node
@@ -0,0 +1,250 @@
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state
+
+from networks.custom_dt_gini_with_entropy_metrics import DecisionPath, TREE_LEAF
+from utils.concept_cache import checkpoint_hash
+
+
+def _descend(tree, X, node, expand):
+    """
+    Route the samples of `X` from the array indices `node` of `tree` while `expand[node]`.
+    Returns the indices reached and the (sample, node index) pairs expanded, in level order.
+    """
+    node = node.copy()
+    active = np.arange(len(node))
+    path_samples, path_nodes = [active[:0]], [node[:0]]
+    while active.size:
+        current = node[active]
+        keep = expand[current]
+        active, current = active[keep], current[keep]
+        path_samples.append(active)
+        path_nodes.append(current)
+        go_left = X[active, tree.feature[current]] < tree.threshold[current]
+        node[active] = np.where(go_left, tree.children_left[current], tree.children_right[current])
+    return node, np.concatenate(path_samples), np.concatenate(path_nodes)
+
+
+class CompiledExpert:
+    """
+    The routing tables of one expert: its combined tree, split between the nodes copied
+    from the original tree (which see the hard concepts) and the leaf subtrees (which see
+    the concepts of the seq or joint predictor on the features of their original path).
+    """
+
+    def __init__(self, original_tree, combined_tree, leaf_cbm_used, num_concepts):
+        self.tree = combined_tree
+        n_nodes = len(combined_tree.node_id)
+        self.is_split = combined_tree.children_left != TREE_LEAF
+        self.in_original = np.zeros(n_nodes, dtype=bool)
+        # at the root of every leaf subtree: the features of its original path, and its predictor
+        self.path_features = np.zeros((n_nodes, num_concepts), dtype=bool)
+        self.use_joint = np.zeros(n_nodes, dtype=bool)
+
+        # both trees are stored in pre-order, walk them in parallel
+        stack = [(0, 0, ())]
+        while stack:
+            o, c, features = stack.pop()
+            if original_tree.children_left[o] != TREE_LEAF:
+                self.in_original[c] = True
+                features = features + (original_tree.feature[o],)
+                stack.append((original_tree.children_left[o], combined_tree.children_left[c], features))
+                stack.append((original_tree.children_right[o], combined_tree.children_right[c], features))
+            else:
+                leaf = original_tree.node_id[o]
+                if leaf in leaf_cbm_used:
+                    self.path_features[c, list(features)] = True
+                    self.use_joint[c] = leaf_cbm_used[leaf] != 'seq'
+
+    def predict(self, C_hard, C_seq, C_joint):
+        """Predictions and (sample, node index) pairs of the decision paths, for numpy inputs."""
+        start = np.zeros(len(C_hard), dtype=np.int64)
+        entry, samples_top, nodes_top = _descend(self.tree, C_hard, start, self.in_original)
+
+        # concepts of the leaf predictor on the path features, hard concepts elsewhere
+        C_leaf = np.where(self.use_joint[entry][:, None], C_joint, C_seq)
+        C_mixed = np.where(self.path_features[entry], C_leaf, C_hard)
+        leaves, samples_sub, nodes_sub = _descend(self.tree, C_mixed, entry, self.is_split)
+
+        y_pred = np.argmax(self.tree.value, axis=1)[leaves]
+        samples = np.concatenate([samples_top, samples_sub, np.arange(len(leaves))])
+        nodes = np.concatenate([nodes_top, nodes_sub, leaves])
+        return y_pred, samples, nodes
+
+
+class HierarchicalExpertsInference:
+    """
+    Batched inference of a trained HierarchicalLeakageTrainervD, for online scoring.
+
+    For a batch X, the concept probabilities are computed once per distinct concept
+    predictor (experts that load the same checkpoint share it), the selectors of all
+    experts are evaluated together, and every sample goes to the combined tree of the
+    first expert that accepts it, as in HierarchicalLeakageTrainervD.test.
+    Samples rejected by all experts get the prediction and expert -1, and an empty path.
+    """
+
+    def __init__(self, experts, device):
+        """
+        `experts` is a list of dicts, in routing order, with the keys
+            selector, selector_predictor, selector_concepts, selection_threshold,
+            base_predictor, seq_predictor, joint_predictor, selected_concepts,
+            label_predictor, combined_tree, leaf_cbm_used, num_concepts
+        where the *_predictor entries are concept predictors (nn.Module, joint may be None).
+        """
+        self.device = device
+        self.predictors = {}
+        self.expert_ids = []
+        self.selection_thresholds = []
+        self.compiled = []
+        self.inputs = []
+        selector_inputs = []
+        selectors = []
+
+        for expert_id, expert in enumerate(experts, start=1):
+            joint = expert['joint_predictor'] if expert['joint_predictor'] is not None else expert['seq_predictor']
+            self.expert_ids.append(expert_id)
+            self.selection_thresholds.append(expert['selection_threshold'])
+            self.inputs.append({
+                'hard': (self._register(expert['base_predictor']), expert['selected_concepts']),
+                'seq': (self._register(expert['seq_predictor']), expert['selected_concepts']),
+                'joint': (self._register(joint), expert['selected_concepts']),
+            })
+            selector_inputs.append((self._register(expert['selector_predictor']), expert['selector_concepts']))
+            selectors.append(expert['selector'].eval())
+            self.compiled.append(CompiledExpert(expert['label_predictor'], expert['combined_tree'],
+                                                expert['leaf_cbm_used'], expert['num_concepts']))
+
+        self.selector_groups = self._group_selectors(selectors, selector_inputs)
+        self.n_columns = max(max(c.tree.node_count, int(c.tree.node_columns().max()) + 1) for c in self.compiled)
+
+    @classmethod
+    def from_trainer(cls, trainer):
+        """Compile the experts of a trained HierarchicalLeakageTrainervD."""
+        experts = []
+        for expert in sorted(trainer.experts_leakage_inspection):
+            cy_epoch_trainer = trainer.experts_selectivenet[expert].cy_epoch_trainer
+            leakage = trainer.experts_leakage_inspection[expert]
+            arch = leakage.arch
+            xc_predictor = leakage.xc_epoch_trainer.model.concept_predictor
+            experts.append({
+                'selector': cy_epoch_trainer.arch.selector,
+                'selector_predictor': cy_epoch_trainer.model.concept_predictor,
+                'selector_concepts': cy_epoch_trainer.arch.selected_concepts,
+                'selection_threshold': cy_epoch_trainer.config['selectivenet']['selection_threshold'],
+                # as in HierarchicalLeakageTrainervC.test
+                'base_predictor': arch.concept_predictor if arch.concept_predictor_joint is not None else xc_predictor,
+                'seq_predictor': arch.concept_predictor,
+                'joint_predictor': arch.concept_predictor_joint,
+                'selected_concepts': arch.selected_concepts,
+                'label_predictor': arch.label_predictor,
+                'combined_tree': leakage.combined_tree,
+                'leaf_cbm_used': leakage.leaf_cbm_used,
+                'num_concepts': leakage.num_concepts,
+            })
+        return cls(experts, trainer.device)
+
+    def _register(self, predictor):
+        """Key of `predictor`, shared by all predictors with the same weights."""
+        key = checkpoint_hash(predictor, extra=type(predictor).__name__)
+        if key not in self.predictors:
+            self.predictors[key] = predictor.eval()
+        return key
+
+    @staticmethod
+    def _group_selectors(selectors, selector_inputs):
+        """Selectors of the same architecture and input, whose weights are stacked to run in one vmap."""
+        groups = {}
+        for position, (selector, inputs) in enumerate(zip(selectors, selector_inputs)):
+            signature = (type(selector).__name__, inputs[0], tuple(np.asarray(inputs[1]).tolist()),
+                         tuple((name, tuple(t.shape)) for name, t in selector.state_dict().items()))
+            groups.setdefault(signature, {'positions': [], 'selectors': [], 'inputs': inputs})
+            groups[signature]['positions'].append(position)
+            groups[signature]['selectors'].append(selector)
+        for group in groups.values():
+            if len(group['selectors']) > 1:
+                params, buffers = stack_module_state(group['selectors'])
+                group['stacked'] = (params, buffers)
+        return list(groups.values())
+
+    def _run_selectors(self, concepts):
+        """(N, n_experts) selector outputs."""
+        n_samples = next(iter(concepts.values())).shape[0]
+        out = torch.empty(n_samples, len(self.compiled), device=self.device)
+        for group in self.selector_groups:
+            key, selected = group['inputs']
+            C = concepts[key][:, selected]
+            if 'stacked' in group:
+                params, buffers = group['stacked']
+                base = group['selectors'][0]
+
+                def call(p, b, x):
+                    return functional_call(base, (p, b), (x,))
+
+                group_out = torch.vmap(call, in_dims=(0, 0, None))(params, buffers, C)
+                out[:, group['positions']] = group_out.reshape(len(group['positions']), n_samples).T
+            else:
+                out[:, group['positions'][0]] = group['selectors'][0](C).reshape(-1)
+        return out
+
+    def __call__(self, X):
+        """
+        Predict the batch `X`. Returns a dict with
+            y_pred: (N,) predicted classes
+            expert: (N,) id of the expert (1-based) used for every sample
+            out_selector: (N, n_experts) outputs of all selectors
+            decision_path: DecisionPath over the node ids of the combined tree of every
+                sample's expert, with the features tested along it
+        """
+        with torch.no_grad():
+            X = X.to(self.device)
+            concepts = {key: torch.sigmoid(predictor(X)) for key, predictor in self.predictors.items()}
+            out_selector = self._run_selectors(concepts)
+
+            thresholds = torch.as_tensor(self.selection_thresholds, dtype=out_selector.dtype,
+                                         device=out_selector.device)
+            accepted = out_selector >= thresholds
+            # first accepting expert of every sample
+            first = accepted.to(torch.uint8).argmax(dim=1)
+            routed = accepted.any(dim=1)
+            expert_position = torch.where(routed, first, torch.full_like(first, -1)).cpu().numpy()
+            concepts = {key: value.cpu().numpy() for key, value in concepts.items()}
+            out_selector = out_selector.cpu().numpy()
+
+        n_samples = len(expert_position)
+        y_pred = np.full(n_samples, -1, dtype=np.int64)
+        path_samples, path_nodes, node_ids, features = [], [], [], []
+        for position, compiled in enumerate(self.compiled):
+            rows = np.flatnonzero(expert_position == position)
+            if rows.size == 0:
+                continue
+            inputs = {name: concepts[key][rows][:, selected] for name, (key, selected) in self.inputs[position].items()}
+            inputs['hard'] = (inputs['hard'] >= 0.5).astype(inputs['hard'].dtype)
+            y_rows, samples, nodes = compiled.predict(inputs['hard'], inputs['seq'], inputs['joint'])
+            y_pred[rows] = y_rows
+            path_samples.append(rows[samples])
+            path_nodes.append(nodes)
+            node_ids.append(compiled.tree.node_columns()[nodes])
+            features.append(np.where(compiled.is_split[nodes], compiled.tree.feature[nodes], -1))
+
+        expert = np.where(expert_position >= 0,
+                          np.asarray(self.expert_ids)[np.maximum(expert_position, 0)], -1)
+        return {'y_pred': y_pred, 'expert': expert, 'out_selector': out_selector,
+                'decision_path': self._decision_path(n_samples, path_samples, node_ids, features)}
+
+    def _decision_path(self, n_samples, path_samples, node_ids, features):
+        samples = np.concatenate([np.zeros(0, dtype=np.int64)] + path_samples)
+        node_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + node_ids)
+        features = np.concatenate([np.zeros(0, dtype=np.int64)] + features)
+        # stable sort keeps the root-to-leaf order within every sample
+        order = np.argsort(samples, kind='stable')
+        samples, node_ids, features = samples[order], node_ids[order], features[order]
+
+        node_indptr = np.zeros(n_samples + 1, dtype=np.int32)
+        np.cumsum(np.bincount(samples, minlength=n_samples), out=node_indptr[1:])
+        is_split = features >= 0
+        feature_indptr = np.zeros(n_samples + 1, dtype=np.int32)
+        np.cumsum(np.bincount(samples[is_split], minlength=n_samples), out=feature_indptr[1:])
+        return DecisionPath((np.ones(len(node_ids), dtype=np.int64), node_ids.astype(np.int32), node_indptr),
+                            shape=(n_samples, self.n_columns),
+                            feature_indices=features[is_split].astype(np.int32),
+                            feature_indptr=feature_indptr)
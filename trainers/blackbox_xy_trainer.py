@@ -3,6 +3,7 @@ from matplotlib import pyplot as plt
 
 from epoch_trainers.xy_epoch_trainer import XY_Epoch_Trainer
 from epoch_trainers.xy_epoch_tree_trainer import XY_Epoch_Tree_Trainer
+from utils.util import dataset_column
 
 
 class BlackBoxXYTrainer:
@@ -93,11 +94,11 @@ class BlackBoxXYTrainer:
 
     def create_xy_dataloaders(self):
 
-        if isinstance(self.data_loader.dataset, torch.utils.data.TensorDataset):
-            all_X = self.data_loader.dataset[:][0]
-            all_y = self.data_loader.dataset[:][2]
-            all_X_val = self.valid_data_loader.dataset[:][0]
-            all_y_val = self.valid_data_loader.dataset[:][2]
+        if not hasattr(self.data_loader.dataset, 'get_all_data_in_tensors'):
+            all_X = dataset_column(self.data_loader.dataset, 0)
+            all_y = dataset_column(self.data_loader.dataset, 2)
+            all_X_val = dataset_column(self.valid_data_loader.dataset, 0)
+            all_y_val = dataset_column(self.valid_data_loader.dataset, 2)
             train_dataset = torch.utils.data.TensorDataset(all_X, all_y)
             val_dataset = torch.utils.data.TensorDataset(all_X_val, all_y_val)
             train_data_loader = torch.utils.data.DataLoader(
@@ -118,16 +119,16 @@ class BlackBoxXYTrainer:
 
     def get_xy_test_dataloader(self, test_data_loader, batch_size):
 
-        if isinstance(test_data_loader.dataset, torch.utils.data.TensorDataset):
-            X = test_data_loader.dataset[:][0]
-            y = test_data_loader.dataset[:][2]
+        if not hasattr(test_data_loader.dataset, 'get_all_data_in_tensors'):
+            X = dataset_column(test_data_loader.dataset, 0)
+            y = dataset_column(test_data_loader.dataset, 2)
             test_data_loader = torch.utils.data.DataLoader(
                 torch.utils.data.TensorDataset(X, y),
                 batch_size=batch_size,
                 shuffle=False
             )
         else:
-            raise ValueError("Only TensorDataset is supported for now")
+            raise ValueError("Only TensorDataset and sharded datasets are supported for now")
 
         return test_data_loader
 
@@ -10,7 +10,9 @@ from sklearn.metrics import accuracy_score
 
 from epoch_trainers.xc_epoch_trainer import XC_Epoch_Trainer
 from networks.custom_dt_gini_with_entropy_metrics import \
-    build_combined_tree, CustomDecisionTree
+    build_combined_tree, CustomDecisionTree, fit_leaf_trees
+from utils.util import dataset_column, get_subset_column, get_subset_loader
+from utils.concept_cache import ConceptPredictionCache
 from utils.tree_utils import get_light_colors, get_leaf_samples_and_features, \
     get_decision_path_features_and_thresholds
 
@@ -50,6 +52,12 @@ class HierarchicalLeakageTrainervC:
             self.device, self.data_loader,
             self.valid_data_loader)
 
+        # concept probabilities of whole splits, every leaf gathers its samples from them;
+        # kept in the run directory unless a shared concept_cache_dir is configured
+        cache_dir = config['trainer'].get('concept_cache_dir',
+                                          os.path.join(config.save_dir, 'concept_cache'))
+        self.concept_cache = ConceptPredictionCache(cache_dir, extra_key=self.arch.selected_concepts)
+
     def train(self):
 
         save_dicts = self.config["trainer"]["save_train_tensors"]
@@ -88,12 +96,10 @@ class HierarchicalLeakageTrainervC:
         leaf_samples_indices_val, leaf_features_per_path_val = get_leaf_samples_and_features(self.arch.label_predictor, all_C_val)
 
         # evaluate x->c
-        train_C_pred, train_y = self.xc_epoch_trainer._predict(data_loader=self.data_loader, use_data_loader=True)
-        val_C_pred, val_y = self.xc_epoch_trainer._predict(data_loader=self.valid_data_loader, use_data_loader=True)
-        train_C_pred = train_C_pred.detach().cpu().numpy()
-        train_y = train_y.detach().cpu().numpy()
-        val_C_pred = val_C_pred.detach().cpu().numpy()
-        val_y = val_y.detach().cpu().numpy()
+        train_C_pred = self.predict_subset_concepts(self.data_loader, np.arange(len(all_y)), 'train')
+        train_y = all_y
+        val_C_pred = self.predict_subset_concepts(self.valid_data_loader, np.arange(len(all_y_val)), 'val')
+        val_y = all_y_val
 
         # print("\nTraining soft c->y DT label predictor")
         # logger.info("\nTraining soft c->y DT label predictor")
@@ -196,14 +202,13 @@ class HierarchicalLeakageTrainervC:
         y_all = []
         for leaf, sample_indices in leaf_samples_indices.items():
             C_leaf, y_leaf = tensor_C_binary_pred[sample_indices], tensor_y[sample_indices]
-            X_leaf = self.extract_x_subset_data(test_data_loader, sample_indices)
             y_original_pred = self.arch.label_predictor.predict(C_leaf)
             cbm_used = self.leaf_cbm_used[leaf]
             if cbm_used == 'seq':
                 self.xc_epoch_trainer.model.concept_predictor = self.arch.concept_predictor
             else:
                 self.xc_epoch_trainer.model.concept_predictor = self.arch.concept_predictor_joint
-            C_leaf_pred = self.xc_epoch_trainer._predict(X=X_leaf, use_data_loader=False)
+            C_leaf_pred = self.predict_subset_concepts(test_data_loader, sample_indices, 'test')
             leaf_features_not_used = list(set(range(self.num_concepts)) - set(leaf_features_per_path[leaf]))
             hard_concepts = C_leaf[:, leaf_features_not_used]
             C_leaf_pred[:, leaf_features_not_used] = hard_concepts
@@ -227,7 +232,7 @@ class HierarchicalLeakageTrainervC:
                 y_leaf_dict[leaf] = y_leaf
                 y_original_pred_dict[leaf] = y_original_pred
                 y_pred_dict[leaf] = y_pred
-                X_leaf_dict[leaf] = X_leaf
+                X_leaf_dict[leaf] = self.extract_x_subset_data(test_data_loader, sample_indices)
 
         if save_dicts:
             # save C_leaf_pred and y_leaf per leaf
@@ -399,35 +404,39 @@ class HierarchicalLeakageTrainervC:
 
     def extract_cy_data(self):
 
-        if isinstance(self.data_loader.dataset, torch.utils.data.TensorDataset):
-            all_C = self.data_loader.dataset[:][1]
-            all_y = self.data_loader.dataset[:][2]
-            all_C_val = self.valid_data_loader.dataset[:][1]
-            all_y_val = self.valid_data_loader.dataset[:][2]
-        else:
-            all_C, all_y = self.data_loader.dataset.get_all_data_in_tensors(
-                batch_size=self.config["data_loader"]["args"]["batch_size"], shuffle=True,
-                return_loader=False
-            )
-            all_C_val, all_y_val = self.valid_data_loader.dataset.get_all_data_in_tensors(
-                batch_size=self.config["data_loader"]["args"]["batch_size"], shuffle=False,
-                return_loader=False
-            )
+        # concepts and labels only, without loading the images of CUB / sharded datasets
+        all_C = dataset_column(self.data_loader.dataset, 1)
+        all_y = dataset_column(self.data_loader.dataset, 2)
+        all_C_val = dataset_column(self.valid_data_loader.dataset, 1)
+        all_y_val = dataset_column(self.valid_data_loader.dataset, 2)
 
         return all_C, all_y, all_C_val, all_y_val
 
     def extract_x_subset_data(self, dataloader, subset_indices):
 
         if isinstance(dataloader.dataset, torch.utils.data.TensorDataset):
-            X = dataloader.dataset[:][0][subset_indices]
+            X = dataloader.dataset.tensors[0][subset_indices]
         else:
-            X = []
-            for i, sample in enumerate(dataloader.dataset.data):
-                if i in subset_indices:
-                    X.append(dataloader.dataset.__getitem__(i)[0])
-            X = torch.stack(X)
+            X = get_subset_column(dataloader, subset_indices, index=0,
+                                  num_workers=self.config["trainer"].get("subset_num_workers", 0))
         return X
 
+    def predict_subset_concepts(self, dataloader, subset_indices, split):
+        """Concept probabilities for the samples `subset_indices` of `dataloader`, as a numpy array.
+
+        They are gathered from the probabilities of the whole split, which are computed once per
+        concept predictor and cached on disk.
+        """
+        return self.concept_cache.gather(self.xc_epoch_trainer.model.concept_predictor, split,
+                                         dataloader, subset_indices, self._predict_split_concepts)
+
+    def _predict_split_concepts(self, dataloader):
+        # index-ordered pass over all samples, the train loader shuffles and drops the last batch
+        split_loader = get_subset_loader(dataloader, np.arange(len(dataloader.dataset)),
+                                         num_workers=self.config["trainer"].get("subset_num_workers", 0))
+        C_pred, _ = self.xc_epoch_trainer._predict(data_loader=split_loader, use_data_loader=True)
+        return C_pred.detach().cpu().numpy()
+
     def _fit_subtrees(self, path_name=None, save_dicts=False, logger=None,
                       leaf_samples_indices=None, leaf_features_per_path=None,
                       leaf_samples_indices_val=None, leaf_features_per_path_val=None,
@@ -435,8 +444,6 @@ class HierarchicalLeakageTrainervC:
                       train_C_pred=None, train_y=None, val_C_pred=None, val_y=None,
                       original_tree=None, thresholds_per_path=None):
 
-        leaf_trees = {}
-
         if save_dicts:
             new_leaves_per_leaf_samples_indices = {}
             new_leaves_per_leaf_features_per_path = {}
@@ -447,11 +454,12 @@ class HierarchicalLeakageTrainervC:
             y_pred_dict = {}
             X_leaf_dict = {}
 
+        C_leaf_pred_per_leaf = {}
+        y_original_pred_per_leaf = {}
         for leaf, sample_indices in leaf_samples_indices.items():
             C_leaf, y_leaf = all_C[sample_indices], all_y[sample_indices]
-            X_leaf = self.extract_x_subset_data(self.data_loader,sample_indices)
-            y_original_pred = original_tree.predict(C_leaf)
-            C_leaf_pred = self.xc_epoch_trainer._predict(X=X_leaf, use_data_loader=False)
+            y_original_pred_per_leaf[leaf] = original_tree.predict(C_leaf)
+            C_leaf_pred = self.predict_subset_concepts(self.data_loader, sample_indices, 'train')
             leaf_features_not_used = list(set(range(self.num_concepts)) - set(leaf_features_per_path[leaf]))
             hard_concepts = C_leaf[:, leaf_features_not_used]
             C_leaf_pred[:, leaf_features_not_used] = hard_concepts
@@ -460,21 +468,33 @@ class HierarchicalLeakageTrainervC:
                     C_leaf_pred[C_leaf_pred[:, feature_idx] < 0.5, feature_idx] = 0.5
                 else:
                     C_leaf_pred[C_leaf_pred[:, feature_idx] >= 0.5, feature_idx] = 0.5
+            C_leaf_pred_per_leaf[leaf] = C_leaf_pred
+
+        # the per-leaf fits are independent, so they can run in a process pool
+        n_jobs = self.config["trainer"].get("n_jobs", 1)
+        print(f"\n {path_name}: Training soft c->y DT label predictors for {len(C_leaf_pred_per_leaf)} leaves (n_jobs={n_jobs})")
+        logger.info(f"\n {path_name}: Training soft c->y DT label predictors for {len(C_leaf_pred_per_leaf)} leaves (n_jobs={n_jobs})")
+        leaf_trees = fit_leaf_trees(
+            {leaf: (C_leaf_pred_per_leaf[leaf], all_y[sample_indices])
+             for leaf, sample_indices in leaf_samples_indices.items()},
+            n_classes=self.config["dataset"]["num_classes"],
+            min_samples_leaf=self.config["regularisation"]["min_samples_leaf"],
+            n_jobs=n_jobs)
 
-            print(f"\n {path_name}: Training soft c->y DT label predictor for leaf: {leaf}")
-            logger.info(f"\n {path_name}: Training soft c->y DT label predictor for leaf: {leaf}")
-            tree = CustomDecisionTree(min_samples_leaf=self.config["regularisation"]["min_samples_leaf"],
-                                      n_classes=self.config["dataset"]["num_classes"]
-            )
-            tree.fit(C_leaf_pred, y_leaf)
+        for leaf, sample_indices in leaf_samples_indices.items():
+            C_leaf, y_leaf = all_C[sample_indices], all_y[sample_indices]
+            C_leaf_pred = C_leaf_pred_per_leaf[leaf]
+            y_original_pred = y_original_pred_per_leaf[leaf]
+            tree = leaf_trees[leaf]
             y_pred = tree.predict(C_leaf_pred)
+            print(f"\n {path_name}: Trained soft c->y DT label predictor for leaf: {leaf}")
+            logger.info(f"\n {path_name}: Trained soft c->y DT label predictor for leaf: {leaf}")
             print(f' {path_name}: Training Accuracy of the original path: {accuracy_score(y_leaf, y_original_pred)}')
             print(f' {path_name}: Training Accuracy of the new path: {accuracy_score(y_leaf, y_pred)}')
             logger.info(f' {path_name}: Training Accuracy of the original path: {accuracy_score(y_leaf, y_original_pred)}')
             logger.info(f' {path_name}: Training Accuracy of the new path: {accuracy_score(y_leaf, y_pred)}')
 
             # prune(self.arch.label_predictor.tree_)
-            leaf_trees[leaf] = tree
             self._visualize_DT_label_predictor(tree, path=f'/{path_name}/leaf_{leaf}')
 
             if save_dicts:
@@ -486,7 +506,7 @@ class HierarchicalLeakageTrainervC:
                 y_leaf_dict[leaf] = y_leaf
                 y_original_pred_dict[leaf] = y_original_pred
                 y_pred_dict[leaf] = y_pred
-                X_leaf_dict[leaf] = X_leaf
+                X_leaf_dict[leaf] = self.extract_x_subset_data(self.data_loader, sample_indices)
 
         if save_dicts:
             # save C_leaf_pred and y_leaf per leaf
@@ -517,10 +537,8 @@ class HierarchicalLeakageTrainervC:
 
         for leaf, sample_indices in leaf_samples_indices_val.items():
             C_leaf_val, y_leaf_val = all_C_val[sample_indices], all_y_val[sample_indices]
-            X_leaf_val = self.extract_x_subset_data(self.valid_data_loader, sample_indices)
             y_original_pred = original_tree.predict(C_leaf_val)
-            C_leaf_val_pred = self.xc_epoch_trainer._predict(X=X_leaf_val,
-                                                             use_data_loader=False)
+            C_leaf_val_pred = self.predict_subset_concepts(self.valid_data_loader, sample_indices, 'val')
             leaf_features_not_used_val = list(
                 set(range(self.num_concepts)) - set(
                     leaf_features_per_path_val[leaf]))
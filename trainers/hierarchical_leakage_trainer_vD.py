@@ -1,8 +1,11 @@
+import numpy as np
 import torch
 from sklearn.metrics import accuracy_score
 
 from trainers import IndependentCBMTrainer, HierarchicalLeakageTrainervC, \
     SequentialCBMTrainer
+from networks.hierarchical_inference import HierarchicalExpertsInference
+from utils.util import get_subset_loader
 import importlib
 import copy
 
@@ -22,9 +25,27 @@ class HierarchicalLeakageTrainervD:
 
         self.num_experts = self.config['trainer']['num_experts']
         self.coverage_per_expert = self.config['selectivenet']['coverage']
+        # thresholds retuned from the saved risk-coverage curves (risk_coverage_<mode>.json
+        # of every expert), instead of the common selection_threshold
+        self.selection_threshold_per_expert = self.config['selectivenet'].get('selection_thresholds')
+        # coverages to retune the trained experts to before testing
+        self.target_coverages = self.config['selectivenet'].get('target_coverages')
         self.experts_selectivenet = {}
         self.experts_leakage_inspection = {}
 
+        # every expert sees index views of the dataset of one base loader per split: the
+        # samples it accepts / rejects are index arrays into it, so no images are copied per expert
+        self.base_loaders = {'train': data_loader, 'valid': valid_data_loader}
+        self.remaining_indices = {split: np.arange(len(loader.dataset))
+                                  for split, loader in self.base_loaders.items()}
+        # expert -> split -> {'acc': indices, 'rej': indices} into the base datasets
+        self.routing = {}
+
+    def _subset_loader(self, split, indices, shuffle=False):
+        return get_subset_loader(self.base_loaders[split], indices,
+                                 batch_size=self.config['data_loader']['args']['batch_size'],
+                                 shuffle=shuffle)
+
     def train(self):
 
         for expert in range(1, self.num_experts + 1):
@@ -33,21 +54,48 @@ class HierarchicalLeakageTrainervD:
     def test(self, test_data_loader, hard_cbm=False):
 
         logger = self.config.get_logger('trainer')
+        if self.target_coverages is not None:
+            self.retune_thresholds(self.target_coverages)
         y_all = []
         y_pred_all = []
+        self.base_loaders['test'] = test_data_loader
+        test_indices = np.arange(len(test_data_loader.dataset))
         for expert in range(1, self.num_experts + 1):
-            test_data_loader, y, y_pred = self.test_expert(expert, test_data_loader)
+            test_indices, y, y_pred = self.test_expert(expert, test_indices)
             y_all.extend(y)
             y_pred_all.extend(y_pred)
+            if len(test_indices) == 0:
+                break
 
         print(f'\nTest Accuracy of the complete algorithm: {accuracy_score(y_all, y_pred_all)}')
         logger.info(f'\nTest Accuracy of the complete algorithm: {accuracy_score(y_all, y_pred_all)}')
 
+    def retune_thresholds(self, target_coverages, mode='valid'):
+        """
+        Set the selection threshold of every trained expert to the one calibrated for its
+        coverage in `target_coverages`, from the risk-coverage curve saved for `mode`.
+        The experts are not retrained: test and compile_inference route with the new thresholds.
+        """
+        logger = self.config.get_logger('trainer')
+        thresholds = []
+        for expert in sorted(self.experts_selectivenet):
+            logger.info(f'Expert {expert} - Retuning the selection threshold ...')
+            print(f'\nExpert {expert} - Retuning the selection threshold ...')
+            cy_epoch_trainer = self.experts_selectivenet[expert].cy_epoch_trainer
+            calibrated = cy_epoch_trainer.retune_selection_threshold(target_coverages[expert-1], mode=mode)
+            thresholds.append(calibrated['threshold'])
+        self.selection_threshold_per_expert = thresholds
+        return thresholds
+
+    def compile_inference(self):
+        """Batched inference object of the trained experts, see HierarchicalExpertsInference."""
+        return HierarchicalExpertsInference.from_trainer(self)
+
     def train_expert(self, expert):
 
         if expert > 1:
-            train_loader = self.train_data_loader
-            valid_loader = self.valid_data_loader
+            train_loader = self._subset_loader('train', self.remaining_indices['train'], shuffle=True)
+            valid_loader = self._subset_loader('valid', self.remaining_indices['valid'])
             arch = self.init_selectivenet_module(train_loader)
         else:
             arch = self.arch
@@ -58,6 +106,9 @@ class HierarchicalLeakageTrainervD:
         config = copy.deepcopy(self.config)
         config._main_config["selectivenet"]["coverage"] = self.coverage_per_expert[expert-1]
         arch.criterion_label.coverage = self.coverage_per_expert[expert-1]
+        if self.selection_threshold_per_expert is not None:
+            config._main_config["selectivenet"]["selection_threshold"] = \
+                self.selection_threshold_per_expert[expert-1]
         expert_selectivenet = SequentialCBMTrainer(
             arch, config, self.device,
             train_loader, valid_loader,
@@ -76,27 +127,18 @@ class HierarchicalLeakageTrainervD:
         # arch.selector.load_state_dict(selector_state_dict)
         self.experts_selectivenet[expert] = expert_selectivenet
 
-        # get the selected train and val data
-        (tensor_X_train, tensor_C_train, tensor_y_acc_train, fi_train, tree_train,
-         tensor_X_rej_train, tensor_C_rej_train, tensor_y_rej_train,)  \
-            = expert_selectivenet.cy_epoch_trainer._save_selected_results(
-            loader=train_loader, expert=expert, mode="train", arch=arch)
-
-        (tensor_X, tensor_C, tensor_y_acc, fi, tree,
-        tensor_X_rej_val, tensor_C_rej_val, tensor_y_rej_val,) \
-            = expert_selectivenet.cy_epoch_trainer._save_selected_results(
-            loader=valid_loader, expert=expert, mode="valid", arch=arch)
-
-        # create a new dataloader with the selected samples
-        new_dataset = torch.utils.data.TensorDataset(tensor_X_train, tensor_C_train, tensor_y_acc_train)
-        new_train_data_loader = torch.utils.data.DataLoader(
-            new_dataset, batch_size=self.config['data_loader']['args']['batch_size'], shuffle=True
-        )
+        # route the samples of both splits through the selector, one index-ordered pass each
+        routing = {}
+        for split in ('train', 'valid'):
+            indices = self.remaining_indices[split]
+            acc, rej = expert_selectivenet.cy_epoch_trainer._select_indices(
+                loader=self._subset_loader(split, indices), expert=expert, mode=split, arch=arch)
+            routing[split] = {'acc': indices[acc], 'rej': indices[rej]}
+        self.routing[expert] = routing
 
-        # create a new dataloader with the selected samples
-        new_dataset = torch.utils.data.TensorDataset(tensor_X, tensor_C, tensor_y_acc)
-        new_valid_data_loader = torch.utils.data.DataLoader(
-            new_dataset, batch_size=self.config['data_loader']['args']['batch_size'], shuffle=False)
+        # views of the accepted samples
+        new_train_data_loader = self._subset_loader('train', routing['train']['acc'], shuffle=True)
+        new_valid_data_loader = self._subset_loader('valid', routing['valid']['acc'])
 
         self.logger.info('\n')
         self.logger.info(f'Expert {expert} - Performing Leakage Inspection...')
@@ -113,22 +155,16 @@ class HierarchicalLeakageTrainervD:
         expert_leakage_inspection.train()
         self.experts_leakage_inspection[expert] = expert_leakage_inspection
 
-        # create a new dataloader with the rejected samples
-        new_dataset = torch.utils.data.TensorDataset(tensor_X_rej_train, tensor_C_rej_train, tensor_y_rej_train)
-        if len(new_dataset) != 0:
-            self.train_data_loader = torch.utils.data.DataLoader(
-                new_dataset, batch_size=self.config['data_loader']['args']['batch_size'], shuffle=True
-            )
-
-        # create a new dataloader with the rejected samples
-        new_dataset = torch.utils.data.TensorDataset(tensor_X_rej_val, tensor_C_rej_val, tensor_y_rej_val)
-        if len(new_dataset) != 0:
-            self.valid_data_loader = torch.utils.data.DataLoader(
-                new_dataset, batch_size=self.config['data_loader']['args']['batch_size'], shuffle=False
-            )
-
-    def test_expert(self, expert, test_dataloader):
+        # the next expert sees the rejected samples
+        for split in ('train', 'valid'):
+            if len(routing[split]['rej']) != 0:
+                self.remaining_indices[split] = routing[split]['rej']
 
+    def test_expert(self, expert, test_indices):
+        """
+        Test `expert` on the samples `test_indices` of the test set, returns the indices of
+        the samples it rejects and the labels / predictions of those it accepts.
+        """
         self.logger = self.config.get_logger('trainer')
 
         # Get the accepted and rejected test samples of this expert
@@ -137,33 +173,20 @@ class HierarchicalLeakageTrainervD:
         print(f'\nExpert {expert} - Testing Hard CBM with SelectiveNet ...')
         cy_epoch_trainer = self.experts_selectivenet[expert].cy_epoch_trainer
 
-        (tensor_X, tensor_C, tensor_y_acc, fi, tree, tensor_X_rej, tensor_C_rej, tensor_y_rej)  \
-            = cy_epoch_trainer._get_predictions_from_selector(
-            loader=test_dataloader, expert_idx=expert, mode="test", expert=cy_epoch_trainer
-        )
-
-        # create a new dataloader with the selected samples
-        new_dataset = torch.utils.data.TensorDataset(tensor_X, tensor_C, tensor_y_acc)
-        new_data_loader = torch.utils.data.DataLoader(
-            new_dataset, batch_size=self.config['data_loader']['args']['batch_size'], shuffle=False
+        acc, rej = cy_epoch_trainer._select_indices_from_predictions(
+            loader=self._subset_loader('test', test_indices), expert_idx=expert, mode="test",
+            expert=cy_epoch_trainer
         )
+        self.routing.setdefault(expert, {})['test'] = {'acc': test_indices[acc], 'rej': test_indices[rej]}
 
         # Do leakage Inspection
         self.logger.info('\n')
         self.logger.info(f'Expert {expert} - Performing Leakage Inspection...')
         print(f'\nExpert {expert} - Performing Leakage Inspection...')
-        y, y_pred = self.experts_leakage_inspection[expert].test(new_data_loader)
-
-        # create a new dataloader with the rejected samples
-        new_dataset = torch.utils.data.TensorDataset(tensor_X_rej, tensor_C_rej, tensor_y_rej)
-        if len(new_dataset) != 0:
-            test_dataloader = torch.utils.data.DataLoader(
-                new_dataset, batch_size=self.config['data_loader']['args']['batch_size'], shuffle=True
-            )
-        else:
-            test_dataloader = None
+        y, y_pred = self.experts_leakage_inspection[expert].test(
+            self._subset_loader('test', test_indices[acc]))
 
-        return test_dataloader, y, y_pred
+        return test_indices[rej], y, y_pred
 
 
     def init_selectivenet_module(self, train_loader):
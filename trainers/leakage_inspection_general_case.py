@@ -4,6 +4,7 @@ import torch
 from sklearn.datasets import load_iris
 import pickle
 from utils.tree_utils import *
+from utils.util import dataset_column
 
 def compare_two_trees(tree_binary, tree_prob, X, X_binary, X_prob, y_binary, y_prob, y, feature_names,
                       class_names, best_feature_name, output_path):
@@ -224,7 +225,8 @@ def compare_two_trees(tree_binary, tree_prob, X, X_binary, X_prob, y_binary, y_p
 def leakage_visualizer(X, X_binary, y_binary, y, X_prob, y_prob,
                        feature_names, class_names, output_path,
                         num_trees = 1500, threshold = 0.02,
-                        min_performance = 0.5, min_samples_leaf=5):
+                        min_performance = 0.5, min_samples_leaf=5, n_jobs=1,
+                        similarity_metric='dot'):
 
     # load the ground truth concepts as X_binary
     # load the predictions of the NN as y_binary
@@ -236,14 +238,16 @@ def leakage_visualizer(X, X_binary, y_binary, y, X_prob, y_prob,
                                           num_trees=num_trees,
                                           threshold=threshold,
                                           min_performance=min_performance,
-                                          min_samples_leaf=min_samples_leaf)
+                                          min_samples_leaf=min_samples_leaf,
+                                          n_jobs=n_jobs)
 
     # collect best trees for the probabilistic tree
     unique_trees_prob = find_best_trees(X_prob, y_prob,
                                         num_trees=num_trees,
                                         threshold=threshold,
                                         min_performance=min_performance,
-                                        min_samples_leaf=min_samples_leaf)
+                                        min_samples_leaf=min_samples_leaf,
+                                        n_jobs=n_jobs)
 
     # stack the first elements of each tuple into a new list
     trees_list1 = [tree for tree, _, _ in unique_trees_binary]
@@ -251,7 +255,7 @@ def leakage_visualizer(X, X_binary, y_binary, y, X_prob, y_prob,
 
     # Find the pair of trees with the highest feature similarity
     best_pair, max_similarity, best_feature_name = find_highest_similarity_pair(
-        trees_list1, trees_list2,feature_names
+        trees_list1, trees_list2,feature_names, metric=similarity_metric
     )
 
     print(f"Total feature similarity of the best pair: {max_similarity:.4f}")
@@ -290,9 +294,9 @@ def perform_leakage_visualization(data_loader, arch, config):
 
     # make a forward pass to get the predictions using the predicted concepts
     with torch.no_grad():
-        X = data_loader.dataset[:][0]
-        y = data_loader.dataset[:][2]
-        c = data_loader.dataset[:][1]
+        X = dataset_column(data_loader.dataset, 0)
+        y = dataset_column(data_loader.dataset, 2)
+        c = dataset_column(data_loader.dataset, 1)
         c_pred = arch.model.mn_model.concept_predictor(X)
         y_pred = arch.model.mn_model.label_predictor(c_pred)
 
@@ -317,8 +321,8 @@ def perform_leakage_visualization(data_loader, arch, config):
 
     # make a forward pass to get the predictions using the predicted concepts
     with torch.no_grad():
-        y = data_loader.dataset[:][2]
-        c = data_loader.dataset[:][1]
+        y = dataset_column(data_loader.dataset, 2)
+        c = dataset_column(data_loader.dataset, 1)
         y_pred = arch_gt.model(c)
 
         if y_pred.shape[1] == 1:
@@ -344,7 +348,9 @@ def perform_leakage_visualization(data_loader, arch, config):
                        num_trees = config['explainer']['num_trees'],
                        threshold = config['explainer']['threshold'],
                        min_performance = config['explainer']['min_performance'],
-                       min_samples_leaf= config['explainer']['min_samples_leaf'])
+                       min_samples_leaf= config['explainer']['min_samples_leaf'],
+                       n_jobs=config['explainer'].get('n_jobs', 1),
+                       similarity_metric=config['explainer'].get('similarity_metric', 'dot'))
 
 
 if __name__ == "__main__":
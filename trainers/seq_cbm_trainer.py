@@ -11,6 +11,7 @@ from epoch_trainers.xc_epoch_trainer import XC_Epoch_Trainer
 from epoch_trainers.cy_epoch_trainer import CY_Epoch_Trainer
 from epoch_trainers.cy_epoch_tree_trainer import CY_Epoch_Tree_Trainer
 from utils.tree_utils import get_light_colors
+from utils.util import dataset_column
 
 
 class SequentialCBMTrainer:
@@ -261,26 +262,18 @@ class SequentialCBMTrainer:
 
     def create_cy_dataloaders(self):
 
-        if isinstance(self.data_loader.dataset, torch.utils.data.TensorDataset):
-            all_C = self.data_loader.dataset[:][1]
-            all_y = self.data_loader.dataset[:][2]
-            all_C_val = self.valid_data_loader.dataset[:][1]
-            all_y_val = self.valid_data_loader.dataset[:][2]
-            train_dataset = torch.utils.data.TensorDataset(all_C, all_y)
-            val_dataset = torch.utils.data.TensorDataset(all_C_val, all_y_val)
-            train_data_loader = torch.utils.data.DataLoader(
-                train_dataset, batch_size=self.config["data_loader"]["args"]["batch_size"], shuffle=True
-            )
-            val_data_loader = torch.utils.data.DataLoader(
-                val_dataset, batch_size=self.config["data_loader"]["args"]["batch_size"], shuffle=False
-            )
-        else:
-            train_data_loader = self.data_loader.dataset.get_all_data_in_tensors(
-                batch_size=self.config["data_loader"]["args"]["batch_size"], shuffle=True
-            )
-            val_data_loader = self.valid_data_loader.dataset.get_all_data_in_tensors(
-                batch_size=self.config["data_loader"]["args"]["batch_size"], shuffle=False
-            )
+        all_C = dataset_column(self.data_loader.dataset, 1)
+        all_y = dataset_column(self.data_loader.dataset, 2)
+        all_C_val = dataset_column(self.valid_data_loader.dataset, 1)
+        all_y_val = dataset_column(self.valid_data_loader.dataset, 2)
+        train_dataset = torch.utils.data.TensorDataset(all_C, all_y)
+        val_dataset = torch.utils.data.TensorDataset(all_C_val, all_y_val)
+        train_data_loader = torch.utils.data.DataLoader(
+            train_dataset, batch_size=self.config["data_loader"]["args"]["batch_size"], shuffle=True
+        )
+        val_data_loader = torch.utils.data.DataLoader(
+            val_dataset, batch_size=self.config["data_loader"]["args"]["batch_size"], shuffle=False
+        )
 
         return train_data_loader, val_data_loader
 
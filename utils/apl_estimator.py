@@ -0,0 +1,159 @@
+import copy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.metrics import accuracy_score
+from sklearn.tree import DecisionTreeClassifier
+
+from utils.tree_utils import weighted_node_count
+
+
+def stratified_subsample(labels, size, rng):
+    """
+    Sorted indices of about `size` samples drawn with the class proportions of `labels`,
+    keeping at least one sample of every class. All indices if `size` is None or too large.
+    """
+    n_samples = len(labels)
+    if size is None or size >= n_samples:
+        return np.arange(n_samples)
+
+    classes, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    per_class = np.maximum(1, np.floor(counts * size / n_samples).astype(int))
+
+    # shuffle, then group the samples by class (stable, so each group stays shuffled)
+    order = rng.permutation(n_samples)
+    order = order[np.argsort(inverse[order], kind='stable')]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    indices = np.concatenate([order[start:start + k] for start, k in zip(starts, per_class)])
+    return np.sort(indices)
+
+
+def tree_apl(tree, inputs, apl_type=None):
+    if apl_type == 'weighted_node_count':
+        return weighted_node_count(tree, inputs)
+    return tree.tree_.node_count
+
+
+def fit_apl_tree(inputs, preds, min_samples_leaf, apl_type=None, subsample_size=None,
+                 random_state=42, subsample_seed=None, previous=None, reuse_tolerance=None):
+    """
+    Fit the surrogate tree of (inputs, preds) and return APL, fidelity, feature importances,
+    the tree and whether `previous` was reused.
+
+    previous: (tree, fidelity when it was fitted). It is reused, without fitting, if its
+    fidelity on the new predictions dropped by at most `reuse_tolerance`.
+    subsample_size: fit on a stratified subsample of that size, with `min_samples_leaf`
+    scaled down accordingly (drawn with `subsample_seed`, default `random_state`).
+    APL and fidelity are always measured on all samples.
+    """
+    if previous is not None and reuse_tolerance is not None:
+        previous_tree, previous_fid = previous
+        fid = accuracy_score(preds, previous_tree.predict(inputs))
+        if previous_fid - fid <= reuse_tolerance:
+            return (tree_apl(previous_tree, inputs, apl_type), fid,
+                    list(previous_tree.feature_importances_), previous_tree, True)
+
+    rng = np.random.default_rng(random_state if subsample_seed is None else subsample_seed)
+    indices = stratified_subsample(preds, subsample_size, rng)
+    if len(indices) < len(preds) and isinstance(min_samples_leaf, (int, np.integer)):
+        # keep the leaves as coarse as on the full data
+        min_samples_leaf = max(1, int(round(min_samples_leaf * len(indices) / len(preds))))
+
+    tree = DecisionTreeClassifier(min_samples_leaf=min_samples_leaf, random_state=random_state)
+    tree.fit(inputs[indices], preds[indices])
+    fid = accuracy_score(preds, tree.predict(inputs))
+    return tree_apl(tree, inputs, apl_type), fid, list(tree.feature_importances_), tree, False
+
+
+class APLEstimator:
+    """
+    APL / fidelity / feature importance of the surrogate tree of a network, for repeated
+    calls on the predictions of successive epochs.
+
+    By default every call fits a new tree on all samples, as EpochTrainerBase._calculate_APL
+    always did. With `subsample_size` the tree is fitted on a stratified subsample, and with
+    `reuse_tolerance` the tree of the previous fit is kept (for at most `max_reuse`
+    consecutive calls) as long as it still explains the new predictions, i.e. its fidelity
+    dropped by at most `reuse_tolerance` since it was fitted.
+    Fits can run asynchronously through AsyncAPLPipeline.
+    """
+
+    def __init__(self, min_samples_leaf, apl_type=None, subsample_size=None,
+                 reuse_tolerance=None, max_reuse=5, random_state=42):
+        self.min_samples_leaf = min_samples_leaf
+        self.apl_type = apl_type
+        self.subsample_size = subsample_size
+        self.reuse_tolerance = reuse_tolerance
+        self.max_reuse = max_reuse
+        self.random_state = random_state
+        self.n_fits = 0
+        self.n_reused = 0
+        # fits requested so far, the subsample seed of every fit is drawn from it
+        self.n_requests = 0
+        self._tree = None
+        self._fit_fid = None
+
+    def estimate(self, inputs, preds):
+        """APL, fidelity, feature importances and tree for numpy `inputs` and hard `preds`."""
+        return self.record(*fit_apl_tree(inputs, preds, **self.fit_kwargs()))
+
+    def fit_kwargs(self):
+        """Keyword arguments of fit_apl_tree for the next estimate, except the data."""
+        subsample_seed = self.random_state + self.n_requests
+        self.n_requests += 1
+        previous = None
+        if self.reuse_tolerance is not None and self._tree is not None and self.n_reused < self.max_reuse:
+            previous = (self._tree, self._fit_fid)
+        return dict(min_samples_leaf=self.min_samples_leaf,
+                    apl_type=self.apl_type,
+                    subsample_size=self.subsample_size,
+                    random_state=self.random_state,
+                    subsample_seed=subsample_seed,
+                    previous=previous,
+                    reuse_tolerance=self.reuse_tolerance)
+
+    def record(self, APL, fid, fi, tree, reused):
+        """Update the reuse state with the result of fit_apl_tree and return APL, fid, fi, tree."""
+        if reused:
+            self.n_reused += 1
+            # callers may prune the returned tree, keep the stored one intact
+            return APL, fid, fi, copy.deepcopy(tree)
+
+        self.n_fits += 1
+        self.n_reused = 0
+        if self.reuse_tolerance is not None:
+            self._tree = copy.deepcopy(tree)
+            self._fit_fid = fid
+        return APL, fid, fi, tree
+
+class AsyncAPLPipeline:
+    """
+    Surrogate tree fits in a process pool, so that training never waits on sklearn.
+
+    `submit` sends fit_apl_tree for the current state of an APLEstimator (reusing the
+    tree of its latest collected fit) together with a context, e.g. the epoch and mode
+    the predictions belong to. `collect` returns (context, (APL, fid, fi, tree)) of the
+    finished jobs in submission order, stopping at the first unfinished one unless `wait`.
+    """
+
+    def __init__(self, max_workers=1):
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._pending = deque()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, estimator, inputs, preds, **context):
+        future = self._executor.submit(fit_apl_tree, inputs, preds, **estimator.fit_kwargs())
+        self._pending.append((future, estimator, context))
+
+    def collect(self, wait=False):
+        results = []
+        while self._pending and (wait or self._pending[0][0].done()):
+            future, estimator, context = self._pending.popleft()
+            results.append((context, estimator.record(*future.result())))
+        return results
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
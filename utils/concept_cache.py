@@ -0,0 +1,106 @@
+import hashlib
+import os
+import uuid
+import weakref
+
+import numpy as np
+import torch
+
+from utils.util import dataset_column
+
+
+def checkpoint_hash(model, extra=None):
+    """md5 of the parameters and buffers of `model` (and of `extra`, e.g. the selected concepts)."""
+    md5 = hashlib.md5()
+    for name, tensor in model.state_dict().items():
+        md5.update(name.encode())
+        md5.update(tensor.detach().cpu().numpy().tobytes())
+    if extra is not None:
+        md5.update(repr(extra).encode())
+    return md5.hexdigest()
+
+
+def dataset_digest(dataset):
+    """
+    md5 identifying the samples of `dataset`: its length, the indices of Subset views
+    and the C / y columns. Datasets without column access get a digest unique to this
+    call, so their cache entries are never shared.
+    """
+    md5 = hashlib.md5()
+    md5.update(f'{type(dataset).__name__}:{len(dataset)}'.encode())
+    base = dataset
+    while isinstance(base, torch.utils.data.Subset):
+        md5.update(np.asarray(base.indices, dtype=np.int64).tobytes())
+        base = base.dataset
+    try:
+        for column in (1, 2):
+            md5.update(dataset_column(dataset, column).detach().cpu().numpy().tobytes())
+    except ValueError:
+        md5.update(uuid.uuid4().bytes)
+    return md5.hexdigest()
+
+
+class ConceptPredictionCache:
+    """
+    Concept probabilities per (concept predictor checkpoint hash, split, dataset digest,
+    sample index).
+
+    The probabilities of a whole split are computed once and stored as a .npy file
+    in `cache_dir`, which is memory-mapped on later accesses, so reruns and later
+    experts that use the same concept predictor reuse it. Predictions for a subset
+    of the samples are then a gather from the cached matrix.
+    The checkpoint hash of a model is computed on its first use, so a model must not
+    be trained further while the cache is in use (or `invalidate` must be called).
+    Hashes and digests are held by weak reference to the model / dataset, so they are
+    dropped with it and never reused for another object.
+    The dataset digest (see dataset_digest) keeps datasets or subsets of equal length
+    apart, e.g. the samples routed to different experts.
+    """
+
+    def __init__(self, cache_dir, extra_key=None):
+        self.cache_dir = cache_dir
+        self.extra_key = extra_key
+        self._hashes = weakref.WeakKeyDictionary()
+        self._digests = weakref.WeakKeyDictionary()
+        self._matrices = {}
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get(self, model, split, data_loader, predict_fn):
+        """
+        Return the (n_samples, n_concepts) memory-mapped probabilities of `split`.
+        `predict_fn(data_loader)` must return them as a numpy array in dataset order,
+        it is only called on a cache miss.
+        """
+        if model not in self._hashes:
+            self._hashes[model] = checkpoint_hash(model, extra=self.extra_key)
+        dataset = data_loader.dataset
+        if dataset not in self._digests:
+            self._digests[dataset] = dataset_digest(dataset)
+        key = (self._hashes[model], split, self._digests[dataset])
+        if key not in self._matrices:
+            file_name = os.path.join(self.cache_dir, '{}_{}_{}.npy'.format(*key))
+            if not os.path.exists(file_name):
+                C_pred = np.asarray(predict_fn(data_loader), dtype=np.float32)
+                # write to a temporary file first, so that an interrupted run leaves no partial cache
+                tmp_file_name = file_name[:-len('.npy')] + f'.tmp{os.getpid()}.npy'
+                cached = np.lib.format.open_memmap(tmp_file_name, mode='w+',
+                                                   dtype=C_pred.dtype, shape=C_pred.shape)
+                cached[:] = C_pred
+                cached.flush()
+                del cached
+                os.replace(tmp_file_name, file_name)
+            self._matrices[key] = np.load(file_name, mmap_mode='r')
+        return self._matrices[key]
+
+    def gather(self, model, split, data_loader, indices, predict_fn):
+        """Writable copy of the cached probabilities of the samples `indices` of `split`."""
+        return np.array(self.get(model, split, data_loader, predict_fn)[indices])
+
+    def invalidate(self, model=None):
+        """Forget the checkpoint hash of `model` (or of all models), e.g. after training it further."""
+        if model is None:
+            self._hashes = weakref.WeakKeyDictionary()
+        else:
+            self._hashes.pop(model, None)
+        self._matrices = {}
@@ -0,0 +1,96 @@
+import torch
+
+
+class EpochBuffer:
+    """
+    Preallocated per-sample storage for the outputs of one pass over a data loader.
+
+    Replaces growing tensors with torch.cat on every batch (quadratic copying per epoch).
+    Every field is allocated on its first `append`, for `capacity` samples (typically
+    len(loader.dataset)) and with the dtype / device of its first batch, and batches are
+    then written by slice assignment. The stored values are detached from the graph.
+    The storage is kept across `reset`, so one buffer can be reused for every epoch.
+
+    Samples can also be assigned to partitions (e.g. accepted / rejected by a selector)
+    through a boolean mask per batch. The buffer then records the index list of each
+    partition and `get(name, partition)` gathers only its samples, in loader order.
+    """
+
+    def __init__(self, capacity, dtypes=None):
+        self.capacity = capacity
+        self.dtypes = dtypes if dtypes is not None else {}
+        self.size = 0
+        self._fields = {}
+        self._partition_batches = {}
+        self._partition_indices = {}
+
+    @classmethod
+    def from_loader(cls, data_loader, dtypes=None):
+        return cls(len(data_loader.dataset), dtypes=dtypes)
+
+    def reset(self):
+        """Start a new pass, keeping the allocated storage."""
+        self.size = 0
+        self._partition_batches = {}
+        self._partition_indices = {}
+
+    def append(self, partitions=None, **batches):
+        """
+        Write one batch of every field, e.g. append(C=C_batch, y_pred=y_pred).
+        `partitions` maps a partition name to a boolean mask over the batch.
+        """
+        batch_size = next(iter(batches.values())).size(0)
+        start, end = self.size, self.size + batch_size
+        if end > self.capacity:
+            # e.g. a sampler drawing with replacement, grow geometrically
+            self._grow(max(end, 2 * self.capacity))
+
+        for name, batch in batches.items():
+            if batch.size(0) != batch_size:
+                raise ValueError(f'Field {name} has {batch.size(0)} samples, expected {batch_size}')
+            if name not in self._fields:
+                self._fields[name] = torch.empty((self.capacity,) + tuple(batch.shape[1:]),
+                                                 dtype=self.dtypes.get(name, batch.dtype),
+                                                 device=batch.device)
+            self._fields[name][start:end] = batch.detach()
+
+        if partitions is not None:
+            for partition, mask in partitions.items():
+                indices = torch.nonzero(mask.reshape(-1), as_tuple=True)[0]
+                self._partition_batches.setdefault(partition, []).append(indices + start)
+                self._partition_indices.pop(partition, None)
+
+        self.size = end
+
+    def indices(self, partition):
+        """Buffer positions of the samples of `partition`, in loader order."""
+        if partition not in self._partition_indices:
+            batches = self._partition_batches.get(partition, [])
+            if len(batches) == 0:
+                device = next(iter(self._fields.values())).device if self._fields else None
+                self._partition_indices[partition] = torch.empty(0, dtype=torch.long, device=device)
+            else:
+                self._partition_indices[partition] = torch.cat(batches)
+        return self._partition_indices[partition]
+
+    def count(self, partition):
+        return self.indices(partition).numel()
+
+    def get(self, name, partition=None):
+        """
+        The filled part of field `name` (a view of the storage, overwritten after `reset`),
+        or a copy holding only the samples of `partition`.
+        """
+        if name not in self._fields:
+            raise ValueError(f'Field {name} was never written to the buffer')
+        data = self._fields[name][:self.size]
+        if partition is None:
+            return data
+        return data[self.indices(partition).to(data.device)]
+
+    def _grow(self, capacity):
+        for name, data in self._fields.items():
+            grown = torch.empty((capacity,) + tuple(data.shape[1:]), dtype=data.dtype, device=data.device)
+            grown[:self.size] = data[:self.size]
+            self._fields[name] = grown
+        self.capacity = capacity
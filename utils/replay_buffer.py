@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+
+class SurrogateReplayBuffer:
+    """
+    Bounded training set of (prediction vector, APL) pairs for the surrogate of the
+    Sequential tree regularisation, stored in tensors preallocated for `capacity` pairs.
+
+    Once full, a new pair either replaces a uniformly chosen slot with probability
+    capacity / n_seen ('reservoir', the buffer stays a uniform sample of every pair
+    added so far) or the oldest pair ('recency').
+    """
+
+    def __init__(self, capacity, eviction='reservoir', seed=42):
+        if eviction not in ('reservoir', 'recency'):
+            raise ValueError(f'Unknown eviction policy: {eviction}')
+        self.capacity = capacity
+        self.eviction = eviction
+        self.size = 0
+        self.n_seen = 0
+        self._rng = np.random.default_rng(seed)
+        self._preds = None
+        self._APLs = None
+
+    def __len__(self):
+        return self.size
+
+    def add(self, preds, APL):
+        preds = preds.detach().reshape(-1)
+        if self._preds is None:
+            self._preds = torch.empty((self.capacity, preds.numel()), dtype=preds.dtype, device=preds.device)
+            self._APLs = torch.empty((self.capacity, 1), dtype=torch.float, device=preds.device)
+        elif preds.numel() != self._preds.shape[1]:
+            raise ValueError(f'Prediction vector of size {preds.numel()}, expected {self._preds.shape[1]}')
+
+        if self.size < self.capacity:
+            slot = self.size
+            self.size += 1
+        elif self.eviction == 'recency':
+            slot = self.n_seen % self.capacity
+        else:
+            slot = self._rng.integers(0, self.n_seen + 1)
+            if slot >= self.capacity:
+                self.n_seen += 1
+                return
+        self._preds[slot] = preds
+        self._APLs[slot, 0] = float(APL)
+        self.n_seen += 1
+
+    def tensors(self):
+        """(size, n) prediction vectors and (size, 1) APLs currently in the buffer."""
+        return self._preds[:self.size], self._APLs[:self.size]
@@ -0,0 +1,91 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from utils.util import predicted_classes
+
+
+def risk_coverage_curve(sel_proba, class_out, targets, num_classes=None):
+    """
+    Risk-coverage curve of a selector, from its outputs `sel_proba` and the predictions
+    `class_out` (logits) of a whole split, in O(N log N).
+
+    Every distinct selector output is a candidate threshold (samples with
+    sel_proba >= threshold are accepted). Returns a dict of numpy arrays, ordered by
+    decreasing threshold (i.e. increasing coverage):
+        thresholds, n_selected, coverage, risk (error rate of the accepted samples)
+    and aurc, the area under the risk-coverage curve.
+    """
+    num_classes = class_out.shape[1] if num_classes is None else num_classes
+    sel_proba = sel_proba.detach().reshape(-1)
+    errors = (predicted_classes(class_out.detach(), num_classes) != targets.reshape(-1).long())
+    n_samples = len(sel_proba)
+    if n_samples == 0:
+        raise ValueError('Cannot compute the risk-coverage curve of an empty split')
+
+    sel_sorted, order = torch.sort(sel_proba, descending=True)
+    errors_accepted = torch.cumsum(errors[order].to(torch.float64), dim=0)
+    n_accepted = torch.arange(1, n_samples + 1, dtype=torch.float64, device=sel_proba.device)
+    # samples with equal outputs are accepted together: keep the last of every run
+    last = torch.ones(n_samples, dtype=torch.bool, device=sel_proba.device)
+    last[:-1] = sel_sorted[1:] != sel_sorted[:-1]
+
+    risk_per_sample = errors_accepted / n_accepted
+    n_selected = n_accepted[last]
+    return {
+        'thresholds': sel_sorted[last].double().cpu().numpy(),
+        'n_selected': n_selected.long().cpu().numpy(),
+        'coverage': (n_selected / n_samples).cpu().numpy(),
+        'risk': risk_per_sample[last].cpu().numpy(),
+        'aurc': float(risk_per_sample.mean()),
+    }
+
+
+def threshold_for_coverage(curve, target_coverage):
+    """
+    The highest threshold of `curve` with a coverage of at least `target_coverage`,
+    with the coverage and risk it achieves.
+    """
+    idx = int(np.searchsorted(curve['coverage'], target_coverage - 1e-12, side='left'))
+    idx = min(idx, len(curve['thresholds']) - 1)
+    return {'threshold': float(curve['thresholds'][idx]),
+            'coverage': float(curve['coverage'][idx]),
+            'risk': float(curve['risk'][idx])}
+
+
+def operating_point(curve, selection_threshold):
+    """Coverage and risk of `curve` when accepting sel_proba >= `selection_threshold`."""
+    # thresholds are decreasing, count those >= selection_threshold
+    idx = int(np.searchsorted(-curve['thresholds'], -selection_threshold, side='right')) - 1
+    if idx < 0:
+        return {'threshold': float(selection_threshold), 'coverage': 0.0, 'risk': 0.0}
+    return {'threshold': float(selection_threshold),
+            'coverage': float(curve['coverage'][idx]),
+            'risk': float(curve['risk'][idx])}
+
+
+def save_risk_coverage(path, curve, target_coverages=(), selection_threshold=None):
+    """
+    Write `curve` to the json file `path`, with the calibrated threshold of every
+    coverage in `target_coverages` and the operating point of `selection_threshold`.
+    """
+    content = {name: (value.tolist() if isinstance(value, np.ndarray) else value)
+               for name, value in curve.items()}
+    content['calibrated'] = {str(coverage): threshold_for_coverage(curve, coverage)
+                             for coverage in target_coverages}
+    if selection_threshold is not None:
+        content['operating_point'] = operating_point(curve, selection_threshold)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(content, f, indent=2)
+
+
+def load_risk_coverage(path):
+    """Curve saved by save_risk_coverage, e.g. to retune a threshold with threshold_for_coverage."""
+    with open(path) as f:
+        content = json.load(f)
+    for name in ('thresholds', 'n_selected', 'coverage', 'risk'):
+        content[name] = np.asarray(content[name])
+    return content
@@ -0,0 +1,106 @@
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score
+
+from utils.util import predicted_classes
+
+
+def _flatten_inputs(class_out, sel_proba, targets, num_classes):
+    predictions = predicted_classes(class_out, num_classes)
+    targets = targets.reshape(-1).long()
+    return predictions, sel_proba.reshape(-1), targets
+
+
+def selective_sweep(class_out, sel_proba, targets, thresholds, num_classes=None):
+    """
+    Selective prediction statistics for every threshold in `thresholds` at once, where
+    the samples with sel_proba >= threshold are selected (accepted).
+
+    The selector outputs are sorted once and the correct predictions summed cumulatively,
+    so a sweep costs O(N log N + T log N) for N samples and T thresholds.
+    Returns a dict of (T,) tensors:
+        ta / fa: correctly / incorrectly predicted selected samples
+        tr / fr: correctly / incorrectly predicted rejected samples
+        n_selected, n_rejected, coverage
+        selected_accuracy: accuracy on the selected samples (in %)
+        rejected_accuracy: accuracy on the rejected samples (in %)
+        selective_risk: error rate on the selected samples
+    """
+    num_classes = class_out.shape[1] if num_classes is None else num_classes
+    predictions, sel_proba, targets = _flatten_inputs(class_out, sel_proba, targets, num_classes)
+    thresholds = torch.as_tensor(thresholds, dtype=sel_proba.dtype, device=sel_proba.device).reshape(-1)
+
+    n_samples = len(sel_proba)
+    sel_sorted, order = torch.sort(sel_proba)
+    correct_sorted = (predictions == targets)[order].to(torch.float64)
+    # number of correct predictions among the i samples with the lowest sel_proba
+    correct_below = torch.cat([correct_sorted.new_zeros(1), torch.cumsum(correct_sorted, dim=0)])
+
+    n_rejected = torch.searchsorted(sel_sorted, thresholds, side='left')
+    tr = correct_below[n_rejected]
+    ta = correct_below[-1] - tr
+    n_rejected = n_rejected.to(torch.float64)
+    n_selected = n_samples - n_rejected
+    fa = n_selected - ta
+    fr = n_rejected - tr
+
+    selected_accuracy = ta / (n_selected + 1e-12)
+    return {
+        'thresholds': thresholds,
+        'ta': ta, 'tr': tr, 'fa': fa, 'fr': fr,
+        'n_selected': n_selected,
+        'n_rejected': n_rejected,
+        'coverage': n_selected / max(n_samples, 1),
+        'selected_accuracy': selected_accuracy * 100,
+        'rejected_accuracy': tr / (n_rejected + 1e-12) * 100,
+        'selective_risk': torch.where(n_selected > 0, 1 - selected_accuracy, torch.zeros_like(ta)),
+    }
+
+
+def selective_auroc(class_out, targets, selected=None, num_classes=None):
+    """
+    AUROC of the class outputs (logits) on the `selected` samples: of the positive class
+    for binary outputs, one-vs-rest macro average otherwise. 0.5 when it is undefined,
+    e.g. if only one class is selected.
+    """
+    num_classes = class_out.shape[1] if num_classes is None else num_classes
+    if selected is not None:
+        class_out, targets = class_out[selected], targets.reshape(-1)[selected]
+    if class_out.dim() == 1 or class_out.shape[1] == 1:
+        scores = torch.sigmoid(class_out.reshape(-1))
+    else:
+        scores = torch.softmax(class_out.float(), dim=1)
+        if num_classes == 2:
+            scores = scores[:, 1]
+    gt_np = targets.reshape(-1).long().cpu().numpy()
+    scores_np = scores.detach().cpu().numpy()
+    try:
+        if scores_np.ndim == 1:
+            return roc_auc_score(gt_np, scores_np)
+        return roc_auc_score(gt_np, scores_np, multi_class='ovr', labels=np.arange(num_classes))
+    except ValueError:
+        return 0.5
+
+
+def selective_stats(class_out, sel_proba, targets, selection_threshold, num_classes=None,
+                    with_auroc=False, sweep_thresholds=None):
+    """
+    All the selective prediction statistics of one split at `selection_threshold`, from
+    one sort of the selector outputs: the entries of selective_sweep as floats, plus the
+    AUROC on the selected samples if `with_auroc`, plus the whole `sweep` (numpy arrays)
+    if `sweep_thresholds` are given.
+    """
+    thresholds = [selection_threshold] + ([] if sweep_thresholds is None else list(sweep_thresholds))
+    sweep = selective_sweep(class_out, sel_proba, targets, thresholds, num_classes=num_classes)
+    names = [name for name in sweep if name != 'thresholds']
+    # one host copy for everything
+    values = torch.stack([sweep[name].to(torch.float64) for name in names]).cpu().numpy()
+
+    stats = {name: float(values[i, 0]) for i, name in enumerate(names)}
+    if with_auroc:
+        selected = sel_proba.reshape(-1) >= selection_threshold
+        stats['auroc'] = selective_auroc(class_out, targets, selected, num_classes=num_classes)
+    if sweep_thresholds is not None:
+        stats['sweep'] = {name: values[i, 1:] for i, name in enumerate(names)}
+        stats['sweep']['thresholds'] = np.asarray(thresholds[1:], dtype=np.float64)
+    return stats
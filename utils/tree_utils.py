@@ -1,4 +1,6 @@
 import re
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import seaborn as sns
 import matplotlib.colors as mcolors
@@ -247,26 +249,33 @@ def plot_partial_dependence_trees(tree1, tree2, X, feature_names, target=0):
     plt.show()
 
 
-def compute_semantic_similarity(tree1, tree2, X):
-    leaf_ids1 = tree1.apply(X)
-    leaf_ids2 = tree2.apply(X)
-
-    # Leaf node distribution
-    unique_leaf_ids1, counts1 = np.unique(leaf_ids1, return_counts=True)
-    unique_leaf_ids2, counts2 = np.unique(leaf_ids2, return_counts=True)
-
-    leaf_dist1 = dict(zip(unique_leaf_ids1, counts1))
-    leaf_dist2 = dict(zip(unique_leaf_ids2, counts2))
-
-    common_leaves = set(leaf_dist1.keys()).intersection(set(leaf_dist2.keys()))
-    leaf_similarity = sum(min(leaf_dist1[leaf], leaf_dist2[leaf]) for leaf in
-                          common_leaves) / min(sum(counts1), sum(counts2))
-
-    # Path similarity
-    paths1 = [tree1.decision_path([x]).toarray() for x in X]
-    paths2 = [tree2.decision_path([x]).toarray() for x in X]
-    path_similarity = np.mean(
-        [np.array_equal(p1, p2) for p1, p2 in zip(paths1, paths2)])
+def compute_semantic_similarity(tree1, tree2, X, chunk_size=None):
+    """
+    leaf_similarity: overlap of the leaf id distributions of the two trees on X.
+    path_similarity: fraction of the samples of X that visit exactly the same node ids in
+    both trees (never the case for trees with different node counts).
+    With `chunk_size`, X is processed in chunks of that many samples, so that the
+    decision paths of a large X never have to be held at once.
+    """
+    n_samples = len(X)
+    chunk_size = n_samples if chunk_size is None else chunk_size
+    n_nodes = max(tree1.tree_.node_count, tree2.tree_.node_count)
+    leaf_counts1 = np.zeros(n_nodes, dtype=np.int64)
+    leaf_counts2 = np.zeros(n_nodes, dtype=np.int64)
+    n_same_paths = 0
+    for start in range(0, n_samples, max(1, chunk_size)):
+        X_chunk = X[start:start + chunk_size]
+        # Leaf node distribution
+        leaf_counts1 += np.bincount(tree1.apply(X_chunk), minlength=n_nodes)
+        leaf_counts2 += np.bincount(tree2.apply(X_chunk), minlength=n_nodes)
+        # Path similarity
+        if tree1.tree_.node_count == tree2.tree_.node_count:
+            n_same_paths += _count_equal_csr_rows(tree1.decision_path(X_chunk),
+                                                  tree2.decision_path(X_chunk))
+
+    leaf_similarity = np.minimum(leaf_counts1, leaf_counts2).sum() / \
+        min(leaf_counts1.sum(), leaf_counts2.sum())
+    path_similarity = n_same_paths / n_samples
 
     semantic_similarity = {
         'leaf_similarity': leaf_similarity,
@@ -276,6 +285,25 @@ def compute_semantic_similarity(tree1, tree2, X):
     return semantic_similarity
 
 
+def _count_equal_csr_rows(paths1, paths2):
+    """Number of rows of two CSR node indicator matrices with the same set of nodes."""
+    paths1.sort_indices()
+    paths2.sort_indices()
+    lengths1 = np.diff(paths1.indptr)
+    lengths2 = np.diff(paths2.indptr)
+    rows = np.flatnonzero(lengths1 == lengths2)
+    if len(rows) == 0:
+        return 0
+    lengths = lengths1[rows]
+    # position of every node of the candidate rows in both index arrays
+    row_starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    offsets = np.arange(lengths.sum()) - row_starts
+    same = paths1.indices[np.repeat(paths1.indptr[rows], lengths) + offsets] == \
+        paths2.indices[np.repeat(paths2.indptr[rows], lengths) + offsets]
+    # every path holds at least the root, so no segment is empty
+    return int(np.logical_and.reduceat(same, np.cumsum(lengths) - lengths).sum())
+
+
 def serialize_tree(tree):
     # Serialize the tree structure and node values
     return hashlib.md5(tree.tree_.__getstate__()['nodes'].tobytes()).hexdigest()
@@ -503,52 +531,101 @@ def find_closest_paths_to_0_and_1(classifications_prob, counts_prob,
 
 
 def find_best_trees(X, y, num_trees = 1500, threshold = 0.02, min_performance = 0.9,
-                    min_samples_leaf=1):
+                    min_samples_leaf=1, n_jobs=1, max_trees=None, chunk_size=None):
+    """
+    Unique trees (clf, random_state, accuracy) among `num_trees` trees fitted with
+    random states 0..num_trees-1 whose training accuracy is within `threshold` of the
+    best one and at least `min_performance`, in random state order.
+
+    The trees are fitted in chunks of random states, in a pool of `n_jobs` processes if
+    n_jobs > 1. Every chunk only returns its unique trees within `threshold` of the chunk
+    best (no other tree can be within `threshold` of the overall best), and the chunks are
+    merged in order into a running selection, so at most the near-best trees are kept in
+    memory. With `max_trees`, only the max_trees best of them are kept.
+    """
+    if chunk_size is None:
+        chunk_size = max(1, int(np.ceil(num_trees / (4 * max(1, n_jobs or 1)))))
+    chunks = [range(start, min(start + chunk_size, num_trees))
+              for start in range(0, num_trees, chunk_size)]
+    task_args = (min_samples_leaf, threshold, min_performance)
+
+    best_score = -np.inf
+    selected = []  # (clf, random_state, mean_score) in random state order
+    seen_hashes = set()
 
-    # Number of different random states to visualize
-    num_trees = num_trees
-    performance_threshold = threshold  # Performance range (e.g., within 2% of the best performance)
-    min_performance = min_performance  # Minimum performance to consider (e.g., accuracy of 90%)
-    # First pass to collect all scores
+    def merge(chunk_result):
+        nonlocal best_score, selected
+        chunk_best, candidates = chunk_result
+        best_score = max(best_score, chunk_best)
+        for clf, random_state, mean_score, tree_hash in candidates:
+            # identical trees have identical scores, so the first one decides for all
+            if tree_hash not in seen_hashes:
+                seen_hashes.add(tree_hash)
+                selected.append((clf, random_state, mean_score))
+        selected = [tree for tree in selected if best_score - threshold <= tree[2]]
+        if max_trees is not None and len(selected) > max_trees:
+            selected = sorted(selected, key=lambda tree: (-tree[2], tree[1]))[:max_trees]
+            selected.sort(key=lambda tree: tree[1])
+
+    if n_jobs is None or n_jobs <= 1 or len(chunks) <= 1:
+        for random_states in chunks:
+            merge(_fit_tree_chunk(X, y, random_states, *task_args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_tree_search_worker,
+                                 initargs=(X, y)) as executor:
+            # map keeps the chunk order, whatever order the fits finish in
+            for chunk_result in executor.map(_fit_tree_chunk_worker,
+                                             [(random_states,) + task_args for random_states in chunks]):
+                merge(chunk_result)
 
+    # Visualize the unique trees with similar performance
+    # for clf, random_state, mean_score in unique_trees:
+    #     title = f"tree_random_state_{random_state}_score_{mean_score:.4f}"
+    #     graph = export_tree_graphviz(clf, feature_names, class_names, title)
+        # graph.view()
+
+    return selected
+
+
+def _fit_tree_chunk(X, y, random_states, min_samples_leaf, threshold, min_performance):
+    """
+    Fit one tree per random state and return the best accuracy of the chunk with the
+    unique (clf, random_state, accuracy, hash) candidates that can still be selected.
+    """
     scores = []
-    classifiers = []
-    for i in range(num_trees):
-        random_state = i
+    trees = []
+    for random_state in random_states:
         clf = DecisionTreeClassifier(random_state=random_state,
                                      min_samples_leaf=min_samples_leaf)
         clf.fit(X, y)  # Train on the full dataset
-        y_pred = clf.predict(X)
-        mean_score = accuracy_score(y, y_pred)
-        classifiers.append((clf, random_state, mean_score))
+        mean_score = accuracy_score(y, clf.predict(X))
         scores.append(mean_score)
+        trees.append((clf, random_state, mean_score))
 
-    # Determine the best score
-    best_score = max(scores)
-
-    # Filter classifiers with similar performance
-    similar_trees = [
-        (clf, random_state, mean_score)
-        for clf, random_state, mean_score in classifiers
-        if
-        best_score - performance_threshold <= mean_score <= best_score + performance_threshold and mean_score >= min_performance
-    ]
-    # Remove identical trees
-    unique_trees = []
+    chunk_best = max(scores)
+    candidates = []
     seen_hashes = set()
-    for clf, random_state, mean_score in similar_trees:
+    for clf, random_state, mean_score in trees:
+        if mean_score < chunk_best - threshold or mean_score < min_performance:
+            continue
         tree_hash = serialize_tree(clf)
         if tree_hash not in seen_hashes:
             seen_hashes.add(tree_hash)
-            unique_trees.append((clf, random_state, mean_score))
+            candidates.append((clf, random_state, mean_score, tree_hash))
+    return chunk_best, candidates
+
+
+_tree_search_data = {}
+
+
+def _init_tree_search_worker(X, y):
+    # the data is sent once per worker rather than once per chunk
+    _tree_search_data['X'] = X
+    _tree_search_data['y'] = y
 
-    # Visualize the unique trees with similar performance
-    # for clf, random_state, mean_score in unique_trees:
-    #     title = f"tree_random_state_{random_state}_score_{mean_score:.4f}"
-    #     graph = export_tree_graphviz(clf, feature_names, class_names, title)
-        # graph.view()
 
-    return unique_trees
+def _fit_tree_chunk_worker(task):
+    return _fit_tree_chunk(_tree_search_data['X'], _tree_search_data['y'], *task)
 
 
 def calculate_feature_similarity(tree1, tree2):
@@ -685,16 +762,82 @@ def traverse_nodes_chaid(node):
     for child in node.children.values():
         yield from traverse_nodes_chaid(child)
 
-def find_highest_similarity_pair(trees_list1, trees_list2, feature_names):
-    max_similarity = -1
-    best_pair = (None, None)
+def _dot_similarity(F1, F2):
+    return F1 @ F2.T
+
+
+def _cosine_similarity(F1, F2):
+    norms1 = np.linalg.norm(F1, axis=1, keepdims=True)
+    norms2 = np.linalg.norm(F2, axis=1, keepdims=True)
+    # trees without splits have no importances, give them similarity 0
+    F1 = np.divide(F1, norms1, out=np.zeros_like(F1), where=norms1 > 0)
+    F2 = np.divide(F2, norms2, out=np.zeros_like(F2), where=norms2 > 0)
+    return F1 @ F2.T
+
+
+def _overlap_similarity(F1, F2):
+    """Jaccard overlap of the sets of features the trees split on."""
+    used1 = (F1 > 0).astype(np.float64)
+    used2 = (F2 > 0).astype(np.float64)
+    intersection = used1 @ used2.T
+    union = used1.sum(axis=1)[:, None] + used2.sum(axis=1)[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+FEATURE_SIMILARITY_METRICS = {
+    'dot': _dot_similarity,  # calculate_feature_similarity of every pair
+    'cosine': _cosine_similarity,
+    'overlap': _overlap_similarity,
+}
 
-    for tree1 in trees_list1:
-        for tree2 in trees_list2:
-            similarity = calculate_feature_similarity(tree1, tree2)
-            if similarity > max_similarity:
-                max_similarity = similarity
-                best_pair = (tree1, tree2)
+
+def feature_similarity_matrix(trees_list1, trees_list2, metric='dot'):
+    """
+    (len(trees_list1), len(trees_list2)) similarities of the feature importances of every
+    pair of trees. `metric` is a key of FEATURE_SIMILARITY_METRICS or a function of the two
+    stacked (n_trees, n_features) importance matrices.
+    """
+    if not callable(metric):
+        if metric not in FEATURE_SIMILARITY_METRICS:
+            raise ValueError(f'Unknown similarity metric: {metric}')
+        metric = FEATURE_SIMILARITY_METRICS[metric]
+    F1 = np.stack([tree.feature_importances_ for tree in trees_list1]).astype(np.float64)
+    F2 = np.stack([tree.feature_importances_ for tree in trees_list2]).astype(np.float64)
+    return metric(F1, F2)
+
+
+def top_similar_pairs(similarities, top_k=1):
+    """
+    (i, j, similarity) of the `top_k` most similar pairs of a similarity matrix, best first
+    (ties in row-major order, as a double loop keeping strict improvements would).
+    """
+    flat = similarities.ravel()
+    top_k = min(top_k, flat.size)
+    if top_k == 1:
+        # argmax returns the first maximum
+        candidates = np.array([flat.argmax()])
+    else:
+        if top_k < flat.size:
+            # every value tied with the k-th best, argpartition picks among them arbitrarily
+            kth = flat[np.argpartition(-flat, top_k - 1)[top_k - 1]]
+            candidates = np.flatnonzero(flat >= kth)
+        else:
+            candidates = np.arange(flat.size)
+        candidates = candidates[np.lexsort((candidates, -flat[candidates]))][:top_k]
+    n_cols = similarities.shape[1]
+    return [(int(k // n_cols), int(k % n_cols), flat[k]) for k in candidates]
+
+
+def find_highest_similarity_pair(trees_list1, trees_list2, feature_names, metric='dot', top_k=None):
+    """
+    The most similar pair of trees, its similarity and the most important feature of both
+    trees. With `top_k`, the (i, j, similarity) of the `top_k` most similar pairs (see
+    top_similar_pairs) are returned as a fourth element.
+    """
+    similarities = feature_similarity_matrix(trees_list1, trees_list2, metric=metric)
+    top_pairs = top_similar_pairs(similarities, top_k=max(1, top_k or 1))
+    i, j, max_similarity = top_pairs[0]
+    best_pair = (trees_list1[i], trees_list2[j])
 
     # find the feature with the highest importance in the best pair
     best_pair_features = []
@@ -713,6 +856,8 @@ def find_highest_similarity_pair(trees_list1, trees_list2, feature_names):
     print(f"Best feature: {feature_names[best_pair_features[0]]}")
     best_feature_name = feature_names[best_pair_features[0]]
 
+    if top_k is not None:
+        return best_pair, max_similarity, best_feature_name, top_pairs
     return best_pair, max_similarity, best_feature_name
 
 
@@ -31,6 +31,50 @@ def inf_loop(data_loader):
     for loader in repeat(data_loader):
         yield from loader
 
+def dataset_column(dataset, index):
+    """
+    Whole column `index` of a dataset, as `dataset[:][index]` of a TensorDataset,
+    for datasets that cannot be sliced (e.g. sharded or CUB datasets, through their
+    `columns` method) without materialising the other columns, and Subset views of them.
+    """
+    if isinstance(dataset, torch.utils.data.TensorDataset):
+        return dataset.tensors[index]
+    if isinstance(dataset, torch.utils.data.Subset):
+        return dataset_column(dataset.dataset, index)[torch.as_tensor(dataset.indices, dtype=torch.long)]
+    if hasattr(dataset, 'columns'):
+        return dataset.columns(index)[0]
+    raise ValueError(f'{type(dataset).__name__} does not support column access')
+
+def get_subset_loader(data_loader, subset_indices, batch_size=None, num_workers=0, shuffle=False):
+    """
+    Index-based DataLoader over the samples `subset_indices` of `data_loader.dataset`.
+    Samples keep the order of `subset_indices` (unless `shuffle`) and are decoded batch
+    by batch, by `num_workers` parallel workers if num_workers > 0.
+    """
+    subset = torch.utils.data.Subset(data_loader.dataset, np.asarray(subset_indices).tolist())
+    # an empty subset yields no batches
+    batch_size = max(1, batch_size or data_loader.batch_size or len(subset))
+    loader = torch.utils.data.DataLoader(subset, batch_size=batch_size, shuffle=shuffle,
+                                         num_workers=num_workers,
+                                         pin_memory=torch.cuda.is_available())
+    if hasattr(data_loader, 'batch_transform'):
+        # keep the batched (e.g. on-device augmentation) transform of the original loader
+        return type(data_loader)(loader, data_loader.batch_transform, data_loader.device)
+    return loader
+
+def get_subset_column(data_loader, subset_indices, index=0, num_workers=0):
+    """
+    Column `index` (e.g. 0 for X) of the samples `subset_indices` of `data_loader.dataset`,
+    as loaded (and batch-transformed) by get_subset_loader. Empty subsets give an empty
+    tensor with the shape and dtype of the column.
+    """
+    if len(subset_indices) == 0:
+        if len(data_loader.dataset) == 0:
+            return torch.empty(0)
+        return next(iter(get_subset_loader(data_loader, [0])))[index][:0]
+    subset_loader = get_subset_loader(data_loader, subset_indices, num_workers=num_workers)
+    return torch.cat([batch[index] for batch in subset_loader])
+
 def prepare_device(n_gpu_use):
     """
     setup GPU device if available. get gpu device indices which are used for DataParallel
@@ -57,6 +101,15 @@ def get_correct(y_hat, y, num_classes):
     else:
         return y_hat.argmax(dim=1).eq(y).sum().item()
 
+def predicted_classes(logits, num_classes, threshold=0.5):
+    """
+    Predicted class of every sample, as a (batch_size,) long tensor on the device of `logits`.
+    For num_classes == 2 the logits can also be the single logit of the positive class.
+    """
+    if num_classes == 2 and (logits.dim() == 1 or logits.shape[1] == 1):
+        return (torch.sigmoid(logits) >= threshold).long().reshape(-1)
+    return logits.argmax(dim=1)
+
 def correct_predictions_per_class(logits, true_labels, num_classes,
                                   threshold=0.5):
     """